@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2013 William Adams
+#  Distributed under the terms of the Modified BSD License.
+#  The full license is in the file LICENSE, distributed with this software.
+#
+
+from izdvd import main as izdvd_main
+from izdvd import utils
+from izdvd import config
+from izdvd import runner
+from izdvd import trace
+from izdvd import metrics
+from izdvd import workspace
+from argparse import ArgumentParser
+from datetime import datetime
+import threading
+import itertools
+import heapq
+import json
+import tempfile
+import os
+import sys
+import logging
+
+
+class Error(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+def get_device(path):
+    '''Returns the device path is (or would be) on.'''
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev
+
+
+class Slots (object):
+    '''A counting semaphore that hands out free slots by priority instead
+    of in arrival order.  The priority is set per thread with
+    set_priority(), so the DVDs using the slots don't need to know about
+    it.
+    '''
+    def __init__(self, count):
+        self.count = count
+        self.cond = threading.Condition()
+        self.waiting = []
+        self.seq = itertools.count()
+        self.local = threading.local()
+    
+    def set_priority(self, priority):
+        self.local.priority = priority
+    
+    def acquire(self):
+        entry = (-getattr(self.local, 'priority', 0), next(self.seq))
+        with self.cond:
+            heapq.heappush(self.waiting, entry)
+            while self.count < 1 or self.waiting[0] != entry:
+                self.cond.wait()
+            heapq.heappop(self.waiting)
+            self.count -= 1
+            # the next waiter may be able to take another free slot
+            self.cond.notify_all()
+    
+    def release(self):
+        with self.cond:
+            self.count += 1
+            self.cond.notify_all()
+    
+    def __enter__(self):
+        self.acquire()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+
+class Job (object):
+    def __init__(self, index, name, priority, options):
+        self.index = index
+        self.name = name
+        self.priority = priority
+        self.options = options
+        self.status = 'pending'
+        self.error = None
+        self.start = None
+        self.end = None
+        self.get_disk_required()
+    
+    def get_disk_required(self):
+        '''Rough amount of disk space the job will use while it runs
+        (see DVD.get_out_paths), per device.
+        
+        Sets self.disks to {device: bytes}, self.disk_paths to {device: 
+        path} and self.disk to the total.
+        '''
+        dvd_size = self.options.dvd_size_bytes
+        if self.options.low_disk:
+            tmp_size = 300*1024*1024
+        else:
+            tmp_size = dvd_size * 1.2
+        if self.options.tmp_budget:
+            tmp_size = self.options.tmp_budget * 1024 * 1024
+        out_dir = self.options.out_dir or os.getcwd()
+        tmp_dir = self.options.tmp_dir or os.path.join(tempfile.gettempdir(), 
+                                                       config.PROG_NAME)
+        self.disks = {}
+        self.disk_paths = {}
+        for path, size in [(out_dir, dvd_size * 1.05), (tmp_dir, tmp_size)]:
+            dev = get_device(path)
+            self.disks[dev] = self.disks.get(dev, 0) + size
+            # the tmp dir wins on a shared device, so that the space other
+            # runs have reserved in it is counted (see get_disk_budget)
+            self.disk_paths[dev] = path
+        self.disk = sum(self.disks.values())
+    
+    def get_elapsed(self):
+        if self.start is None:
+            return None
+        end = self.end or datetime.now()
+        return str(end - self.start).split('.')[0]
+
+
+class Batch (object):
+    '''Makes many DVDs in one process.
+    
+    Jobs are read from a json manifest and started by priority, at most
+    max_jobs at a time.  The heavy stages of every job (menu rendering,
+    encoding and authoring) share cpu_slots, so lighter work (probing,
+    waiting on dvdauthor) overlaps with them without oversubscribing the
+    cpu.  A job is only started when its expected disk usage fits in what
+    is left of the budget of each device it writes to (its out and tmp 
+    dirs); disk_budget is the budget for each device.  Because the jobs run in the same process, the
+    mediainfo cache (utils.get_mediainfo) is shared between them.
+    
+    The manifest is either a list of jobs or an object with "jobs" and
+    (optionally) "defaults".  Each job takes the same options as izdvd,
+    either as command line "args", as "options" (using the izdvd option
+    names, e.g. "in_dirs", "out_name") or both, plus an optional "name"
+    and "priority" (higher runs first).
+    '''
+    def __init__(self,
+                 manifest,
+                 max_jobs=2,
+                 cpu_slots=None,
+                 disk_budget=None,
+                 pool_limits=None):
+        self.manifest = manifest
+        self.max_jobs = max_jobs
+        self.cpu_slots = cpu_slots or max_jobs
+        self.disk_budget = disk_budget
+        self.pool_limits = pool_limits or {}
+        for k,v in self.pool_limits.items():
+            runner.set_limit(k, v)
+        self.logger = logging.getLogger('{}.batch'.format(config.PROG_NAME))
+        #----------
+        self.read_manifest()
+        self.get_disk_budget()
+        self.log_jobs()
+        self.run()
+        self.log_summary()
+    
+    def read_manifest(self):
+        with open(self.manifest) as f:
+            data = json.load(f)
+        if type(data) == list:
+            data = {'jobs': data}
+        defaults = data.get('defaults', {})
+        self.jobs = []
+        for n,j in enumerate(data.get('jobs', [])):
+            options = self.get_job_options(j, defaults)
+            name = j.get('name') or options.out_name or 'job{}'.format(n+1)
+            self.jobs.append(Job(n, name, j.get('priority', 0), options))
+        if not self.jobs:
+            raise Error('No jobs found in {}'.format(self.manifest))
+    
+    def get_job_options(self, job, defaults):
+        parser = izdvd_main.get_parser('dvd')
+        dests = vars(parser.parse_args([]))
+        for k in itertools.chain(defaults, job.get('options', {})):
+            if k not in dests:
+                raise Error('Unknown option in {}: "{}"'.format(
+                                self.manifest, k))
+        parser.set_defaults(**defaults)
+        options = parser.parse_args(job.get('args', []))
+        for k,v in job.get('options', {}).items():
+            setattr(options, k, v)
+        # there is nobody to answer
+        options.no_prompt = True
+        # tracing and metrics are for the whole batch (see main)
+        del options.trace_file
+        del options.metrics_file
+        return options
+    
+    def get_disk_budget(self):
+        '''Set self.disk_free to {device: bytes} for the devices the jobs
+        write to.
+        '''
+        self.disk_free = {}
+        for j in self.jobs:
+            for dev, path in j.disk_paths.items():
+                if dev in self.disk_free:
+                    continue
+                if self.disk_budget is None:
+                    self.disk_free[dev] = workspace.get_space_available(path)
+                else:
+                    self.disk_free[dev] = self.disk_budget
+    
+    def log_jobs(self):
+        utils.log_items(heading='Batch Jobs', items=[], lines_before=1,
+                        logger=self.logger)
+        for j in self.get_queue():
+            log_data = [('Priority', j.priority),
+                        ('Disk', '{:.1f} MiB'.format(j.disk/1024/1024))]
+            utils.log_items('{}'.format(j.name), lines_before=0,
+                            sep_pre='-', sep_post='-', logger=self.logger)
+            utils.log_items(log_data, col_width=12, indent=4, lines_before=0,
+                            logger=self.logger)
+    
+    def get_queue(self):
+        pending = [i for i in self.jobs if i.status == 'pending']
+        return sorted(pending, key=lambda x: (-x.priority, x.index))
+    
+    def get_next_job(self, running):
+        '''Return the highest priority pending job that fits in the disk
+        budget.  A job larger than the whole budget is only started when
+        nothing else is running.
+        '''
+        for j in self.get_queue():
+            fits = all([v <= self.disk_free[k] for k,v in j.disks.items()])
+            if fits or not running:
+                return j
+        return None
+    
+    def run(self):
+        self.slots = Slots(self.cpu_slots)
+        self.cond = threading.Condition()
+        running = []
+        with self.cond:
+            while True:
+                while len(running) < self.max_jobs:
+                    job = self.get_next_job(running)
+                    if job is None:
+                        break
+                    job.status = 'running'
+                    for k,v in job.disks.items():
+                        self.disk_free[k] -= v
+                    t = threading.Thread(target=self.run_job, args=(job,),
+                                         name=job.name)
+                    running.append(job)
+                    t.start()
+                if not running:
+                    break
+                self.cond.wait()
+                for j in [i for i in running if i.status != 'running']:
+                    running.remove(j)
+                    for k,v in j.disks.items():
+                        self.disk_free[k] += v
+    
+    def run_job(self, job):
+        self.slots.set_priority(job.priority)
+        job.options.cpu_slots = self.slots
+        job.start = datetime.now()
+        self.logger.info('Starting job "{}"'.format(job.name))
+        try:
+            with trace.span(job.name, 'job', priority=job.priority):
+                izdvd_main.make_dvd(job.options)
+        except Exception as e:
+            job.error = e
+            status = 'failed'
+            self.logger.exception('Job "{}" failed'.format(job.name))
+        else:
+            status = 'done'
+            self.logger.info('Finished job "{}"'.format(job.name))
+        job.end = datetime.now()
+        with self.cond:
+            job.status = status
+            self.cond.notify_all()
+    
+    def log_summary(self):
+        utils.log_items(heading='Batch Summary', items=[], lines_before=1,
+                        logger=self.logger)
+        log_data = [(j.name, '{} ({})'.format(j.status, j.get_elapsed()))
+                    for j in self.jobs]
+        utils.log_items(log_data, col_width=24, indent=4, lines_before=0,
+                        logger=self.logger)
+        runner.log_stats(self.logger)
+        self.failed = [i for i in self.jobs if i.status != 'done']
+
+
+def get_options():
+    parser = ArgumentParser(description='''Make a DVD for each job in a json
+                                           manifest, sharing the cpu and disk
+                                           between them.''')
+    parser.add_argument('manifest', metavar='MANIFEST',
+                        help='''Path to a json file listing the jobs.  Each
+                                job takes the same options as izdvd, as
+                                "args" (a list of command line arguments)
+                                and/or "options" (a mapping of option names
+                                to values), along with an optional "name" and
+                                "priority" (higher runs first).  Options
+                                under a top level "defaults" mapping apply to
+                                every job.''')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=2,
+                        dest='max_jobs',
+                        help='''Maximum number of DVDs to work on at the same
+                                time.  Default: %(default)s''')
+    parser.add_argument('--cpu-slots', metavar='N', type=int,
+                        help='''Maximum number of cpu heavy stages (menu
+                                rendering, encoding, authoring) to run at
+                                the same time, across all jobs.
+                                Default: the number of jobs''')
+    parser.add_argument('--disk-budget', metavar='MiB', type=float,
+                        help='''Disk space the batch may use at once on each
+                                device.  Jobs wait to start until their
+                                output and temporary files fit on the
+                                devices of their out and tmp dirs.
+                                Default: the space available on each of
+                                those devices''')
+    parser.add_argument('--pool-limit', metavar='POOL=N', action='append',
+                        default=[], dest='pool_limits',
+                        help='''Maximum number of external commands to run
+                                at the same time in POOL (one of "ffmpeg",
+                                "imagemagick" or "mux").  Can be given more
+                                than once.''')
+    parser.add_argument('--trace', metavar='PATH', dest='trace_file',
+                        help='''Write a timeline of the whole batch to PATH
+                                in the Chrome trace format (see izdvd
+                                --trace).''')
+    parser.add_argument('--metrics-file', metavar='PATH',
+                        help='''Write metrics for the whole batch to PATH in
+                                the Prometheus text format (see izdvd
+                                --metrics-file).''')
+    options = parser.parse_args()
+    limits = {}
+    for i in options.pool_limits:
+        pool, sep, limit = i.partition('=')
+        if pool not in runner.POOL_LIMITS or not limit.isdigit():
+            parser.error('invalid --pool-limit: "{}"'.format(i))
+        limits[pool] = int(limit)
+    options.pool_limits = limits
+    if options.disk_budget is not None:
+        options.disk_budget = options.disk_budget * 1024 * 1024
+    return options
+
+def main():
+    options = get_options()
+    trace_file = vars(options).pop('trace_file')
+    if trace_file:
+        trace.enable(trace_file)
+    metrics_file = vars(options).pop('metrics_file')
+    if metrics_file:
+        metrics.enable(metrics_file)
+    batch = Batch(**vars(options))
+    if batch.failed:
+        return 1
+    metrics.set_value('izdvd_run_success', 1)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
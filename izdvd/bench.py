@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2013 William Adams
+#  Distributed under the terms of the Modified BSD License.
+#  The full license is in the file LICENSE, distributed with this software.
+#
+
+'''Benchmarks for the main parts of izdvd, run on media generated locally.
+
+Usage:
+    python3 -m izdvd.bench -o results.json [--baseline baseline.json]
+
+Each benchmark is run a number of times and its fastest and median times
+are written to a json file.  When a baseline (an earlier results file) is
+given, benchmarks that got slower by more than the threshold are reported
+as regressions and the exit status is 1.
+'''
+
+from izdvd.dvd import DVD
+from izdvd.dvdmenu import DVDMenu
+from izdvd.bg import BG
+from izdvd.encoder import Encoder
+from izdvd.image import TextImg
+from izdvd import runner
+from izdvd import config
+from argparse import ArgumentParser
+from datetime import datetime
+import statistics
+import platform
+import tempfile
+import shutil
+import json
+import time
+import sys
+import os
+
+
+LABELS_SHORT = ['Up', 'Heat', 'Jaws', 'Alien', 'Brazil', 'Vertigo']
+LABELS_LONG = ['The Good, the Bad and the Ugly',
+               'Dr. Strangelove or: How I Learned to Stop Worrying and '
+               'Love the Bomb',
+               'Night of the Day of the Dawn of the Son of the Bride of the '
+               'Return of the Revenge of the Terror of the Attack of the Evil, '
+               'Mutant, Alien, Flesh Eating, Hellbound, Zombified Living Dead',
+               'Lord of the Rings: The Return of the King (Extended Edition)',
+               'Borat: Cultural Learnings of America for Make Benefit '
+               'Glorious Nation of Kazakhstan',
+               'Birdman or (The Unexpected Virtue of Ignorance)']
+
+
+class Bench (object):
+    '''Generates the synthetic input once, then times each benchmark.
+    
+    Benchmarks are the bench_* methods.  Each one runs a single iteration
+    and returns the elapsed time; the tools listed in REQUIRES must be
+    installed for it to run.
+    '''
+    REQUIRES = {'file_matching': [],
+                'text_fitting': ['convert'],
+                'bg_layout': ['convert', 'identify'],
+                'menu_encode': ['convert', 'ppmtoy4m', 'mpeg2enc', 'toolame',
+                                'mplex', 'spumux'],
+                'encoder_passes': ['ffmpeg', 'mediainfo']}
+    
+    def __init__(self,
+                 work_dir=None,
+                 repeat=3,
+                 only=None,
+                 vid_seconds=10,
+                 num_posters=6,
+                 num_vids=200):
+        self.work_dir = work_dir
+        self.repeat = repeat
+        self.only = only
+        self.vid_seconds = vid_seconds
+        self.num_posters = num_posters
+        self.num_vids = num_vids
+        self.results = {}
+    
+    def run(self):
+        self.setup_work_dir()
+        try:
+            for name in sorted(self.REQUIRES):
+                if self.only and name not in self.only:
+                    continue
+                self.run_bench(name)
+        finally:
+            if self.remove_work_dir:
+                shutil.rmtree(self.work_dir, ignore_errors=True)
+        return self.get_report()
+    
+    def setup_work_dir(self):
+        self.remove_work_dir = self.work_dir is None
+        if self.work_dir is None:
+            self.work_dir = tempfile.mkdtemp(prefix='{}_bench_'.format(
+                                                 config.PROG_NAME))
+        elif not os.path.exists(self.work_dir):
+            os.makedirs(self.work_dir)
+    
+    def run_bench(self, name):
+        missing = [i for i in self.REQUIRES[name] if not shutil.which(i)]
+        if missing:
+            self.results[name] = {'skipped': 'missing {}'.format(
+                                                 ', '.join(missing))}
+            print('{:<16} skipped (missing {})'.format(name,
+                                                       ', '.join(missing)))
+            return
+        prepare = getattr(self, 'prepare_{}'.format(name), None)
+        if prepare is not None:
+            prepare()
+        bench = getattr(self, 'bench_{}'.format(name))
+        times = [bench() for i in range(self.repeat)]
+        self.results[name] = {'min': min(times),
+                              'median': statistics.median(times),
+                              'runs': times}
+        print('{:<16} min {:8.3f}s   median {:8.3f}s'.format(
+                  name, min(times), statistics.median(times)))
+    
+    def get_report(self):
+        return {'created': datetime.now().isoformat(),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'cpus': os.cpu_count(),
+                'repeat': self.repeat,
+                'results': self.results}
+    
+    def get_path(self, *parts):
+        path = os.path.join(self.work_dir, *parts)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        return path
+    
+    # ------------------------------------------------------------------------
+    # synthetic input
+    
+    def make_posters(self):
+        '''Posters with different sizes and aspect ratios, so that the
+        layout and resizing code has real work to do.
+        '''
+        if getattr(self, 'posters', None):
+            return self.posters
+        sizes = [(400, 600), (600, 400), (500, 500), (300, 450),
+                 (1000, 1500), (640, 360)]
+        colors = ['red', 'green', 'blue', 'orange', 'purple', 'gray']
+        self.posters = []
+        for n in range(self.num_posters):
+            w, h = sizes[n % len(sizes)]
+            path = self.get_path('posters', 'poster{:02}.png'.format(n))
+            runner.check_call(['convert', '-size', '{}x{}'.format(w, h),
+                               'gradient:{}-black'.format(
+                                   colors[n % len(colors)]),
+                               '-fill', 'white', '-pointsize', str(h//6),
+                               '-gravity', 'center', '-annotate', '+0+0',
+                               str(n+1), path], pool='imagemagick')
+            self.posters.append(path)
+        return self.posters
+    
+    def get_labels(self):
+        labels = LABELS_SHORT + LABELS_LONG
+        return [labels[n % len(labels)] for n in range(self.num_posters)]
+    
+    def make_video(self):
+        if getattr(self, 'video', None):
+            return self.video
+        self.video = self.get_path('video', 'testsrc.mkv')
+        runner.check_call(['ffmpeg', '-y', '-v', 'error',
+                           '-f', 'lavfi', '-i',
+                           'testsrc2=size=1280x720:rate=24000/1001:'
+                           'duration={}'.format(self.vid_seconds),
+                           '-f', 'lavfi', '-i',
+                           'sine=frequency=440:sample_rate=48000:'
+                           'duration={}'.format(self.vid_seconds),
+                           '-c:v', 'ffv1', '-c:a', 'flac', self.video],
+                          pool='ffmpeg')
+        return self.video
+    
+    def make_library(self):
+        '''Empty video files with images named like them (with varying case,
+        punctuation and extensions) and some without, so that both the
+        glob and the difflib paths in get_matching_file are exercised.
+        '''
+        self.vids = []
+        lib = os.path.join(self.work_dir, 'library')
+        if not os.path.exists(lib):
+            os.makedirs(lib)
+        for n in range(self.num_vids):
+            name = '{} ({})'.format(LABELS_LONG[n % len(LABELS_LONG)],
+                                    1950 + n)
+            vid = os.path.join(lib, '{}.mkv'.format(name))
+            open(vid, 'w').close()
+            self.vids.append(vid)
+            if n % 3 == 0:
+                img = '{}.jpg'.format(name)
+            elif n % 3 == 1:
+                img = '{}.poster.PNG'.format(name.lower().replace(' ', '.'))
+            else:
+                continue
+            open(os.path.join(lib, img), 'w').close()
+    
+    # ------------------------------------------------------------------------
+    # benchmarks
+    
+    def prepare_file_matching(self):
+        self.make_library()
+        self.dvd = DVD.__new__(DVD)
+        self.dvd.one_vid_per_dir = False
+    
+    def bench_file_matching(self):
+        start = time.time()
+        for i in self.vids:
+            self.dvd.get_matching_file(i, ['png', 'jpg', 'bmp', 'gif'],
+                                       ['poster', 'folder'])
+        return time.time() - start
+    
+    def bench_text_fitting(self):
+        start = time.time()
+        for i in LABELS_SHORT + LABELS_LONG:
+            TextImg(i, line_height=18, max_width=200, max_lines=2,
+                    strokewidth=4)
+        return time.time() - start
+    
+    def prepare_bg_layout(self):
+        self.make_posters()
+    
+    def bench_bg_layout(self):
+        out_dir = tempfile.mkdtemp(dir=self.work_dir)
+        start = time.time()
+        BG(self.make_posters(), menu_labels=self.get_labels(),
+           out_dir=out_dir, tmp_dir=out_dir, out_name='bench',
+           menu_ar=16/9, label_line_height=18, mode='dvd', no_logging=True)
+        elapsed = time.time() - start
+        shutil.rmtree(out_dir, ignore_errors=True)
+        return elapsed
+    
+    def prepare_menu_encode(self):
+        self.make_posters()
+    
+    def bench_menu_encode(self):
+        out_dir = tempfile.mkdtemp(dir=self.work_dir)
+        start = time.time()
+        DVDMenu(self.make_posters(), menu_labels=self.get_labels(),
+                out_dir=out_dir, tmp_dir=out_dir, out_name='bench',
+                menu_ar=16/9, label_line_height=18, frames=60, mode='dvd',
+                no_logging=True)
+        elapsed = time.time() - start
+        shutil.rmtree(out_dir, ignore_errors=True)
+        return elapsed
+    
+    def prepare_encoder_passes(self):
+        self.make_video()
+    
+    def bench_encoder_passes(self):
+        out_dir = tempfile.mkdtemp(dir=self.work_dir)
+        start = time.time()
+        e = Encoder(self.make_video(), out_dir=out_dir, vbitrate=5000000,
+                    abitrate=196608, aspect='16:9', duration=self.vid_seconds)
+        e.encode()
+        elapsed = time.time() - start
+        shutil.rmtree(out_dir, ignore_errors=True)
+        return elapsed
+
+
+def compare(results, baseline, threshold=.1):
+    '''Compare the fastest time of each benchmark to a baseline.
+
+    Returns:    list of (name, baseline time, new time, ratio) for the
+                benchmarks that are more than threshold slower.
+    '''
+    regressions = []
+    print('\n{:<16} {:>10} {:>10} {:>8}'.format('benchmark', 'baseline',
+                                                'new', 'change'))
+    for name, r in sorted(results['results'].items()):
+        b = baseline.get('results', {}).get(name, {})
+        if 'min' not in r or 'min' not in b:
+            continue
+        ratio = r['min'] / b['min'] if b['min'] else 1
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions.append((name, b['min'], r['min'], ratio))
+        print('{:<16} {:>9.3f}s {:>9.3f}s {:>+7.1%}{}'.format(
+                  name, b['min'], r['min'], ratio - 1, flag))
+    return regressions
+
+def get_options():
+    parser = ArgumentParser(description='''Benchmark izdvd on synthetic
+                                           media.''')
+    parser.add_argument('-o', '--out-file', metavar='PATH',
+                        help='''Write the results to PATH (json).''')
+    parser.add_argument('-b', '--baseline', metavar='PATH',
+                        help='''Compare the results to an earlier results
+                                file.''')
+    parser.add_argument('--threshold', metavar='RATIO', type=float,
+                        default=.1,
+                        help='''Report a regression when a benchmark is
+                                more than RATIO slower than the baseline.
+                                Default: %(default)s''')
+    parser.add_argument('-r', '--repeat', metavar='N', type=int, default=3,
+                        help='''Run each benchmark N times.
+                                Default: %(default)s''')
+    parser.add_argument('--only', metavar='NAME', nargs='+',
+                        choices=sorted(Bench.REQUIRES),
+                        help='''Only run these benchmarks.''')
+    parser.add_argument('-w', '--work-dir', metavar='PATH',
+                        help='''Directory for the generated media (kept
+                                afterwards).  By default a temporary
+                                directory is used and removed.''')
+    return parser.parse_args()
+
+def main():
+    options = get_options()
+    bench = Bench(work_dir=options.work_dir, repeat=options.repeat,
+                  only=options.only)
+    results = bench.run()
+    if options.out_file:
+        with open(options.out_file, 'w') as f:
+            json.dump(results, f, indent=2)
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, options.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,11 +6,15 @@
 #  The full license is in the file LICENSE, distributed with this software.
 #
 
-from izdvd.image import Img, CanvasImg, TextImg
+from izdvd.image import Img, CanvasImg, TextImg, TMP_FMT, drop_shadows
 from izdvd import utils
 from izdvd import user_input
 from izdvd import config
-import subprocess
+from izdvd import trace
+from izdvd import workspace
+from izdvd import imgstore
+from izdvd import thumbcache
+from izdvd import runner
 import sys
 from lxml import etree
 import math
@@ -54,6 +58,9 @@ class BG (object):
                  # labels
                  label_line_height=0, 
                  label_lines=2,
+                 nav_labels=None,
+                 menu_preview=False,
+                 with_overlay=False,
                  mode='bg',
                  no_logging=False,
                  ):
@@ -92,6 +99,10 @@ class BG (object):
         # labels
         self.label_line_height = label_line_height
         self.label_lines = label_lines
+        self.nav_labels = nav_labels
+        self.nav_imgs = []
+        self.menu_preview = menu_preview
+        self.with_overlay = with_overlay
         self.mode = mode
         self.no_logging = no_logging
         #---------
@@ -101,11 +112,19 @@ class BG (object):
         self.prompt_input_output()
         self.get_imgs()
         self.get_dims()
+        if self.menu_preview:
+            if self.button_imgs is not None:
+                self.calc_cell_ar()
+                self.get_grid_size()
+                self.make_nav_buttons()
+            self.make_preview()
+            return
         self.make_bg()
         self.resize_bg()
         if self.button_imgs is not None:
             self.calc_cell_ar()
             self.get_grid_size()
+            self.make_nav_buttons()
             self.resize_buttons()
             self.prepare_buttons()
             self.create_labels()
@@ -120,7 +139,10 @@ class BG (object):
     def get_out_paths(self):
         paths = utils.get_out_paths(config.PROG_NAME, self.out_name, 
                                     self.out_dir, self.tmp_dir, 50*1024*1024)
-        self.out_name, self.out_dir, self.tmp_dir = paths
+        self.out_name, self.out_dir, tmp_root = paths
+        self.workspace = workspace.Workspace(tmp_root, self.out_name, 
+                                             budget=50*1024*1024)
+        self.tmp_dir = self.workspace.path
         
         self.path_bg_img = os.path.join(self.out_dir, 
                                         '{}_background.png'.format(self.out_name))
@@ -136,14 +158,16 @@ class BG (object):
                                           '{}_menu.xml'.format(self.out_name))
         self.path_menu_lb_xml = os.path.join(self.out_dir, 
                                 '{}_menu_letterbox.xml'.format(self.out_name))
+        self.path_overlay_img = os.path.join(self.out_dir, 
+                                       '{}_overlay.png'.format(self.out_name))
+        self.path_preview_img = os.path.join(self.out_dir, 
+                                        '{}_preview.png'.format(self.out_name))
         if not self.out_log:
             self.out_log = os.path.join(self.out_dir, 
                                         '{}.log'.format(self.out_name))
         if self.no_logging:
             self.out_log = os.devnull
-        self.logger = logging.getLogger('{}.bg'.format(config.PROG_NAME))
-        self.logger.addHandler(logging.FileHandler(self.out_log))
-        self.logger.setLevel(logging.INFO)
+        self.logger = utils.get_logger('bg', self.out_log)
     
     def log_input_info(self):
         if not self.no_logging:
@@ -171,11 +195,12 @@ class BG (object):
                     break
                 img = user_input.prompt_user_list(self.menu_imgs, 
                                                   header='Display an image')
-                o = subprocess.check_call([config.IMAGE_VIEWER, 
-                                           self.menu_imgs[img]],
-                                          stderr=subprocess.STDOUT,
-                                          stdout=subprocess.DEVNULL)
+                o = runner.check_call([config.IMAGE_VIEWER, 
+                                       self.menu_imgs[img]],
+                                      stderr=runner.STDOUT,
+                                      stdout=runner.DEVNULL)
     
+    @trace.traced()
     def get_imgs(self):
         if self.menu_imgs:
             self.button_imgs = [Img(i) for i in self.menu_imgs]
@@ -186,6 +211,7 @@ class BG (object):
         else:
             self.bg_img = None
     
+    @trace.traced()
     def get_dims(self):
         if self.menu_ar and self.dvd_format:
             dims = utils.get_dvd_dims(self.menu_ar, self.dvd_format)
@@ -208,6 +234,7 @@ class BG (object):
                 self.storage_width = self.display_width * multiplier
                 self.storage_height = self.display_height
     
+    @trace.traced()
     def make_bg(self):
         if self.bg_img is None:
             if not self.no_logging:
@@ -226,7 +253,13 @@ class BG (object):
                                     height=self.display_height,
                                     color='gray')
     
+    @trace.traced()
+    @imgstore.collects
     def resize_bg(self):
+        '''Resize the background image to the display size.  A resized 
+        background image file is kept in (and reused from) thumbcache, so 
+        the pages of a paged menu resize it only once.
+        '''
         if self.bg_img.get_width() != self.display_width:
             new_width = self.display_width
         else:
@@ -240,8 +273,23 @@ class BG (object):
                 utils.log_items(heading='Resizing menu background...', 
                                 items=False, lines_before=1, sep='', sep_post='-',
                                 logger=self.logger)
+            if isinstance(self.bg_img, CanvasImg):
+                self.bg_img.resize(width=new_width, height=new_height,
+                                   ignore_aspect=True)
+                return
+            w = new_width or self.bg_img.get_width()
+            h = new_height or self.bg_img.get_height()
+            key = thumbcache.get_key(self.bg_img.path, w, h, True)
+            cached = thumbcache.get(key, TMP_FMT)
+            if cached is not None:
+                try:
+                    self.bg_img.load_version(cached, '{}x{}'.format(w, h))
+                    return
+                except OSError:
+                    pass
             self.bg_img.resize(width=new_width, height=new_height,
                                ignore_aspect=True)
+            thumbcache.put(key, self.bg_img.path)
     
     def calc_cell_ar(self):
         '''Gets the most common aspect ratio of all button images.
@@ -257,6 +305,7 @@ class BG (object):
         base_ar = ars.most_common()[0][0]
         self.cell_ar = base_ar
     
+    @trace.traced()
     def get_grid_size(self):
         '''Determines the optimal layout of rows and columns (i.e., the grid
         size which maximizes the size of the buttons).
@@ -299,7 +348,7 @@ class BG (object):
         bg_h = self.display_height - self.outer_padding*2
         bg_ar = bg_w / bg_h
         grid_ratio = bg_ar / self.cell_ar
-        buttons = len(self.button_imgs)
+        buttons = len(self.button_imgs) + len(self.nav_labels or [])
         initial_rows = math.floor(math.sqrt(buttons / grid_ratio))
         initial_cols = math.floor(math.sqrt(buttons * grid_ratio))
         max_area = 0
@@ -408,10 +457,13 @@ class BG (object):
                           'west': west}
         return shadow_padding
     
+    @trace.traced()
+    @imgstore.collects
     def resize_buttons(self):
         '''Resize each button image to fit into the aspect ratio stored in
         self.cell_ar and corrects for any difference between storage and 
-        display aspect ratios.
+        display aspect ratios.  Resized images are kept in (and reused 
+        from) thumbcache.
         
         Returns:    None
                         (modifies self.button_imgs)
@@ -420,18 +472,67 @@ class BG (object):
             utils.log_items(heading='Resizing menu button images...', 
                             items=False, lines_before=1, sep='', sep_post='-',
                             logger=self.logger)
+        self.button_sizes = []
         for i in self.button_imgs:
-            if i.ar > self.cell_ar:
-                w = self.cell_w
-                h = math.floor(self.cell_w / i.ar)
-            elif i.ar < self.cell_ar:
-                w = math.floor(self.cell_h * i.ar)
-                h = self.cell_h
-            else:
-                w = self.cell_w
-                h = self.cell_h
+            if i in self.nav_imgs:
+                # already the size of a cell
+                self.button_sizes.append(tuple(i.get_dims()))
+                continue
+            w, h = self.get_button_size(i)
+            self.button_sizes.append((w, h))
+            key = thumbcache.get_key(i.path, w, h, True)
+            cached = thumbcache.get(key, TMP_FMT)
+            if cached is not None:
+                try:
+                    i.load_version(cached, '{}x{}'.format(w, h))
+                    continue
+                except OSError:
+                    # evicted by another run in the meantime
+                    pass
             i.resize(w, h, True)
+            thumbcache.put(key, i.path)
+    
+    @trace.traced()
+    def make_nav_buttons(self):
+        '''Make a button image the size of a cell for each of 
+        self.nav_labels (e.g. the previous/next page buttons of a paged 
+        menu) and add them after the other buttons.
+        '''
+        if not self.nav_labels:
+            return
+        for n,label in enumerate(self.nav_labels):
+            # about .6 em per character, to fit the width of the cell
+            pts = max(1, math.floor(min(self.cell_h / 5, 
+                                        self.cell_w / (len(label)*.6 + 1))))
+            path = os.path.join(self.tmp_dir, 'nav_{:02}.png'.format(n))
+            cmd = ['convert', '-size', '{}x{}'.format(self.cell_w, 
+                                                      self.cell_h), 
+                   'xc:gray20', '-fill', 'white', '-gravity', 'center', 
+                   '-pointsize', str(pts), '-annotate', '+0+0', label, path]
+            runner.check_call(cmd, pool='imagemagick')
+            img = Img(path)
+            self.nav_imgs.append(img)
+            self.button_imgs.append(img)
+            if self.menu_labels:
+                self.menu_labels = self.menu_labels + [label]
+    
+    def get_button_size(self, img):
+        '''Returns the size (width, height) that img is resized to by 
+        resize_buttons, to fit in a cell with the aspect ratio self.cell_ar.
+        '''
+        if img.ar > self.cell_ar:
+            w = self.cell_w
+            h = math.floor(self.cell_w / img.ar)
+        elif img.ar < self.cell_ar:
+            w = math.floor(self.cell_h * img.ar)
+            h = self.cell_h
+        else:
+            w = self.cell_w
+            h = self.cell_h
+        return w, h
     
+    @trace.traced()
+    @imgstore.collects
     def prepare_buttons(self):
         '''Add border and shadow to each button and create new outline images
         for the hightlight/select subtitles used for moving the cursor around
@@ -454,6 +555,8 @@ class BG (object):
             i.select = sl
             i.border(self.button_border_thickness, self.button_border_color)
     
+    @trace.traced()
+    @imgstore.collects
     def create_labels(self):
         '''Create images for each label to be placed alongside the button 
         images.
@@ -466,11 +569,14 @@ class BG (object):
                             logger=self.logger)
         button_w = max([i.get_width() for i in self.button_imgs])
         labels = []
-        for i in self.menu_labels:
+        for n,i in enumerate(self.menu_labels):
             img = TextImg(i, line_height=self.label_line_height, 
                                   max_width=button_w, 
                                   max_lines=self.label_lines,
                                   strokewidth=4)
+            if n == 0:
+                # measure the first lines of the other labels in one go
+                img.prefetch_labels(self.menu_labels[1:])
             labels.append(img)
         self.label_height = max([i.get_height() for i in labels])
         for i in labels:
@@ -478,6 +584,8 @@ class BG (object):
                 i.pad_to(new_h=self.label_height, gravity='center')
         self.label_imgs = labels
     
+    @trace.traced()
+    @imgstore.collects
     def append_labels(self):
         '''Appends label images to button images to create a new image 
         containing both.
@@ -486,27 +594,36 @@ class BG (object):
             for n,img in enumerate(self.button_imgs):
                 img.append([self.label_imgs[n]], padding=self.label_padding)
     
+    @trace.traced()
+    @imgstore.collects
     def apply_shadows(self):
-        for i in self.button_imgs:
-            i.drop_shadow(sigma=self.shadow_sigma, 
-                          x_offset=self.shadow_x_offset,
-                          y_offset=self.shadow_y_offset)
+        # buttons of the same shape share one shadow
+        drop_shadows(self.button_imgs, sigma=self.shadow_sigma, 
+                     x_offset=self.shadow_x_offset,
+                     y_offset=self.shadow_y_offset)
     
-    def get_cell_locations(self):
+    @trace.traced()
+    def get_cell_locations(self, sizes=None):
         '''Get the coordinates at which to place each button
         
+        Args:
+            sizes (list):   (width, height) of each button (default: the 
+                            current size of each of self.button_imgs)
+        
         Returns:    cell locations (dict)
                         x0: left edge
                         y0: top edge
                         x1: right edge
                         y1: bottom edge
         '''
+        if sizes is None:
+            sizes = [i.get_dims() for i in self.button_imgs]
         bg_w = self.display_width
         bg_h = self.display_height
-        total_cells = list(range(len(self.button_imgs)))
+        total_cells = list(range(len(sizes)))
         cells = []
-        cell_w = max([i.get_width() for i in self.button_imgs])
-        cell_h = max([i.get_height() for i in self.button_imgs])
+        cell_w = max([i[0] for i in sizes])
+        cell_h = max([i[1] for i in sizes])
         padding_y = math.floor((bg_h - cell_h*self.rows) / (self.rows + 1))
         padded_y = cell_h + padding_y
         for r in range(self.rows):
@@ -525,13 +642,100 @@ class BG (object):
         self.cell_w = cell_w
         self.cell_h = cell_h
     
+    @trace.traced()
+    def make_preview(self, scale=.5):
+        '''Render a low resolution preview of the menu layout (background, 
+        buttons, labels and the highlight on the first button) to 
+        self.path_preview_img with a single convert command, without making
+        any of the menu images.
+        
+        The layout comes from get_grid_size and get_cell_locations, using 
+        the sizes the buttons will have once they are resized and have 
+        their borders, labels and shadows.  Shadows themselves are not 
+        drawn, and labels are not fitted the way TextImg fits them.
+        '''
+        w = self.display_width
+        h = self.display_height
+        if self.bg_img is not None:
+            cmd = (['convert', '-respect-parentheses'] + 
+                   self.bg_img.get_load_opts(w, h) + 
+                   [self.bg_img.path, '-resize', '{}x{}!'.format(w, h)])
+        else:
+            cmd = ['convert', '-respect-parentheses', 
+                   '-size', '{}x{}'.format(w, h), 
+                   'xc:{}'.format(self.menu_bg or 'gray')]
+        if self.button_imgs is not None:
+            border = self.button_border_thickness
+            shadow = self.calculate_shadow_padding()
+            label_h = 0
+            if self.menu_labels:
+                label_h = (self.label_line_height * self.label_lines 
+                           + self.label_padding)
+            resized = [self.get_button_size(i) for i in self.button_imgs]
+            sizes = [(bw + border*2 + shadow['x'], 
+                      bh + border*2 + label_h + shadow['y']) 
+                     for bw,bh in resized]
+            self.get_cell_locations(sizes)
+            for n,cell in enumerate(self.cell_locations):
+                img = self.button_imgs[n]
+                bw, bh = resized[n]
+                x = (cell['x0'] + math.floor((self.cell_w - sizes[n][0]) / 2)
+                     + shadow['west'])
+                y = (cell['y0'] + math.floor((self.cell_h - sizes[n][1]) / 2)
+                     + shadow['north'])
+                cmd += (['('] + img.get_load_opts(bw, bh) + 
+                        [img.path, '-resize', '{}x{}!'.format(bw, bh), 
+                         '-bordercolor', self.button_border_color, 
+                         '-border', str(border), ')', 
+                         '-geometry', '{:+}{:+}'.format(x, y), '-composite'])
+                if self.menu_labels and self.menu_labels[n]:
+                    size = '{}x{}'.format(bw + border*2, 
+                                          label_h - self.label_padding)
+                    pts = max(1, round(self.label_line_height * .75))
+                    label_y = y + bh + border*2 + self.label_padding
+                    cmd += ['(', '-size', size, '-background', 'none', 
+                            '-fill', 'white', '-stroke', 'black', 
+                            '-strokewidth', '1', '-gravity', 'north', 
+                            '-pointsize', str(pts), 
+                            'caption:{}'.format(self.menu_labels[n]), ')', 
+                            '-geometry', '{:+}{:+}'.format(x, label_y), 
+                            '-composite']
+                if n == 0:
+                    # the highlight is centered on the edge of the image
+                    t = self.button_highlight_thickness
+                    d = (t - 2) / 2
+                    rect = 'rectangle {},{} {},{}'.format(
+                               x + border - d, y + border - d, 
+                               x + border + bw - 1 + d, 
+                               y + border + bh - 1 + d)
+                    cmd += ['-fill', 'none', 
+                            '-stroke', self.button_highlight_color, 
+                            '-strokewidth', str(t), '-draw', rect]
+        cmd += ['-resize', '{}%'.format(round(scale*100)), 
+                self.path_preview_img]
+        runner.check_call(cmd, pool='imagemagick')
+        if not self.no_logging:
+            utils.log_items([('Preview', self.path_preview_img)], 
+                            'Menu Preview', logger=self.logger)
+        return self.path_preview_img
+    
+    @trace.traced()
+    @imgstore.collects
     def overlay_buttons(self):
-        '''Overlays the buttons onto the background image.
+        '''Overlays the buttons onto the background image (and with 
+        with_overlay, onto a transparent overlay image as well, for showing 
+        over a background video; see motion.MotionMenu).
+        
+        The area of each button's image (without border, label or shadow)
+        is kept in self.button_rects.
         '''
         if self.button_imgs is None:
             return
         self.highlight_img = self.bg_img.new_canvas()
         self.select_img = self.bg_img.new_canvas()
+        if self.with_overlay:
+            self.overlay_img = self.bg_img.new_canvas()
+        self.button_rects = []
         for n,cell in enumerate(self.cell_locations):
             b = self.button_imgs[n]
             x_padding = math.floor((self.cell_w - b.get_width()) / 2)
@@ -539,6 +743,12 @@ class BG (object):
             x = cell['x0'] + x_padding
             y = cell['y0'] + y_padding
             self.bg_img.new_layer(b, x, y, layers_method='flatten')
+            if self.with_overlay:
+                self.overlay_img.new_layer(b, x, y, layers_method='flatten')
+            w, h = self.button_sizes[n]
+            self.button_rects.append({'x': int(x + b.x_offset), 
+                                      'y': int(y + b.y_offset), 
+                                      'w': w, 'h': h})
             self.highlight_img.new_layer(b.highlight, 
                                          x + b.x_offset, 
                                          y + b.y_offset, 
@@ -548,6 +758,8 @@ class BG (object):
                                       y + b.y_offset,
                                       True, layers_method='flatten')
     
+    @trace.traced()
+    @imgstore.collects
     def resize_imgs(self):
         '''
         backgrounds:
@@ -558,12 +770,19 @@ class BG (object):
         letterboxed buttons:
         NTSC WS: 854x480  -> 720x360 --pad--> 720x480
         PAL WS : 1024x576 -> 720x432 --pad--> 720x576
+        
+        These are the last operations on each image, so they write png 
+        (earlier versions are in the faster image.TMP_FMT).
         '''
         self.bg_img.resize(width=self.storage_width, 
                            height=self.storage_height, 
-                           ignore_aspect=True)
+                           ignore_aspect=True, out_fmt='png')
         if self.button_imgs is None:
             return
+        if self.with_overlay:
+            self.overlay_img.resize(width=self.storage_width, 
+                                    height=self.storage_height, 
+                                    ignore_aspect=True, out_fmt='png')
         if self.menu_ar == 16/9:
             if self.dvd_format.lower() == 'ntsc':
                 lb_h = 360
@@ -572,17 +791,14 @@ class BG (object):
             self.highlight_lb_img = Img(self.highlight_img.path)
             self.select_lb_img = Img(self.select_img.path)
             for img in [self.highlight_lb_img, self.select_lb_img]:
-                img.resize(width=720, height=lb_h, ignore_aspect=True,
-                           remap=True, no_antialias=True, no_dither=True)
-                img.pad_to(new_h=self.storage_height)
+                img.resize_indexed(width=720, height=lb_h, 
+                                   canvas_height=self.storage_height)
         for img in [self.highlight_img, self.select_img]:
-            img.resize(width=self.storage_width, 
-                       height=self.storage_height,
-                       ignore_aspect=True, 
-                       remap=True, 
-                       no_antialias=True, 
-                       no_dither=True)
+            img.resize_indexed(width=self.storage_width, 
+                               height=self.storage_height)
     
+    @trace.traced()
+    @imgstore.collects
     def write(self, out_file_bg=None, out_file_hl=None, out_file_sl=None,
                  out_file_hl_lb=None, out_file_sl_lb=None):
         # TODO: write letterboxed highlight/select images when menu_ar is 16:9
@@ -599,12 +815,15 @@ class BG (object):
         self.bg_img.write(out_file=out_file_bg)
         if self.button_imgs is None:
             return
+        if self.with_overlay:
+            self.overlay_img.write(out_file=self.path_overlay_img)
         self.highlight_img.write(out_file=out_file_hl)
         self.select_img.write(out_file=out_file_sl)
         if self.menu_ar == 16/9:
             self.highlight_lb_img.write(out_file=out_file_hl_lb)
             self.select_lb_img.write(out_file=out_file_sl_lb)
     
+    @trace.traced()
     def get_xml(self):
         self.create_menu_xml(self.path_hl_img, 
                              self.path_sl_img, 
@@ -18,3 +18,10 @@ RE_VOL_LETTERS = r'[a-d]'
 MODE_NAMES = {'dvd':  'izdvd',
               'menu': 'izdvdmenu',
               'bg':   'izdvdbg'}
+
+DVD_SIZES_NTSC = [(720, 480), (704, 480), (352, 480), (352, 240)]
+DVD_SIZES_PAL = [(720, 576), (704, 576), (352, 576), (352, 288)]
+DVD_AUDIO_FORMATS = ['AC-3', 'MPEG Audio', 'PCM']
+
+# source codecs that are slow to decode compared to an mpeg2 encode
+EXPENSIVE_CODECS = ['HEVC', 'AV1', 'VP9']
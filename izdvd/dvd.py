@@ -8,11 +8,15 @@
 
 from izdvd.dvdmenu import DVDMenu
 from izdvd.encoder import Encoder
+from izdvd import encoder
 from izdvd import utils
 from izdvd import user_input
 from izdvd import config
+from izdvd import trace
+from izdvd import metrics
+from izdvd import workspace
+from izdvd import runner
 import sys
-import subprocess
 import math
 from datetime import timedelta
 import os
@@ -21,6 +25,14 @@ import glob
 import re
 import logging
 import difflib
+import errno
+import time
+import contextlib
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+# the lowest video bitrate (bps) titles are re-encoded at to fit the DVD
+VBITRATE_FLOOR = 1500000
 
 
 class DVD (object):
@@ -32,6 +44,7 @@ class DVD (object):
                  menu_imgs=None, 
                  menu_labels=None, 
                  menu_bg=None, 
+                 menu_bg_vid=None, 
                  # input options
                  vid_fmts=['mp4', 'avi', 'mkv'],
                  img_fmts=['png', 'jpg', 'bmp', 'gif'],
@@ -43,6 +56,7 @@ class DVD (object):
                  strip_label_year=True,
                  no_encode_v=False, 
                  no_encode_a=False, 
+                 auto_passthrough=True,
                  unstack_vids=None,
                  # output locations
                  out_name=None, 
@@ -53,8 +67,14 @@ class DVD (object):
                  with_menu=True, 
                  menu_only=False,
                  with_author_dvd=True,
+                 low_disk=False,
+                 estimate=False,
+                 probe_only=False,
                  #~ dvd_size_bits=37602983936,
                  dvd_size_bytes=4700372992,
+                 tmp_budget=None,
+                 size_margin=.02,
+                 mux_overhead=1.01,
                  # dvd options
                  audio_lang='en',
                  with_subs=False, 
@@ -64,6 +84,9 @@ class DVD (object):
                  vbitrate=None, 
                  abitrate=196608, 
                  two_pass=True,
+                 intermediate='auto',
+                 ivtc='auto',
+                 crop='auto',
                  separate_titles=True, 
                  separate_titlesets=False, 
                  ar_threshold=1.38,
@@ -90,8 +113,16 @@ class DVD (object):
                  # ------menu opts------
                  menu_audio=None,
                  no_loop_menu=False,
+                 motion_menu=False,
+                 menu_page_size=12,
                  frames=360,
-                 mode='dvd'):
+                 menu_preview=False,
+                 mode='dvd',
+                 # ------progress------
+                 progress_callback=None,
+                 progress_interval=60,
+                 # ------batch------
+                 cpu_slots=None):
         self.uid = str(id(self))
         # input
         self.in_vids = in_vids
@@ -100,6 +131,7 @@ class DVD (object):
         self.menu_imgs = menu_imgs
         self.menu_labels = menu_labels
         self.menu_bg = menu_bg
+        self.menu_bg_vid = menu_bg_vid
         # input options
         self.vid_fmts = vid_fmts
         self.img_fmts = img_fmts
@@ -111,6 +143,7 @@ class DVD (object):
         self.strip_label_year = strip_label_year
         self.no_encode_v = no_encode_v
         self.no_encode_a = no_encode_a
+        self.auto_passthrough = auto_passthrough
         self.unstack_vids = unstack_vids
         # output locations
         self.out_name = out_name
@@ -121,8 +154,14 @@ class DVD (object):
         self.with_menu = with_menu
         self.menu_only = menu_only
         self.with_author_dvd = with_author_dvd
+        self.low_disk = low_disk
+        self.estimate = estimate
+        self.probe_only = probe_only
         self.dvd_size_bytes = dvd_size_bytes
         self.dvd_size_bits  = dvd_size_bytes * 8
+        self.tmp_budget = tmp_budget
+        self.size_margin = size_margin
+        self.mux_overhead = mux_overhead
         # dvd options
         self.audio_lang = audio_lang
         self.with_subs = with_subs
@@ -130,8 +169,12 @@ class DVD (object):
         self.dvd_format = dvd_format
         self.dvd_ar = dvd_ar
         self.vbitrate = vbitrate
+        self.vbitrate_fixed = True
         self.abitrate = abitrate
         self.two_pass = two_pass
+        self.intermediate = intermediate
+        self.ivtc = ivtc
+        self.crop = crop
         self.separate_titles = separate_titles
         self.separate_titlesets = separate_titlesets
         self.ar_threshold = ar_threshold
@@ -158,8 +201,14 @@ class DVD (object):
         self.label_lines = label_lines
         self.menu_audio = menu_audio
         self.no_loop_menu = no_loop_menu
+        self.motion_menu = motion_menu
+        self.menu_page_size = menu_page_size
         self.frames = frames
+        self.menu_preview = menu_preview
         self.mode = mode
+        self.progress_callback = progress_callback
+        self.progress_interval = progress_interval
+        self.cpu_slots = cpu_slots
         #-------------------------------
         if self.menu_ar is None:
             self.menu_ar = self.dvd_ar
@@ -167,33 +216,100 @@ class DVD (object):
         self.get_menu_imgs()
         self.get_menu_labels()
         self.get_subs()
-        self.get_out_paths()
-        # get information about input video
+        if self.probe_only:
+            # only gather information about the input (see DiscSet)
+            self.get_media_info()
+            return
+        # get information about input video (before get_out_paths, which 
+        # sizes the temp dir for the titles)
         self.get_media_info()
+        self.get_out_paths()
         self.calculate_vbitrate()
         self.log_output_info()
         self.log_input_info()
         self.log_titlesets()
         self.log_dvd_info()
         self.prompt_input_output()
+        if self.menu_preview:
+            self.preview_menu()
+            return
+        if self.estimate:
+            with self.cpu_slot():
+                self.estimate_encode()
+            return
         # make menu
         if self.with_menu or self.menu_only:
-            self.get_menu()
+            with self.cpu_slot():
+                self.get_menu()
         if self.menu_only:
             return
         #~ self.log_menu_info()
         self.prompt_menu()
+        if self.low_disk:
+            # stream mpeg2 video into dvdauthor through named pipes
+            self.create_fifos()
+            self.create_dvd_xml()
+            self.author_dvd_streaming()
+            self.report_disc_usage()
+            runner.log_stats(self.logger)
+            self.workspace.cleanup()
+            return
         # prepare mpeg2 files
         self.encode_video()
         self.create_dvd_xml()
         # author DVD
         if self.with_author_dvd:
-            self.author_dvd()
+            with self.cpu_slot():
+                self.author_dvd()
+            self.report_disc_usage()
+        runner.log_stats(self.logger)
+        self.workspace.cleanup()
+    
+    def cpu_slot(self):
+        '''Return a context manager that holds one of the cpu slots shared 
+        by a batch of DVDs (see batch.Batch) while a heavy stage runs.
+        '''
+        if self.cpu_slots is None:
+            return contextlib.nullcontext()
+        return self.cpu_slots
     
+    @trace.traced()
     def get_out_paths(self):
+        if self.low_disk and (self.no_encode_v or not self.with_author_dvd):
+            print('WARNING: --low-disk requires encoding and authoring the',
+                  'DVD; ignoring it.')
+            self.low_disk = False
+        if self.low_disk:
+            # only the menus are written to tmp, titles are streamed (a 
+            # lossless intermediate is many times the size of the dvd)
+            tmp_required = 300*1024*1024
+            if self.intermediate == 'always':
+                print('WARNING: --low-disk cannot use an intermediate file;',
+                      'ignoring --intermediate always.')
+            self.intermediate = 'never'
+        else:
+            tmp_required = self.dvd_size_bytes * 1.2
+        reserve = 0
+        if self.tmp_budget:
+            tmp_required = self.tmp_budget
+        else:
+            # room for the intermediate file of one title at a time
+            reserve = self.get_intermediate_reserve()
+            tmp_required += reserve
         paths = utils.get_out_paths(config.PROG_NAME, self.out_name, self.out_dir,
-                                    self.tmp_dir, self.dvd_size_bytes * 1.2)
-        self.out_name, self.out_dir, self.tmp_dir = paths
+                                    self.tmp_dir, tmp_required)
+        self.out_name, self.out_dir, tmp_root = paths
+        if reserve and workspace.get_space_available(tmp_root) < tmp_required:
+            print('WARNING: Not enough temp space for an intermediate file',
+                  '({:.1f} MiB); titles will be decoded twice.'.format(
+                      reserve/1024/1024))
+            tmp_required -= reserve
+        # a private tmp dir, removed after authoring unless the files in it 
+        # are the output
+        keep = self.menu_only or not self.with_author_dvd
+        self.workspace = workspace.Workspace(tmp_root, self.out_name, 
+                                             budget=tmp_required, keep=keep)
+        self.tmp_dir = self.workspace.path
         
         self.out_dvd_dir = os.path.join(self.out_dir, 'DVD')
         #~ self.out_files_dir = os.path.join(self.out_dir, 'files')
@@ -209,8 +325,9 @@ class DVD (object):
         # check available space
         devices = {}
         dvd_size = self.dvd_size_bytes
+        tmp_size = tmp_required if self.low_disk else dvd_size*1.05
         for d,s in zip([self.out_dvd_dir, self.tmp_dir], 
-                       [dvd_size*1.05, dvd_size*1.05]):
+                       [dvd_size*1.05, tmp_size]):
             dev = os.stat(d).st_dev
             if devices.get(dev):
                 devices[dev] -= s
@@ -219,10 +336,9 @@ class DVD (object):
         if min(devices.values()) < 1024*1024:
             raise
         
-        self.logger = logging.getLogger('{}.dvd'.format(config.PROG_NAME))
-        self.logger.addHandler(logging.FileHandler(self.out_log))
-        self.logger.setLevel(logging.INFO)
+        self.logger = utils.get_logger('dvd', self.out_log)
     
+    @trace.traced()
     def get_in_vids(self):
         if not self.in_vids:
             if self.unstack_vids is None:
@@ -245,6 +361,7 @@ class DVD (object):
             if self.unstack_vids is None:
                 self.unstack_vids = False
     
+    @trace.traced()
     def get_menu_imgs(self):
         if not self.with_menu:
             self.menu_imgs = [None for i in self.in_vids]
@@ -256,6 +373,7 @@ class DVD (object):
                                              self.img_names)
                 self.menu_imgs.append(img)
     
+    @trace.traced()
     def get_menu_labels(self):
         if not self.menu_labels:
             self.menu_labels = []
@@ -283,6 +401,7 @@ class DVD (object):
         else:
             self.menu_labels = [None for i in self.in_vids]
     
+    @trace.traced()
     def get_subs(self):
         if self.with_subs:
             if not self.in_srts:
@@ -344,10 +463,15 @@ class DVD (object):
                 return shortest
         return None
     
+    @trace.traced()
     def get_media_info(self):
         vids = []
         fmt = ('--output=Video;%Duration%|^|%Width%|^|%Height%|^|'
-               '%PixelAspectRatio%|^|%DisplayAspectRatio%')
+               '%PixelAspectRatio%|^|%DisplayAspectRatio%|^|%Format%|^|'
+               '%FrameRate%|^|%BitRate%|^|%BitRate_Maximum%|^|%ScanOrder%|^|'
+               '%BitDepth%')
+        fmt_a = ('--output=Audio;%Format%|^|%Format_Profile%|^|'
+                 '%Format_Settings_Endianness%|^|%SamplingRate%\n')
         for n,i in enumerate(self.in_vids):
             subs = [self.in_srts[n]] if self.in_srts is not None else [None]
             if self.unstack_vids:
@@ -365,10 +489,30 @@ class DVD (object):
                     subs = [self.in_srts[n]]
             v = {}
             duration = 0
+            streams = []
             for path in stacked:
-                mi = subprocess.check_output(['mediainfo', fmt, path], 
-                                               universal_newlines=True).strip()
-                d_ms,w,h,par,dar = mi.split('|^|')
+                mi = utils.get_mediainfo(path, fmt).strip()
+                (d_ms,w,h,par,dar,v_fmt,fps,br,br_max,scan,
+                 bit_depth) = mi.split('|^|')
+                mi_a = utils.get_mediainfo(path, fmt_a).strip()
+                if mi_a:
+                    a_fmt,a_profile,a_endian,a_rate = (
+                        mi_a.splitlines()[0].split('|^|'))
+                else:
+                    a_fmt,a_profile,a_endian,a_rate = ('', '', '', '')
+                streams.append({'format': v_fmt, 
+                                'fps': fps, 
+                                'bitrate': br_max or br,
+                                'scan_order': scan,
+                                'bit_depth': (int(bit_depth) 
+                                              if bit_depth.isdigit() else 8),
+                                'width': int(w),
+                                'height': int(h),
+                                'dar': float(dar),
+                                'a_format': a_fmt, 
+                                'a_profile': a_profile,
+                                'a_endianness': a_endian,
+                                'a_rate': a_rate})
                 d_s = int(d_ms) / 1000
                 duration += d_s
                 width = int(w)
@@ -386,6 +530,7 @@ class DVD (object):
                 else:
                     v.update(nv)
             v['in'] = stacked
+            v['streams'] = streams
             v['mpeg'] = ''
             #~ v['srt'] = self.in_srts[n]
             v['srt'] = subs
@@ -396,9 +541,70 @@ class DVD (object):
             vids.append(v)
         self.vids = vids
         self.titlesets = self.split_titlesets()
+        self.get_passthrough()
         self.durations = [i['duration'] for i in vids]
         self.duration_total = sum(self.durations)
     
+    def get_passthrough(self):
+        '''Decide for each title whether its video and/or audio streams can 
+        be remuxed as-is instead of being re-encoded.
+        '''
+        for ts in self.titlesets:
+            for v in ts['vids']:
+                if self.no_encode_v:
+                    v['copy_v'] = True
+                elif self.auto_passthrough:
+                    v['copy_v'] = all(self.is_dvd_video(i, ts['ar']) 
+                                      for i in v['streams'])
+                else:
+                    v['copy_v'] = False
+                if self.no_encode_a:
+                    v['copy_a'] = True
+                elif self.auto_passthrough:
+                    v['copy_a'] = all(self.is_dvd_audio(i) 
+                                      for i in v['streams'])
+                else:
+                    v['copy_a'] = False
+    
+    def is_dvd_video(self, stream, ar):
+        '''Returns True if a video stream (as probed by get_media_info) is 
+        mpeg2 that is already compliant with the DVD format and aspect ratio
+        of the titleset it will be placed in.
+        '''
+        if stream['format'] != 'MPEG Video':
+            return False
+        if self.dvd_format.lower() == 'pal':
+            sizes = config.DVD_SIZES_PAL
+            rates = ['25.000']
+        else:
+            sizes = config.DVD_SIZES_NTSC
+            rates = ['29.970']
+            if 'pulldown' in stream['scan_order'].lower():
+                rates.append('23.976')
+        if (stream['width'], stream['height']) not in sizes:
+            return False
+        if stream['fps'] not in rates:
+            return False
+        ar_w, ar_h = ar.split(':')
+        if abs(stream['dar'] - int(ar_w) / int(ar_h)) > .01:
+            return False
+        if not stream['bitrate'] or int(stream['bitrate']) > 9800000:
+            return False
+        return True
+    
+    def is_dvd_audio(self, stream):
+        '''Returns True if an audio stream (as probed by get_media_info) is 
+        in a DVD compliant format and sampling rate.
+        '''
+        if stream['a_format'] not in config.DVD_AUDIO_FORMATS:
+            return False
+        if (stream['a_format'] == 'MPEG Audio' 
+            and stream['a_profile'] != 'Layer 2'):
+            return False
+        if stream['a_format'] == 'PCM' and stream['a_endianness'] != 'Big':
+            return False
+        return stream['a_rate'] == '48000'
+    
     def get_stacked_vids(self, vid_path):
         vid_dir, vid_name = os.path.split(vid_path)
         paths = [i for i in os.listdir(vid_dir) if i != vid_name]
@@ -443,7 +649,7 @@ class DVD (object):
                          self.tmp_dir]))
         utils.log_items(logs, 'Output Paths', col_width=16, 
                         logger=self.logger)
-
+    
     def log_input_info(self):
         utils.log_items(heading='Video Information', items=[], lines_before=1,
                         logger=self.logger)
@@ -480,10 +686,13 @@ class DVD (object):
                 in_srt = i['srt']
             #~ name = os.path.basename(i['in'])
             duration = self.get_duration_string(i['duration'])
+            passthrough = [k for k,c in [('video', i['copy_v']), 
+                                         ('audio', i['copy_a'])] if c]
             keys = ['In file(s)', 'Image', 'Label', 'Subtitle', 
-                             'Aspect Ratio', 'Duration']
+                             'Aspect Ratio', 'Duration', 'Passthrough']
             vals = [in_vids, in_img, i['menu_label'], in_srt, 
-                             '{:.2f}'.format(i['ar']), duration]
+                             '{:.2f}'.format(i['ar']), duration, 
+                             ', '.join(passthrough) or 'no']
             if not self.with_menu_labels:
                 vals.pop(keys.index('Label'))
                 keys.pop(keys.index('Label'))
@@ -535,12 +744,20 @@ class DVD (object):
                    'Play a video',
                    'Display a menu image',
                    'List contents of a directory']
+        if self.with_menu or self.menu_only:
+            choices.append('Preview the menu layout')
         while True:
             resp = user_input.prompt_user_list(choices)
             if resp is False:
                 sys.exit()
             elif resp == 0:
                 break
+            elif resp == 4:
+                o = runner.check_call([config.IMAGE_VIEWER, 
+                                       self.preview_menu()],
+                                      stderr=runner.STDOUT,
+                                      stdout=runner.DEVNULL)
+                continue
             vids = [i['vid_label'] for i in self.vids]
             chosen = user_input.prompt_user_list(vids, header=choices[resp])
             # TODO: offer choice of files when video is stacked
@@ -548,18 +765,18 @@ class DVD (object):
             vid_path = chosen_vid['in'][0]
             img_path = chosen_vid['img']
             if resp == 1:
-                o = subprocess.check_call([config.VIDEO_PLAYER, vid_path],
-                                          stderr=subprocess.STDOUT,
-                                          stdout=subprocess.DEVNULL)
+                o = runner.check_call([config.VIDEO_PLAYER, vid_path],
+                                      stderr=runner.STDOUT,
+                                      stdout=runner.DEVNULL)
             elif resp == 2:
-                o = subprocess.check_call([config.IMAGE_VIEWER, 
-                                           img_path],
-                                          stderr=subprocess.STDOUT,
-                                          stdout=subprocess.DEVNULL)
+                o = runner.check_call([config.IMAGE_VIEWER, 
+                                       img_path],
+                                      stderr=runner.STDOUT,
+                                      stdout=runner.DEVNULL)
             elif resp == 3:
-                o = subprocess.check_output(['ls', '-lhaF', '--color=auto', 
-                                             os.path.dirname(vid_path)],
-                                            universal_newlines=True)
+                o = runner.check_output(['ls', '-lhaF', '--color=auto', 
+                                         os.path.dirname(vid_path)],
+                                        universal_newlines=True)
                 print('\n{}\n\n{}'.format(vid_path, o.strip()))
     
     def prompt_menu(self):
@@ -575,13 +792,13 @@ class DVD (object):
             elif resp == 0:
                 break
             if resp == 1:
-                o = subprocess.check_call([config.IMAGE_VIEWER, 
-                                           self.menu.bg.path_bg_img])
+                o = runner.check_call([config.IMAGE_VIEWER, 
+                                       self.menu.bg.path_bg_img])
             elif resp == 2:
-                o = subprocess.check_call([config.VIDEO_PLAYER, 
-                                           self.menu.path_menu_mpg],
-                                          stderr=subprocess.STDOUT,
-                                          stdout=subprocess.DEVNULL)
+                o = runner.check_call([config.VIDEO_PLAYER, 
+                                       self.menu.path_menu_mpg],
+                                      stderr=runner.STDOUT,
+                                      stdout=runner.DEVNULL)
     
     def get_duration_string(self, seconds):
         h,m,s = str(timedelta(seconds=seconds)).split(':')
@@ -615,14 +832,25 @@ class DVD (object):
                 self.menu_ar = self.dvd_ar
         return titlesets
     
+    @trace.traced()
     def calculate_vbitrate(self):
-        duration = self.duration_total
+        # passthrough titles take up a fixed amount of space, the rest is
+        # shared between the titles that will be encoded
+        copied = [i for i in self.vids if i['copy_v']]
+        copied_bits = sum([os.path.getsize(p) * 8 
+                           for i in copied for p in i['in']])
+        duration = sum([i['duration'] for i in self.vids if not i['copy_v']])
+        if not duration:
+            if not self.vbitrate:
+                self.vbitrate = 9000000 - self.abitrate
+            return
         abitrate = self.get_audio_bitrate()
-        available = self.dvd_size_bits / duration
-        available -= available * .05
+        available = (self.dvd_size_bits - copied_bits) / duration
+        available -= available * self.size_margin
         v_available = available - abitrate
         
         if not self.vbitrate:
+            self.vbitrate_fixed = False
             self.vbitrate = math.floor(v_available)
         else:
             if self.vbitrate > v_available:
@@ -641,10 +869,7 @@ class DVD (object):
     def get_audio_bitrate(self):
         return self.abitrate
         
-    def get_menu(self):
-        utils.log_items(heading='Making DVD Menu...', items=False, 
-                        sep=None, sep_post='-', lines_before=2,
-                        logger=self.logger)
+    def get_menu_args(self):
         if not self.with_menu_labels:
             self.menu_label_line_height = 0
             self.menu_labels = None
@@ -667,21 +892,96 @@ class DVD (object):
                       'label_line_height',
                       'label_lines',
                       'menu_audio',
+                      'menu_bg_vid',
                       'frames',
                       'mode']
         for k in menu_attrs:
             v = getattr(self, k)
             if v is not None:
                 menu_args[k] = v
-        self.menu = DVDMenu(self.menu_imgs, 
-                            menu_bg=self.menu_bg,
-                            menu_labels=self.menu_labels, 
-                            out_dir=self.tmp_dir,
-                            #~ tmp_dir=self.tmp_dir,
-                            dvd_format=self.dvd_format,
-                            out_log=self.out_log,
-                            **menu_args)
-
+        return menu_args
+    
+    def get_menu_pages(self):
+        '''Split the titles into menu pages of no more than menu_page_size 
+        buttons each (not counting the previous/next page buttons), as 
+        evenly as possible.
+        
+        Returns:    a list with the indices in self.vids of the titles on 
+                    each page
+        '''
+        titles = list(range(len(self.vids)))
+        size = self.menu_page_size or len(titles) or 1
+        pages = math.ceil(len(titles) / size) or 1
+        per_page = math.ceil(len(titles) / pages)
+        return ([titles[i:i+per_page] for i in range(0, len(titles), per_page)]
+                or [titles])
+    
+    def get_page_args(self, n, pages):
+        '''Returns the DVDMenu arguments for page n of pages.'''
+        page = pages[n]
+        menu_args = self.get_menu_args()
+        menu_args['menu_imgs'] = [self.menu_imgs[i] for i in page]
+        if self.menu_labels:
+            menu_args['menu_labels'] = [self.menu_labels[i] for i in page]
+        if len(pages) > 1:
+            menu_args['out_name'] = '{}_page{:02}'.format(self.out_name, n+1)
+            nav_labels = []
+            if n > 0:
+                nav_labels.append('Previous')
+            if n < len(pages) - 1:
+                nav_labels.append('Next')
+            menu_args['nav_labels'] = nav_labels
+        if self.motion_menu:
+            # play each title in its button, from 10% of the way in (of 
+            # its first part, when stacked)
+            vids = [self.vids[i] for i in page]
+            menu_args['menu_vids'] = [i['in'][0] for i in vids]
+            menu_args['menu_vid_starts'] = [i['duration'] / len(i['in']) / 10
+                                            for i in vids]
+        return menu_args
+    
+    @trace.traced()
+    def preview_menu(self):
+        '''Render a low resolution preview of the menu layout (of the first
+        page), without making the menu (see BG.make_preview).
+        
+        Returns:    path of the preview image
+        '''
+        page_args = self.get_page_args(0, self.get_menu_pages())
+        menu = DVDMenu(menu_bg=self.menu_bg,
+                       out_dir=self.tmp_dir,
+                       dvd_format=self.dvd_format,
+                       out_log=self.out_log,
+                       menu_preview=True,
+                       **page_args)
+        path = os.path.join(self.out_dir, 
+                            '{}_preview.png'.format(self.out_name))
+        shutil.copy(menu.path_preview_img, path)
+        return path
+    
+    @trace.traced()
+    def get_menu(self):
+        '''Make the menu: one DVDMenu per page (see get_menu_pages), made 
+        in parallel, and the blank menu used by the titlesets.
+        '''
+        utils.log_items(heading='Making DVD Menu...', items=False, 
+                        sep=None, sep_post='-', lines_before=2,
+                        logger=self.logger)
+        self.menu_pages = self.get_menu_pages()
+        page_args = [self.get_page_args(n, self.menu_pages) 
+                     for n in range(len(self.menu_pages))]
+        def make_page(menu_args):
+            return DVDMenu(menu_bg=self.menu_bg,
+                           out_dir=self.tmp_dir,
+                           #~ tmp_dir=self.tmp_dir,
+                           dvd_format=self.dvd_format,
+                           out_log=self.out_log,
+                           **menu_args)
+        # the pages' commands are still limited by the runner pools
+        with ThreadPoolExecutor(max_workers=len(page_args)) as pool:
+            self.menus = list(pool.map(make_page, page_args))
+        self.menu = self.menus[0]
+    
         self.blank_menu = DVDMenu(menu_imgs=None,
                                   out_dir=self.tmp_dir,
                                   out_name='blank',
@@ -692,9 +992,11 @@ class DVD (object):
                                   mode=self.mode,
                                   no_logging=True)
     
-    def encode_video(self):
+    @trace.traced()
+    def encode_video(self, author_proc=None):
         # TODO: self.vids[n]['in'] is now a list of paths 
-        if self.no_encode_v:
+        if (self.no_encode_v and not self.with_subs and author_proc is None 
+            and all([len(i['in']) == 1 for i in self.vids])):
             utils.log_items('Skipping encoding mpeg2 video...', 
                             logger=self.logger)
             for i in self.vids:
@@ -706,21 +1008,312 @@ class DVD (object):
             aspect = '16:9'
         else:
             aspect = '4:3'
+        self.start_progress()
         for ts in self.titlesets:
             aspect = ts['ar']
             for v in ts['vids']:
-                e = Encoder(v['in'], 
-                            out_dir=self.tmp_dir, 
-                            vbitrate=self.vbitrate, 
-                            abitrate=self.abitrate,
-                            two_pass=self.two_pass,
-                            aspect=aspect,
-                            dvd_format=self.dvd_format,
-                            with_subs=self.with_subs, 
-                            in_srt=v['srt'][0])
-                mpeg = e.encode()
-                v['mpeg'] = mpeg
+                self.encode_title(v, aspect, author_proc)
+                self.update_vbitrate()
+        self.log_progress(force=True)
+        if author_proc is None:
+            self.fit_to_dvd()
+        else:
+            overflow = self.get_overflow()
+            if overflow > 0:
+                print('WARNING: DVD is {:.1f} MiB too large; titles cannot be'
+                      ' re-encoded with --low-disk.'.format(overflow/1024/1024))
+    
+    @trace.traced()
+    def encode_title(self, vid, aspect, author_proc=None):
+        self.encoding = vid
+        with self.cpu_slot():
+            e = self.get_encoder(vid, aspect)
+            started = time.time()
+            if author_proc is not None:
+                e.encode_first_pass()
+                with self.open_fifo(vid['mpeg'], author_proc) as f:
+                    e.encode_final_pass(out_fh=f)
+                # nothing on disk to measure, use ffmpeg's count instead
+                vid['size'] = e.progress.get('bytes', 0)
+            else:
+                # a re-encode (see fit_to_dvd) overwrites the old file
+                required = self.get_title_size_estimate(vid) - vid.get('size', 
+                                                                       0)
+                self.check_intermediate_budget(e, required)
+                self.workspace.check_budget(required)
+                vid['mpeg'] = e.encode()
+                vid['size'] = os.path.getsize(vid['mpeg'])
+            wall = time.time() - started
+        self.progress['finished'] += self.get_encode_work(vid)
+        metrics.inc('izdvd_titles_encoded_total')
+        metrics.inc('izdvd_title_bytes_total', vid['size'])
+        if not vid['copy_v'] and wall > 0:
+            # all passes, not ffmpeg's speed at the end of the last one
+            metrics.observe('izdvd_encode_fps', 
+                            vid['duration'] * e.fps / wall)
+    
+    def get_intermediate_reserve(self):
+        '''Returns the size of the largest intermediate file (see 
+        Encoder.setup_intermediate) a title is expected to use.
+        '''
+        if (self.intermediate == 'never' or not self.two_pass 
+            or self.menu_only or self.no_encode_v):
+            return 0
+        sizes = [0]
+        for v in self.vids:
+            if v['copy_v']:
+                continue
+            # Encoder only looks at the first part of a stacked title
+            s = v['streams'][0]
+            if self.intermediate == 'always' or encoder.is_expensive_to_decode(
+                    s['width'], s['height'], s['format'], s['bit_depth']):
+                sizes.append(encoder.get_intermediate_size(v['duration'], 
+                                                           self.dvd_format))
+        return max(sizes)
+    
+    def check_intermediate_budget(self, e, required):
+        '''Turn off the encoder's intermediate file (see 
+        Encoder.setup_intermediate) if it would not fit in the temp budget 
+        along with the required bytes of the encoded title.
+        '''
+        if not e.use_intermediate:
+            return
+        try:
+            self.workspace.check_budget(required + 
+                                        e.get_intermediate_size_estimate())
+        except workspace.Error:
+            print('WARNING: Not enough temp space for an intermediate file',
+                  '({:.1f} MiB); decoding {} twice instead.'.format(
+                      e.get_intermediate_size_estimate()/1024/1024, 
+                      e.in_file))
+            e.use_intermediate = False
+    
+    def get_title_size_estimate(self, vid):
+        if vid['copy_v']:
+            return sum([os.path.getsize(i) for i in vid['in']])
+        bitrate = vid.get('vbitrate', self.vbitrate) + self.abitrate
+        return vid['duration'] * bitrate / 8 * self.mux_overhead
+    
+    def get_fixed_size(self):
+        '''Returns the size in bytes of everything on the DVD that is already
+        encoded: the menus and all finished titles.
+        '''
+        size = sum([i.get('size', 0) for i in self.vids])
+        if getattr(self, 'menu', None):
+            for m in self.menus + [self.blank_menu]:
+                if os.path.exists(m.path_menu_mpg):
+                    size += os.path.getsize(m.path_menu_mpg)
+        return size * self.mux_overhead
+    
+    def get_overflow(self):
+        return self.get_fixed_size() - self.dvd_size_bytes
+    
+    def update_vbitrate(self):
+        '''Recalculate the video bitrate for the titles that have not been 
+        encoded yet from the space actually used by the finished ones.
+        '''
+        if self.vbitrate_fixed:
+            return
+        remaining = [i for i in self.vids if 'size' not in i]
+        if not remaining:
+            return
+        # passthrough titles have a known size, count them as finished
+        copied_bits = sum([os.path.getsize(p) * 8 for i in remaining 
+                           if i['copy_v'] for p in i['in']])
+        duration = sum([i['duration'] for i in remaining if not i['copy_v']])
+        if not duration:
+            return
+        budget = (self.dvd_size_bits * (1 - self.size_margin) 
+                  - self.get_fixed_size() * 8 - copied_bits)
+        vbitrate = math.floor(budget / duration - self.abitrate)
+        vbitrate = min(vbitrate, math.floor(9000000 - self.abitrate))
+        if vbitrate < VBITRATE_FLOOR:
+            print('WARNING: The remaining titles need a video bitrate of '
+                  '{:.1f} kbps to fit on the DVD; using {:.1f} kbps '
+                  'instead.'.format(vbitrate / 1024, VBITRATE_FLOOR / 1024))
+            vbitrate = VBITRATE_FLOOR
+        for i in remaining:
+            i['vbitrate'] = vbitrate
+    
+    @trace.traced()
+    def fit_to_dvd(self, max_reduction=.2, max_tries=2):
+        '''If the encoded titles do not fit on the DVD, re-encode the 
+        smallest number of titles needed (largest first) at a lower bitrate.
+        
+        A title's bitrate is cut by at most max_reduction, and never below 
+        VBITRATE_FLOOR.
+        '''
+        for n in range(max_tries):
+            overflow = self.get_overflow()
+            if overflow <= 0 or self.vbitrate_fixed:
+                break
+            # 1% extra to allow for overshoot of the new encodes
+            overflow *= 1.01
+            candidates = sorted([i for i in self.vids if not i['copy_v']], 
+                                key=lambda i: i['size'], reverse=True)
+            # the most bits each title can be cut by
+            max_cut = {}
+            for i in candidates:
+                rate = i.get('vbitrate', self.vbitrate)
+                cut = min(rate * max_reduction, rate - VBITRATE_FLOOR)
+                max_cut[id(i)] = max(cut, 0) * i['duration']
+            chosen = []
+            for i in candidates:
+                if max_cut[id(i)] <= 0:
+                    continue
+                chosen.append(i)
+                if sum([max_cut[id(c)] for c in chosen]) >= overflow * 8:
+                    break
+            chosen_cut = sum([max_cut[id(c)] for c in chosen])
+            if chosen_cut < overflow * 8:
+                break
+            utils.log_items(heading=('DVD is {:.1f} MiB too large, '
+                                     're-encoding {} title(s)...'.format(
+                                        overflow/1024/1024, len(chosen))), 
+                            items=False, logger=self.logger)
+            for v in chosen:
+                # share the reduction in proportion to the most each can take
+                cut_bits = overflow * 8 * max_cut[id(v)] / chosen_cut
+                cut = cut_bits / v['duration']
+                v['vbitrate'] = math.floor(v.get('vbitrate', self.vbitrate) 
+                                           - cut)
+                self.progress['total'] += self.get_encode_work(v)
+                aspect = [ts['ar'] for ts in self.titlesets 
+                          if v in ts['vids']][0]
+                self.encode_title(v, aspect)
+        if self.get_overflow() > 0:
+            print('WARNING: Unable to fit the encoded titles on the DVD!')
+    
+    def get_encoder(self, vid, aspect):
+        # numbered, since titles from different dirs can share a name
+        name = os.path.splitext(os.path.basename(vid['in'][0]))[0]
+        out_file = os.path.join(self.tmp_dir, '{:02}_{}.mpg'.format(
+                                    self.vids.index(vid)+1, name))
+        e = Encoder(vid['in'], 
+                    out_file=out_file, 
+                    vbitrate=vid.get('vbitrate', self.vbitrate), 
+                    abitrate=self.abitrate,
+                    two_pass=self.two_pass,
+                    aspect=aspect,
+                    dvd_format=self.dvd_format,
+                    with_subs=self.with_subs, 
+                    in_srt=vid['srt'][0],
+                    copy_v=vid['copy_v'],
+                    copy_a=vid['copy_a'],
+                    duration=vid['duration'],
+                    progress_callback=self.update_progress,
+                    intermediate=self.intermediate,
+                    ivtc=self.ivtc,
+                    crop=self.crop,
+                    out_log=self.out_log)
+        return e
     
+    @trace.traced()
+    def estimate_encode(self, samples=3, sample_length=20):
+        '''Estimate the time needed to encode each title and the size of the 
+        result by encoding a few short samples of each with the real 
+        encoder settings.  Logs the results instead of making the DVD.
+        '''
+        utils.log_items(heading='Estimating encode time and size...', 
+                        items=False, logger=self.logger)
+        total_time = 0
+        total_size = 0
+        for ts in self.titlesets:
+            for v in ts['vids']:
+                e = self.get_encoder(v, ts['ar'])
+                length = min(sample_length, v['duration'] / (samples * 2))
+                points = [v['duration'] * (n+1) / (samples+1) - length / 2 
+                          for n in range(samples)]
+                wall = 0
+                size = 0
+                for p in points:
+                    w, b = e.encode_sample(p, length)
+                    wall += w
+                    size += b
+                sampled = length * samples
+                est_time = wall / sampled * v['duration']
+                est_size = size / sampled * v['duration']
+                total_time += est_time
+                total_size += est_size
+                log_data = [('Time', self.get_duration_string(est_time)),
+                            ('Speed', '{:.2f}x'.format(sampled / wall)),
+                            ('Size', '{:.1f} MiB'.format(est_size/1024/1024))]
+                utils.log_items('#{}: {}:'.format(self.vids.index(v)+1, 
+                                                   v['vid_label']), 
+                                lines_before=0, sep_pre='-', sep_post='-', 
+                                logger=self.logger)
+                utils.log_items(log_data, col_width=12, indent=4, 
+                                lines_before=0, logger=self.logger)
+        used = total_size / self.dvd_size_bytes * 100
+        fits = 'yes' if total_size <= self.dvd_size_bytes else 'NO'
+        log_data = [('Total Time', self.get_duration_string(total_time)),
+                    ('Total Size', '{:.1f} MiB ({:.1f}% of DVD)'.format(
+                                        total_size/1024/1024, used)),
+                    ('Fits on DVD', fits)]
+        utils.log_items(log_data, 'Encode Estimate', col_width=16, 
+                        logger=self.logger)
+    
+    def get_encode_work(self, vid):
+        '''Amount of encoding work for a title, in seconds of video to be 
+        processed (counting both passes of a two-pass encode).
+        '''
+        if self.two_pass and not vid['copy_v']:
+            return vid['duration'] * 2
+        return vid['duration']
+    
+    def start_progress(self):
+        self.progress = {'total': sum([self.get_encode_work(i) 
+                                       for i in self.vids]),
+                         'finished': 0,
+                         'done': 0,
+                         'start': time.time(),
+                         'elapsed': 0,
+                         'eta': None,
+                         'title': None,
+                         'encoder': {}}
+        self.progress_logged = 0
+    
+    def update_progress(self, enc_progress):
+        '''Called by the Encoder after every ffmpeg progress report.  
+        Aggregates the progress of the current title into a whole-disc ETA,
+        which is logged periodically and passed on to progress_callback.
+        '''
+        p = self.progress
+        current = (enc_progress['pass'] - 1) * self.encoding['duration']
+        current += min(enc_progress['time'], self.encoding['duration'])
+        p['done'] = p['finished'] + current
+        p['elapsed'] = time.time() - p['start']
+        p['title'] = self.vids.index(self.encoding) + 1
+        p['encoder'] = enc_progress
+        rate = p['done'] / p['elapsed'] if p['elapsed'] else 0
+        p['eta'] = (p['total'] - p['done']) / rate if rate else None
+        self.log_progress()
+        if self.progress_callback:
+            self.progress_callback(p)
+    
+    def log_progress(self, force=False):
+        p = self.progress
+        now = time.time()
+        if not force and now - self.progress_logged < self.progress_interval:
+            return
+        self.progress_logged = now
+        enc = p['encoder']
+        percent = p['done'] / p['total'] * 100 if p['total'] else 100
+        eta = self.get_duration_string(p['eta']) if p['eta'] is not None else '?'
+        log_data = [('Elapsed', self.get_duration_string(p['elapsed'])),
+                    ('Disc', '{:.1f}%, ETA {}'.format(percent, eta))]
+        if enc and not force:
+            log_data.extend([
+                ('Title', '#{} of {}, pass {} of {}'.format(
+                                    p['title'], len(self.vids), 
+                                    enc['pass'], enc['passes'])),
+                ('Throughput', '{:.1f} fps, {:.2f}x, {:.1f} MiB written'.format(
+                                    enc['fps'], enc['speed'], 
+                                    enc['bytes'] / 1024 / 1024))])
+        utils.log_items(log_data, lines_before=0, col_width=12,
+                        logger=self.logger)
+    
+    @trace.traced()
     def create_dvd_xml(self):
         utils.log_items(heading='Making dvdauthor xml...', items=False,
                         logger=self.logger)
@@ -751,19 +1344,38 @@ class DVD (object):
                                                  id='0', mode='widescreen') 
                 sub_stream_lb = etree.SubElement(menus_subpicture, 'stream',
                                                  id='1', mode='letterbox') 
-            menus_pgc = etree.SubElement(menus, 'pgc')
-            #~ for n,i in enumerate(self.menu.buttons):
-            for n,i in enumerate(self.menu.bg.button_imgs):
-                #~ b = etree.SubElement(menus_pgc, 'button', name=i)
-                b = etree.SubElement(menus_pgc, 'button')
-                b.text = 'jump title {};'.format(n+1)
-            menus_vob = etree.SubElement(menus_pgc, 'vob', 
-                                         file=self.menu.path_menu_mpg)
-            menus_post = etree.SubElement(menus_pgc, 'post')
-            if self.no_loop_menu:
-                menus_post.text = 'jump title 1;'
-            else:
-                menus_post.text = 'jump cell 1;'
+            # one pgc per page.  g1 holds the page last shown, so that 
+            # returning to the vmgm menu (always page 1) from a title goes
+            # back to the page it was chosen on.
+            pages = len(self.menus)
+            for p,menu in enumerate(self.menus):
+                menus_pgc = etree.SubElement(menus, 'pgc')
+                if p == 0 and pages > 1:
+                    menus_pre = etree.SubElement(menus_pgc, 'pre')
+                    menus_pre.text = ' '.join(['if (g1 eq {0}) jump menu {0};'
+                                               .format(i) 
+                                               for i in range(2, pages+1)])
+                #~ for n,i in enumerate(self.menu.buttons):
+                for n in self.menu_pages[p]:
+                    #~ b = etree.SubElement(menus_pgc, 'button', name=i)
+                    b = etree.SubElement(menus_pgc, 'button')
+                    b.text = 'jump title {};'.format(n+1)
+                # previous/next page buttons come after the titles
+                targets = []
+                if p > 0:
+                    targets.append(p)
+                if p < pages - 1:
+                    targets.append(p + 2)
+                for i in targets:
+                    b = etree.SubElement(menus_pgc, 'button')
+                    b.text = 'g1 = {0}; jump menu {0};'.format(i)
+                menus_vob = etree.SubElement(menus_pgc, 'vob', 
+                                             file=menu.path_menu_mpg)
+                menus_post = etree.SubElement(menus_pgc, 'post')
+                if self.no_loop_menu:
+                    menus_post.text = 'jump title 1;'
+                else:
+                    menus_post.text = 'jump cell 1;'
         # titlesets
         for n,ts in enumerate(self.titlesets):
             titleset = etree.SubElement(dvdauthor, 'titleset')
@@ -818,11 +1430,91 @@ class DVD (object):
             groups.append(pgc)
         return groups
     
+    @trace.traced()
     def author_dvd(self):
         utils.log_items(heading='Authoring DVD...', items=False,
                         logger=self.logger)
         e = dict(os.environ)
         e['VIDEO_FORMAT'] = self.dvd_format
         cmd = ['dvdauthor', '-x', self.out_dvd_xml, '-o', self.out_dvd_dir]
-        o = subprocess.check_output(cmd, env=e, universal_newlines=True)
+        o = runner.check_output(cmd, pool='mux', log=self.out_log, env=e, 
+                                universal_newlines=True)
+    
+    @trace.traced()
+    def report_disc_usage(self):
+        '''Log (and record in metrics) the size of the authored DVD compared 
+        to the size of the disc.
+        '''
+        used = 0
+        for root, dirs, files in os.walk(self.out_dvd_dir):
+            used += sum([os.path.getsize(os.path.join(root, i)) 
+                         for i in files])
+        ratio = used / self.dvd_size_bytes
+        utils.log_items([('DVD Size', '{:.1f} MiB ({:.1%} of {:.1f} MiB)'
+                                      .format(used/1024/1024, ratio, 
+                                              self.dvd_size_bytes/1024/1024))], 
+                        lines_before=1, logger=self.logger)
+        metrics.set_value('izdvd_disc_used_bytes', used, disc=self.out_name)
+        metrics.set_value('izdvd_disc_capacity_bytes', self.dvd_size_bytes, 
+                          disc=self.out_name)
+        metrics.set_value('izdvd_disc_utilisation_ratio', ratio, 
+                          disc=self.out_name)
+    
+    def create_fifos(self):
+        '''Create a named pipe for each title.  The pipes are referenced by 
+        the dvdauthor xml in place of the encoded mpeg2 files, so that the 
+        encoder output goes straight into the VOBs without touching tmp.
+        '''
+        for n,v in enumerate(self.vids):
+            name = os.path.splitext(os.path.basename(v['in'][0]))[0]
+            fifo = os.path.join(self.tmp_dir, 
+                                '{:02}_{}.fifo.mpg'.format(n+1, name))
+            if os.path.exists(fifo):
+                os.remove(fifo)
+            os.mkfifo(fifo)
+            v['mpeg'] = fifo
+    
+    def open_fifo(self, fifo, proc, poll_interval=.5):
+        '''Wait for dvdauthor to open a fifo for reading and return a file 
+        object for writing to it.  Opening with O_NONBLOCK fails with ENXIO 
+        until there is a reader, so dvdauthor exiting early cannot leave 
+        us blocked forever.
+        '''
+        while True:
+            try:
+                fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+                if proc.poll() is not None:
+                    raise runner.CalledProcessError(proc.returncode, 
+                                                    proc.args)
+                time.sleep(poll_interval)
+                continue
+            # back to blocking writes once the reader is attached
+            os.set_blocking(fd, True)
+            return os.fdopen(fd, 'wb')
+    
+    @trace.traced()
+    def author_dvd_streaming(self):
+        utils.log_items(heading='Authoring DVD (streaming titles)...', 
+                        items=False, logger=self.logger)
+        e = dict(os.environ)
+        e['VIDEO_FORMAT'] = self.dvd_format
+        cmd = ['dvdauthor', '-x', self.out_dvd_xml, '-o', self.out_dvd_dir]
+        # not run in the mux pool: dvdauthor mostly waits on the encoders 
+        # here, and holding a slot while they wait for theirs could deadlock
+        proc = runner.Popen(cmd, log=self.out_log, env=e, stdout=runner.LOG)
+        try:
+            self.encode_video(proc)
+        except:
+            proc.kill()
+            proc.wait()
+            raise
+        finally:
+            for v in self.vids:
+                if os.path.exists(v['mpeg']):
+                    os.remove(v['mpeg'])
+        if proc.wait() != 0:
+            raise runner.CalledProcessError(proc.returncode, cmd)
 
@@ -9,7 +9,13 @@
 from izdvd.bg import BG
 from izdvd import utils
 from izdvd import config
-import subprocess
+from izdvd import trace
+from izdvd import workspace
+from izdvd import imgstore
+from izdvd import runner
+from izdvd import motion
+import threading
+import shutil
 import math
 from collections import Counter
 import os
@@ -17,12 +23,21 @@ from lxml import etree
 import logging
 
 
+# menu audio already made by this process, shared by the pages of a paged
+# menu (see DVDMenu.convert_audio)
+_AUDIO = {}
+_AUDIO_LOCK = threading.Lock()
+
+
 class DVDMenu (object):
     def __init__(self, 
                  # input paths
                  menu_imgs, 
                  menu_bg=None,
                  menu_labels=None,
+                 menu_vids=None,
+                 menu_vid_starts=None,
+                 menu_bg_vid=None,
                  # output paths 
                  out_name=None,
                  out_dir=None,
@@ -48,9 +63,11 @@ class DVDMenu (object):
                  # labels
                  label_line_height=None, 
                  label_lines=None,
+                 nav_labels=None,
                  # ------menu opts------
                  menu_audio=None,
                  frames=360,
+                 menu_preview=False,
                  mode='menu',
                  no_logging=False,
                  ):
@@ -58,6 +75,9 @@ class DVDMenu (object):
         self.menu_imgs = menu_imgs
         self.menu_bg = menu_bg
         self.menu_labels = menu_labels
+        self.menu_vids = menu_vids
+        self.menu_vid_starts = menu_vid_starts
+        self.menu_bg_vid = menu_bg_vid
          # output paths 
         self.out_name = out_name
         self.out_dir = out_dir
@@ -86,32 +106,47 @@ class DVDMenu (object):
         # labels
         self.label_line_height = label_line_height
         self.label_lines = label_lines
+        self.nav_labels = nav_labels
         # menu
         self.menu_audio = menu_audio
         self.frames = frames
+        self.menu_preview = menu_preview
         self.mode = mode
         self.no_logging = no_logging
         #-----------------
         self.get_out_paths()
         self.log_output_info()
         self.get_bg()
-        self.convert_to_m2v()
+        if self.menu_preview:
+            # only the layout (see BG.make_preview)
+            shutil.copy(self.bg.path_preview_img, self.path_preview_img)
+            return
+        if self.menu_vids or self.menu_bg_vid:
+            self.make_motion_m2v()
+        else:
+            self.convert_to_m2v()
         self.convert_audio()
         self.multiplex_audio()
         self.create_menu_mpg()
         self.log_menu_info()
     
+    @trace.traced()
     def get_out_paths(self):
         paths = utils.get_out_paths(config.PROG_NAME, self.out_name, 
                                     self.out_dir, self.tmp_dir, 150*1024*1024)
-        self.out_name, self.out_dir, self.tmp_dir = paths
+        self.out_name, self.out_dir, tmp_root = paths
+        self.workspace = workspace.Workspace(tmp_root, self.out_name, 
+                                             budget=150*1024*1024)
+        self.tmp_dir = self.workspace.path
         #~ self.out_files_dir = os.path.join(self.out_dir, 'menu-files')
         #~ if not os.path.exists(self.out_files_dir):
             #~ os.makedirs(self.out_files_dir)
         self.path_menu_mpg = os.path.join(self.out_dir, 
                                           '{}_menu.mpg'.format(self.out_name))
         self.path_menu_lb_mpg = os.path.join(self.out_dir, 
-                                  '{}_menu_letterbox.mpg'.format(self.out_name))        
+                                  '{}_menu_letterbox.mpg'.format(self.out_name))
+        self.path_preview_img = os.path.join(self.out_dir, 
+                                       '{}_preview.png'.format(self.out_name))        
         self.path_bg_m2v = os.path.join(self.tmp_dir, 
                                       '{}_menu_video.m2v'.format(self.out_name))
         self.path_bg_ac3 = os.path.join(self.tmp_dir, 
@@ -127,9 +162,7 @@ class DVDMenu (object):
                                         '{}.log'.format(self.out_name))
         if self.no_logging:
             self.out_log = os.devnull
-        self.logger = logging.getLogger('{}.menu'.format(config.PROG_NAME))
-        self.logger.addHandler(logging.FileHandler(self.out_log))
-        self.logger.setLevel(logging.INFO)
+        self.logger = utils.get_logger('menu', self.out_log)
     
     def log_output_info(self):
         if self.mode == 'menu' and not self.no_logging:
@@ -137,6 +170,8 @@ class DVDMenu (object):
                             [self.out_name, self.out_dir, self.tmp_dir]))
             utils.log_items(logs, 'Output Paths', logger=self.logger)
     
+    @trace.traced()
+    @imgstore.collects
     def get_bg(self):
         bg_attrs = ['menu_bg',
                     'menu_labels',
@@ -162,7 +197,9 @@ class DVDMenu (object):
                     'shadow_y_offset',
                     # labels
                     'label_line_height',
-                    'label_lines']
+                    'label_lines',
+                    'nav_labels',
+                    'menu_preview']
         bg_args = {}
         for k in bg_attrs:
             v = getattr(self, k)
@@ -179,49 +216,86 @@ class DVDMenu (object):
                      out_log=self.out_log, 
                      no_logging=self.no_logging,
                      mode=self.mode,
+                     with_overlay=bool(self.menu_bg_vid),
                      **bg_args)
     
+    @trace.traced()
     def convert_to_m2v(self, frames=None):
         if frames is None:
             frames = self.frames
         frames = str(frames)
-        if self.dvd_format == 'PAL':
-            framerate = '25:1'
-            pixel_aspect = '59:54'
-            fmt = 'p'
-        else:
-            framerate = '30000:1001'
-            pixel_aspect = '10:11'
-            fmt = 'n'
-        if self.menu_ar == 16/9:
-            aspect = '3'
-        else:
-            aspect = '2'
+        framerate, pixel_aspect, fmt, aspect = motion.get_video_params(
+            self.dvd_format, self.menu_ar)
         if not self.no_logging:
             utils.log_items(heading=('Converting menu background '
                                      'to mpeg2 video...'), 
                             items=False, lines_before=1, sep='', sep_post='-',
                             logger=self.logger)
-        with open(self.out_log, 'a') as log:
-            if self.no_logging:
-                log = subprocess.DEVNULL
-            p1 = subprocess.Popen(['convert', self.bg.path_bg_img, 'ppm:-'], 
-                                  stdout=subprocess.PIPE, 
-                                  stderr=log)
-            p2 = subprocess.Popen(['ppmtoy4m', '-n', frames, '-F', framerate, 
-                                   '-A', pixel_aspect, '-I', 'p', '-r', 
-                                   '-S', '420mpeg2'], 
-                                  stdin=p1.stdout, stdout=subprocess.PIPE,
-                                  stderr=log)
+        with runner.slot('ffmpeg'):
+            p1 = runner.Popen(['convert', self.bg.path_bg_img, 'ppm:-'], 
+                              stdout=runner.PIPE, log=self.out_log)
+            p2 = runner.Popen(['ppmtoy4m', '-n', frames, '-F', framerate, 
+                               '-A', pixel_aspect, '-I', 'p', '-r', 
+                               '-S', '420mpeg2'], 
+                              stdin=p1.stdout, stdout=runner.PIPE,
+                              log=self.out_log)
             p1.stdout.close()
-            p3 = subprocess.Popen(['mpeg2enc', '-n', fmt, '-f', '8', '-b', '5000', 
-                                   '-a', aspect, '-o', self.path_bg_m2v], 
-                                  stdin=p2.stdout,stdout=subprocess.PIPE,
-                                  stderr=log)
+            p3 = runner.Popen(['mpeg2enc', '-n', fmt, '-f', '8', '-b', '5000', 
+                               '-a', aspect, '-o', self.path_bg_m2v], 
+                              stdin=p2.stdout,stdout=runner.PIPE,
+                              log=self.out_log)
             p2.stdout.close()
             output, err = p3.communicate()
+            p1.wait()
+            p2.wait()
     
+    @trace.traced()
+    def make_motion_m2v(self):
+        '''Encode a motion menu, with menu_vids playing in the buttons and/or
+        menu_bg_vid behind them (see motion.MotionMenu).  Falls back to a 
+        still menu without numpy.
+        '''
+        if motion.numpy is None:
+            print('WARNING: numpy is needed for motion menus, making a still '
+                  'menu instead.')
+            self.convert_to_m2v()
+            return
+        if not self.no_logging:
+            utils.log_items(heading=('Encoding motion menu '
+                                     'to mpeg2 video...'), 
+                            items=False, lines_before=1, sep='', sep_post='-',
+                            logger=self.logger)
+        motion.MotionMenu(self.bg, self.path_bg_m2v, 
+                          button_vids=self.menu_vids, 
+                          button_starts=self.menu_vid_starts, 
+                          bg_vid=self.menu_bg_vid, 
+                          frames=self.frames, 
+                          dvd_format=self.dvd_format, 
+                          menu_ar=self.menu_ar, 
+                          out_log=self.out_log)
+    
+    @trace.traced()
     def convert_audio(self):
+        '''Make the menu's audio, or reuse the same audio if another menu 
+        (e.g. another page of the same menu) has already made it.
+        '''
+        # the audio is in the private workspace of the menu that made it, 
+        # which is only removed when the process exits, so it stays valid for 
+        # later menus.  out_dir is in the key so that each DVD of a batch 
+        # gets its own copy.
+        key = (self.out_dir, self.menu_audio, int(self.frames), 
+               self.dvd_format)
+        with _AUDIO_LOCK:
+            entry = _AUDIO.setdefault(key, {'lock': threading.Lock(), 
+                                            'path': None})
+        with entry['lock']:
+            if entry['path'] is not None and os.path.exists(entry['path']):
+                self.path_bg_ac3 = entry['path']
+                return
+            self.make_audio()
+            entry['path'] = self.path_bg_ac3
+    
+    def make_audio(self):
         if self.menu_audio:
             in_file = ['-i', self.menu_audio]
             cmd = ['ffmpeg'] + in_file + ['-ac', '2', '-ar', '48000', 
@@ -230,11 +304,8 @@ class DVDMenu (object):
                 utils.log_items(heading='Transcoding menu audio to ac3...', 
                                 items=False, lines_before=1, sep='', sep_post='-',
                                 logger=self.logger)
-            with open(self.out_log, 'a') as log:
-                if self.no_logging:
-                    log = subprocess.DEVNULL
-                o = subprocess.check_output(cmd, universal_newlines=True,
-                                            stderr=log)
+            o = runner.check_output(cmd, pool='ffmpeg', log=self.out_log,
+                                    universal_newlines=True)
             return
         # else make silent audio file for menu
         if self.dvd_format == 'PAL':
@@ -246,18 +317,19 @@ class DVDMenu (object):
             utils.log_items(heading='Creating blank audio for menu...', 
                             items=False, lines_before=1, sep='', sep_post='-',
                             logger=self.logger)
-        with open(self.out_log, 'a') as log:
-            if self.no_logging:
-                log = subprocess.DEVNULL
-            p1 = subprocess.Popen(['dd', 'if=/dev/zero', 'bs=4', 
-                                   'count={}'.format(samples)], 
-                                  stdout=subprocess.PIPE, stderr=log)
-            p2 = subprocess.Popen(['toolame', '-b', '128', '-s', '48', '/dev/stdin',
-                                   self.path_bg_ac3], 
-                                  stdin=p1.stdout, stderr=log, stdout=log)
+        with runner.slot('mux'):
+            p1 = runner.Popen(['dd', 'if=/dev/zero', 'bs=4', 
+                               'count={}'.format(samples)], 
+                              stdout=runner.PIPE, log=self.out_log)
+            p2 = runner.Popen(['toolame', '-b', '128', '-s', '48', '/dev/stdin',
+                               self.path_bg_ac3], 
+                              stdin=p1.stdout, stdout=runner.LOG, 
+                              log=self.out_log)
             p1.stdout.close()
             out, err = p2.communicate()
+            p1.wait()
     
+    @trace.traced()
     def multiplex_audio(self):
         cmd = ['mplex', '-f', '8', '-o', self.path_bg_mpg, self.path_bg_m2v,
                self.path_bg_ac3]
@@ -265,12 +337,10 @@ class DVDMenu (object):
             utils.log_items(heading='Multiplexing menu audio/video...', 
                             items=False, lines_before=1, sep='', sep_post='-',
                             logger=self.logger)
-        with open(self.out_log, 'a') as log:
-            if self.no_logging:
-                log = subprocess.DEVNULL
-            o = subprocess.check_output(cmd, universal_newlines=True,
-                                        stderr=log)
+        o = runner.check_output(cmd, pool='mux', log=self.out_log, 
+                                universal_newlines=True)
     
+    @trace.traced()
     def create_menu_mpg(self):
         if self.menu_imgs is None:
             os.rename(self.path_bg_mpg, self.path_menu_mpg)
@@ -319,6 +389,7 @@ class DVDMenu (object):
         tree = etree.ElementTree(subpictures)
         tree.write(xml, encoding='UTF-8', pretty_print=True)
 
+    @trace.traced()
     def multiplex_buttons(self, in_mpg, out_mpg, xml, stream, mode='normal'):
         e = dict(os.environ)
         if self.dvd_format == 'PAL':
@@ -330,17 +401,15 @@ class DVDMenu (object):
                                      'w/ spumux ({})...'.format(mode)), 
                             items=False, lines_before=1, sep='', sep_post='-',
                             logger=self.logger)
-        with open(out_mpg, 'w') as f:
-            with open(self.out_log, 'a') as log:
-                if self.no_logging:
-                    log = subprocess.DEVNULL
-                p1 = subprocess.Popen(['cat', in_mpg], 
-                                      stdout=subprocess.PIPE, stderr=log)
-                p2 = subprocess.Popen(['spumux', '-s', str(stream), xml], 
-                                      stdin=p1.stdout, stdout=f, stderr=log, 
-                                      env=e)
-                p1.stdout.close()
-                out, err = p2.communicate()
+        with open(out_mpg, 'w') as f, runner.slot('mux'):
+            p1 = runner.Popen(['cat', in_mpg], 
+                              stdout=runner.PIPE, log=self.out_log)
+            p2 = runner.Popen(['spumux', '-s', str(stream), xml], 
+                              stdin=p1.stdout, stdout=f, log=self.out_log, 
+                              env=e)
+            p1.stdout.close()
+            out, err = p2.communicate()
+            p1.wait()
     
     def log_menu_info(self):
         if not self.no_logging:
@@ -8,15 +8,49 @@
 
 import os
 import argparse
-import subprocess
 import re
 import math
+import time
+from concurrent.futures import ThreadPoolExecutor
 from lxml import etree
+from izdvd import config
+from izdvd import trace
+from izdvd import utils
+from izdvd import runner
+
+# bytes per pixel of the ffvhuff yuv420p intermediate (1.5 uncompressed, 
+# about 2:1 lossless compression on film content, rounded up)
+INTERMEDIATE_BYTES_PER_PIXEL = 1
 
 class Error(Exception):
     def __init__(self, message):
         self.message = message
 
+def is_expensive_to_decode(width, height, v_format, bit_depth):
+    '''Returns True if decoding (and scaling) video is likely to be slow 
+    compared to the mpeg2 encode itself, e.g., HEVC or 10-bit HD.
+    '''
+    pixels = width * height
+    if pixels > 1920*1088:
+        return True
+    if pixels >= 1280*720:
+        if v_format in config.EXPENSIVE_CODECS:
+            return True
+        if bit_depth > 8:
+            return True
+    return False
+
+def get_intermediate_size(duration, dvd_format):
+    '''Returns a rough size in bytes of the intermediate file (see 
+    Encoder.setup_intermediate) for duration seconds of video, from the 
+    storage pixel rate of dvd_format.
+    '''
+    if dvd_format.lower() == 'pal':
+        pixel_rate = 720 * 576 * 25
+    else:
+        pixel_rate = 720 * 480 * 30000/1001
+    return duration * pixel_rate * INTERMEDIATE_BYTES_PER_PIXEL
+
 class Encoder (object):
     def __init__(self, 
                  in_file=None, 
@@ -30,7 +64,15 @@ class Encoder (object):
                  two_pass=True, 
                  dry_run=False, 
                  get_args=False, 
-                 with_subs=False):
+                 with_subs=False,
+                 copy_v=False,
+                 copy_a=False,
+                 duration=None,
+                 progress_callback=None,
+                 intermediate='auto',
+                 ivtc='auto',
+                 crop='auto',
+                 out_log=None):
         self.in_file = in_file
         self.in_srt= in_srt
         self.out_file = out_file
@@ -42,6 +84,19 @@ class Encoder (object):
         self.two_pass = two_pass
         self.dry_run = dry_run
         self.with_subs = with_subs
+        self.copy_v = copy_v
+        self.copy_a = copy_a
+        self.duration = duration
+        self.progress_callback = progress_callback
+        self.progress = {}
+        self.intermediate = intermediate
+        self.ivtc = ivtc
+        self.crop = crop
+        self.out_log = out_log
+        self.sample = None
+        if copy_v:
+            # nothing to analyze when the video is only remuxed
+            self.two_pass = False
         if in_srt:
             self.with_subs = True
         ######
@@ -52,8 +107,12 @@ class Encoder (object):
         if self.in_files_cat:
             self.create_cat_file()
         self.get_size()
+        self.get_codec_info()
+        self.detect_film()
+        self.detect_crop()
         self.calculate_scaling()
         self.calculate_padding()
+        self.setup_intermediate()
         if self.with_subs:
             self.write_srt()
             self.create_subs_xml()
@@ -97,6 +156,8 @@ class Encoder (object):
                                      '{}.subs.xml'.format(self.out_name))
         self.cat_file = os.path.join(self.out_dir, 
                                      '{}.cat.txt'.format(self.out_name))
+        self.intermediate_file = os.path.join(self.out_dir, 
+                                    '{}.intermediate.mkv'.format(self.out_name))
         # make out_dir if it doesn't exist
         if not os.path.exists(self.out_dir):
             os.makedirs(self.out_dir)
@@ -119,8 +180,7 @@ class Encoder (object):
         print('\nInput file: {}\n'.format(args.in_file))
     
     def get_size(self):
-        info = subprocess.check_output(['mediainfo', self.in_file], 
-                                       universal_newlines=True).splitlines()
+        info = utils.get_mediainfo(self.in_file).splitlines()
         for l in info:
             if l.startswith('Width '):
                 width = re.search(r':\s*(\d+)', l).group(1)
@@ -137,6 +197,146 @@ class Encoder (object):
                     dar = float(dar_mi)
                 self.dar = dar
     
+    def get_codec_info(self):
+        fmt = ('--Output=Video;%Format%|^|%BitDepth%|^|%FrameRate%|^|'
+               '%ScanType%|^|%Duration%\n')
+        info = utils.get_mediainfo(self.in_file, fmt).strip()
+        v_format, bit_depth, fps, scan, d_ms = info.splitlines()[0].split('|^|')
+        # of in_file only, which is the first part of a stacked title
+        self.in_file_duration = float(d_ms) / 1000 if d_ms else None
+        if self.duration is None:
+            self.duration = self.in_file_duration
+        self.v_format = v_format
+        self.bit_depth = int(bit_depth) if bit_depth.isdigit() else 8
+        self.in_fps = fps
+        self.in_scan_type = scan
+    
+    @trace.traced('encode')
+    def detect_film(self):
+        '''Detect NTSC film sources that can be encoded at 23.976 fps 
+        progressive with soft pulldown flags instead of 29.97 fps:
+        
+            progressive:    23.976/24 fps progressive sources
+            telecined:      29.97 fps sources with hard 3:2 pulldown 
+                            (removed with fieldmatch/decimate)
+        
+        Sets self.film to one of the above or None.
+        '''
+        self.film = None
+        if (self.ivtc == 'never' or self.copy_v 
+            or self.dvd_format.lower() != 'ntsc'):
+            return
+        if self.in_fps in ['23.976', '24.000'] and self.in_scan_type != 'Interlaced':
+            self.film = 'progressive'
+        elif self.in_fps == '29.970' and self.is_telecined():
+            self.film = 'telecined'
+        if self.film and self.two_pass:
+            # mpeg2enc has no two-pass mode
+            print('NOTE: {} is film; encoding it in a single pass with '
+                  'mpeg2enc at a constant bitrate.'.format(self.in_file))
+            self.two_pass = False
+    
+    def is_telecined(self, frames=600, threshold=.3):
+        '''Run the idet filter on a sample from the middle of the video.  
+        3:2 pulldown repeats a field in 2 of every 5 frames, so telecined 
+        video shows a high ratio of repeated fields.
+        '''
+        # in_file is only the first part of a stacked title
+        seek = self.in_file_duration / 2 if self.in_file_duration else 0
+        cmd = ['ffmpeg', '-hide_banner', '-nostats', '-ss', str(seek), 
+               '-i', self.in_file, '-map', '0:v:0', '-frames:v', str(frames), 
+               '-filter:v', 'idet', '-an', '-f', 'null', '-']
+        out = runner.run(cmd, pool='ffmpeg', stdout=runner.DEVNULL, 
+                         stderr=runner.PIPE, 
+                         universal_newlines=True).stderr
+        m = re.search(r'Repeated Fields:\s*Neither:\s*(\d+)\s*Top:\s*(\d+)'
+                      r'\s*Bottom:\s*(\d+)', out)
+        if not m:
+            return False
+        neither, top, bottom = [int(i) for i in m.groups()]
+        total = neither + top + bottom
+        return total > 0 and (top + bottom) / total >= threshold
+    
+    @trace.traced('encode')
+    def detect_crop(self, samples=6, frames=10, min_crop=.01):
+        '''Find black bars burned into the source by running cropdetect on 
+        a few short samples spread through the video (in parallel).  
+        
+        The crop used is the union of the areas detected in each sample, 
+        so that dark scenes (where cropdetect finds more "bars") cannot cut 
+        into the picture.  Crops smaller than min_crop (as a fraction of 
+        the width/height) are ignored.
+        
+        Sets self.crop_area to (w, h, x, y) or None.
+        '''
+        self.crop_area = None
+        if self.crop == 'never' or self.copy_v or not self.in_file_duration:
+            return
+        # samples are taken from in_file, the first part of a stacked title
+        points = [self.in_file_duration * (n+1) / (samples+1) 
+                  for n in range(samples)]
+        with ThreadPoolExecutor(max_workers=samples) as pool:
+            found = [i for i in pool.map(self.get_crop_sample, points, 
+                                         [frames]*samples) if i]
+        if len(found) < samples / 2:
+            return
+        x0 = min([x for w,h,x,y in found])
+        y0 = min([y for w,h,x,y in found])
+        x1 = max([x+w for w,h,x,y in found])
+        y1 = max([y+h for w,h,x,y in found])
+        w, h = x1 - x0, y1 - y0
+        if (self.width - w < self.width * min_crop and 
+            self.height - h < self.height * min_crop):
+            return
+        self.crop_area = (w, h, x0, y0)
+        # the cropped picture keeps the source's pixel aspect ratio
+        self.dar = self.dar * (w / self.width) / (h / self.height)
+    
+    def get_crop_sample(self, seek, frames):
+        cmd = ['ffmpeg', '-hide_banner', '-nostats', '-ss', str(seek), 
+               '-i', self.in_file, '-map', '0:v:0', '-frames:v', str(frames), 
+               '-filter:v', 'cropdetect=24:2:0', '-an', '-f', 'null', '-']
+        out = runner.run(cmd, pool='ffmpeg', stdout=runner.DEVNULL, 
+                         stderr=runner.PIPE, 
+                         universal_newlines=True).stderr
+        crops = re.findall(r'crop=(\d+):(\d+):(\d+):(\d+)', out)
+        if not crops:
+            return None
+        w,h,x,y = [int(i) for i in crops[-1]]
+        if w <= 0 or h <= 0:
+            return None
+        return (w,h,x,y)
+    
+    def is_expensive_to_decode(self):
+        '''Returns True if decoding (and scaling) the source is likely to be 
+        slow compared to the mpeg2 encode itself, e.g., HEVC or 10-bit HD.
+        '''
+        self.get_codec_info()
+        return is_expensive_to_decode(self.width, self.height, self.v_format, 
+                                      self.bit_depth)
+    
+    def setup_intermediate(self):
+        '''Decide whether to decode and scale the source only once.  
+        
+        When enabled, the first pass also writes the decoded, scaled video 
+        to a lossless intermediate file (sharing a single decode via the 
+        split filter), and the second pass reads the intermediate instead 
+        of the source.
+        '''
+        if (self.copy_v or self.film or not self.two_pass 
+            or self.intermediate == 'never'):
+            self.use_intermediate = False
+        elif self.intermediate == 'always':
+            self.use_intermediate = True
+        else:
+            self.use_intermediate = self.is_expensive_to_decode()
+    
+    def get_intermediate_size_estimate(self):
+        '''Returns a rough size in bytes of the intermediate file (see 
+        setup_intermediate).
+        '''
+        return get_intermediate_size(self.duration or 0, self.dvd_format)
+    
     def calculate_scaling(self):
         if self.aspect == '4:3':
             self.display_ar = 4/3
@@ -163,6 +363,9 @@ class Encoder (object):
             self.fps = 30000/1001
             self.fps_str = '29.97'
             self.ffmpeg_target = 'ntsc-dvd'
+            if self.film:
+                # displayed at 29.97 through the soft pulldown flags
+                self.fps = 24000/1001
             if self.aspect == '4:3':
                 self.display_width = 640
                 self.display_height = 480
@@ -191,6 +394,10 @@ class Encoder (object):
                                                      self.pad_y)
 
         self.vf = '{},{}'.format(self.scale, self.pad)
+        if self.crop_area:
+            self.vf = 'crop={}:{}:{}:{},{}'.format(*self.crop_area, self.vf)
+        if self.film == 'telecined':
+            self.vf = 'fieldmatch,decimate,{}'.format(self.vf)
         print('-filter:v {}'.format(self.vf))
     
     def write_srt(self):
@@ -235,6 +442,8 @@ class Encoder (object):
     
     def build_cmd(self, passnum, args_only=False):
         passnum = str(passnum)
+        if self.film and passnum == '2':
+            return self.build_film_mux_cmd(args_only)
         enc_opts = [{'-target': self.ffmpeg_target},
                         {'-aspect': self.aspect},
                         {'-filter:v': self.vf},
@@ -251,14 +460,39 @@ class Encoder (object):
                         {'-b:a': self.abitrate},
                         {'-acodec': 'ac3'},
                         {'-ac': '2'}]
+        if self.copy_v:
+            # -target would try to re-encode/filter the video, so set up
+            # the dvd muxer directly
+            enc_opts = [{'-f': 'dvd'},
+                        {'-muxrate': '10080000'},
+                        {'-packetsize': '2048'},
+                        {'-aspect': self.aspect},
+                        {'-vcodec': 'copy'},
+                        {'-sn': None},
+                        {'-strict': '1'},
+                        {'-b:a': self.abitrate},
+                        {'-acodec': 'ac3'},
+                        {'-ar': '48000'},
+                        {'-ac': '2'}]
+        if self.copy_a:
+            enc_opts = [i for i in enc_opts 
+                        if list(i)[0] not in ['-b:a', '-acodec', '-ar', '-ac']]
+            enc_opts.append({'-acodec': 'copy'})
+        if self.use_intermediate:
+            # the intermediate is already scaled/padded
+            enc_opts = [i for i in enc_opts if list(i)[0] != '-filter:v']
         if not args_only:
-            args = ['ffmpeg']
-            if self.in_files_cat:
-                args.extend(['-f', 'concat', '-i', self.cat_file])
-            else:
-                args.extend(['-i', self.in_file])
+            args = ['ffmpeg'] + self.get_input_args(passnum)
         else:
             args = []
+        if self.use_intermediate and passnum == '1':
+            split = '[0:v:0]{},split=2[enc][cache]'.format(self.vf)
+            args.extend(['-filter_complex', split, 
+                         '-map', '[enc]', '-map', '0:a:0?'])
+        else:
+            # the first audio track, the one copy_a was decided from (left 
+            # to itself, ffmpeg picks the one with the most channels)
+            args.extend(['-map', '0:v:0', '-map', '0:a:0?'])
         [args.extend([str(k), str(v)]) if v is not None else args.extend([str(k)]) 
          for i in enc_opts for (k,v) in i.items()]
         
@@ -266,15 +500,95 @@ class Encoder (object):
             args.extend(['-pass', passnum, '-passlogfile', self.log_file])
         return args
     
-    def encode(self):
+    def build_film_cmd(self):
+        '''Returns the commands for decoding film video to 23.976 fps 
+        yuv4mpeg and encoding it with mpeg2enc, which (unlike ffmpeg) can 
+        set the 3:2 pulldown flags.  mpeg2enc writes the video to stdout, 
+        to be muxed by the final pass (see build_film_mux_cmd).
+        
+        mpeg2enc encodes in a single pass at a constant bitrate, so film 
+        is never encoded in two passes.
+        '''
+        decode = (['ffmpeg'] + self.get_input_args() + 
+                  ['-map', '0:v:0', '-filter:v', self.vf, 
+                   '-r', '24000/1001', '-pix_fmt', 'yuv420p', 
+                   '-f', 'yuv4mpegpipe'])
+        aspect = '3' if self.aspect == '16:9' else '2'
+        kbps = min(math.floor(int(self.vbitrate) / 1000), 9800)
+        encode = ['mpeg2enc', '-f', '8', '-n', 'n', '-F', '1', '-p', 
+                  '-a', aspect, '-b', str(kbps), '-o', '/dev/stdout']
+        return decode, encode
+    
+    def build_film_mux_cmd(self, args_only=False):
+        '''Returns the command for muxing the pulldown-flagged video from 
+        mpeg2enc (read from stdin) with the (re-encoded) audio of the 
+        source.
+        '''
+        args = [] if args_only else ['ffmpeg', '-f', 'mpeg2video', 
+                                     '-i', 'pipe:0']
+        if not args_only:
+            args.extend(self.get_input_args())
+        args.extend(['-map', '0:v:0', '-map', '1:a:0?', 
+                     '-f', 'dvd', '-muxrate', '10080000', 
+                     '-packetsize', '2048', '-vcodec', 'copy'])
+        if self.copy_a:
+            args.extend(['-acodec', 'copy'])
+        else:
+            args.extend(['-b:a', str(self.abitrate), '-acodec', 'ac3', 
+                         '-ar', '48000', '-ac', '2'])
+        return args
+    
+    def get_passes(self):
+        if self.two_pass:
+            return 2
+        return 1
+    
+    def get_input_args(self, passnum='1'):
+        if self.use_intermediate and str(passnum) == '2':
+            return ['-i', self.intermediate_file]
+        args = []
+        if self.sample:
+            start, length = self.sample
+            args.extend(['-ss', str(start), '-t', str(length)])
+        if self.in_files_cat:
+            return args + ['-f', 'concat', '-i', self.cat_file]
+        return args + ['-i', self.in_file]
+    
+    def get_intermediate_args(self):
+        return ['-map', '[cache]', '-map', '0:a:0?', 
+                '-codec:v', 'ffvhuff', '-pix_fmt', 'yuv420p', 
+                '-codec:a', 'copy', self.intermediate_file]
+    
+    def encode(self, out_fh=None):
+        self.encode_first_pass()
+        return self.encode_final_pass(out_fh)
+    
+    @trace.traced('encode')
+    def encode_first_pass(self):
         if self.two_pass:
-            first_pass = self.build_cmd(1) + ['-y', '/dev/null']
-            print('First pass: \n{}\n'.format(' '.join(first_pass)))
+            first_pass = self.build_cmd(1)
+            out_args = ['-y', '/dev/null']
+            if self.use_intermediate:
+                out_args += self.get_intermediate_args()
+            print('First pass: \n{}\n'.format(' '.join(first_pass + 
+                                                       out_args)))
             if not self.dry_run:
-                subprocess.check_call(first_pass)
-        
+                p = self.start_ffmpeg(first_pass, out_args, 1)
+                self.wait_ffmpeg(p)
+    
+    @trace.traced('encode')
+    def encode_final_pass(self, out_fh=None):
+        '''Run the final pass.  If out_fh is given, the mpeg2 stream is 
+        written to it (e.g., a named pipe read by dvdauthor) instead of 
+        self.out_file.
+        '''
         final_pass = self.build_cmd(2)
+        passnum = self.get_passes()
         if self.dry_run:
+            if self.film:
+                decode, encode = self.build_film_cmd()
+                print('Film video: \n{} - | {} |\n'.format(' '.join(decode), 
+                                                           ' '.join(encode)))
             print('\n{}\n\nSecond pass: \n{}\n'.format('='*78 , 
                                                        ' '.join(final_pass)))
             return None
@@ -286,19 +600,165 @@ class Encoder (object):
             spu = ['spumux', '-s0', self.subs_xml]
             cmd_str = '{} | {}'.format(' '.join(fp), ' '.join(spu))
             print('\n{}\n\nSecond pass: \n{}\n'.format('='*78 , cmd_str))
-            with open(self.out_file, 'w') as f:
-                p1 = subprocess.Popen(final_pass+['-'], 
-                                      stdout=subprocess.PIPE)
-                p2 = subprocess.Popen(['spumux', '-s0', self.subs_xml], 
-                                      stdin=p1.stdout, stdout=f, env=e)
+            f = open(self.out_file, 'w') if out_fh is None else out_fh
+            with runner.slot('ffmpeg'):
+                p1 = self.start_final_pass(final_pass, ['-'], passnum, 
+                                           stdout=runner.PIPE)
+                p2 = runner.Popen(['spumux', '-s0', self.subs_xml], 
+                                  stdin=p1.stdout, stdout=f, env=e, 
+                                  log=self.out_log)
                 p1.stdout.close()
+                self.wait_ffmpeg(p1)
                 out,err = p2.communicate()
+            if out_fh is None:
+                f.close()
+        elif out_fh is not None:
+            print('\n{}\n\nSecond pass: \n{}\n'.format('='*78 , 
+                                                       ' '.join(final_pass+['-'])))
+            with runner.slot('ffmpeg'):
+                p = self.start_final_pass(final_pass, ['-'], passnum, 
+                                          stdout=out_fh)
+                self.wait_ffmpeg(p)
         else:
             print('\n{}\n\nSecond pass: \n{}\n'.format('='*78 , 
                                                        ' '.join(final_pass+[self.out_file])))
-            subprocess.check_call(final_pass+[self.out_file])
+            with runner.slot('ffmpeg'):
+                p = self.start_final_pass(final_pass, ['-y', self.out_file], 
+                                          passnum)
+                self.wait_ffmpeg(p)
+        if os.path.exists(self.intermediate_file):
+            os.remove(self.intermediate_file)
         return self.out_file
-                
+    
+    @trace.traced('encode')
+    def encode_sample(self, start, length):
+        '''Encode a short segment of the input with the same settings as 
+        a full encode, writing to separate files that are removed afterwards.
+        
+        Returns:    (wall time in seconds, size of the output in bytes)
+        '''
+        attrs = ['out_file', 'log_file', 'intermediate_file', 
+                 'progress_callback', 'sample']
+        saved = {k: getattr(self, k) for k in attrs}
+        base = os.path.join(self.out_dir, '{}.sample'.format(self.out_name))
+        self.out_file = '{}.mpg'.format(base)
+        self.log_file = '{}.log'.format(base)
+        self.intermediate_file = '{}.intermediate.mkv'.format(base)
+        self.progress_callback = None
+        self.sample = (start, length)
+        try:
+            if os.path.exists(self.out_file):
+                os.remove(self.out_file)
+            started = time.time()
+            self.encode()
+            wall = time.time() - started
+            size = os.path.getsize(self.out_file)
+        finally:
+            for i in [self.out_file, self.intermediate_file]:
+                if os.path.exists(i):
+                    os.remove(i)
+            for k,v in saved.items():
+                setattr(self, k, v)
+        return wall, size
+    
+    def start_final_pass(self, args, out_args, passnum, stdout=None):
+        '''Start the final pass ffmpeg.  For film, the decode | mpeg2enc 
+        pipeline (see build_film_cmd) is started first and piped into it, 
+        so the mpeg2 video never goes through a temp file.  Call while 
+        holding an ffmpeg slot, so the pipeline counts as one command.
+        '''
+        if not self.film:
+            return self.start_ffmpeg(args, out_args, passnum, stdout=stdout)
+        decode, encode = self.build_film_cmd()
+        print('Film video: \n{} - | {} |\n'.format(' '.join(decode), 
+                                                   ' '.join(encode)))
+        p1 = runner.Popen(decode + ['-'], stdout=runner.PIPE, 
+                          stdin=runner.DEVNULL, log=self.out_log)
+        p2 = runner.Popen(encode, stdin=p1.stdout, stdout=runner.PIPE, 
+                          log=self.out_log)
+        p1.stdout.close()
+        try:
+            p = self.start_ffmpeg(args, out_args, passnum, stdout=stdout, 
+                                  stdin=p2.stdout)
+        except:
+            for i in [p1, p2]:
+                i.kill()
+                i.wait()
+            raise
+        finally:
+            p2.stdout.close()
+        p.upstream = [p1, p2]
+        return p
+    
+    def start_ffmpeg(self, args, out_args, passnum, stdout=None, stdin=None):
+        '''Start ffmpeg with its -progress output sent to a pipe that is 
+        read by wait_ffmpeg.
+        '''
+        r, w = os.pipe()
+        cmd = args + ['-nostats', '-progress', 'pipe:{}'.format(w)] + out_args
+        p = runner.Popen(cmd, pool='ffmpeg', log=self.out_log, 
+                         stdout=stdout, stdin=stdin, pass_fds=[w])
+        os.close(w)
+        p.progress_pipe = os.fdopen(r)
+        p.passnum = passnum
+        p.upstream = []
+        return p
+    
+    def wait_ffmpeg(self, p):
+        '''Consume the -progress output of an ffmpeg process started with 
+        start_ffmpeg until it exits, updating self.progress (and calling 
+        self.progress_callback) after every progress report.
+        '''
+        passes = self.get_passes()
+        start = time.time()
+        report = {}
+        with p.progress_pipe as pipe:
+            for line in pipe:
+                k, sep, v = line.strip().partition('=')
+                if not sep:
+                    continue
+                report[k] = v
+                if k == 'progress':
+                    self.update_progress(report, p.passnum, passes, start)
+                    report = {}
+        # the commands piped into it (see start_final_pass) end with it
+        for i in [p] + p.upstream:
+            if i.wait() != 0:
+                raise runner.CalledProcessError(i.returncode, i.args)
+    
+    def update_progress(self, report, passnum, passes, start):
+        elapsed = time.time() - start
+        out_time = report.get('out_time_us', report.get('out_time_ms'))
+        try:
+            out_time = int(out_time) / 1000000
+        except (TypeError, ValueError):
+            out_time = 0
+        try:
+            fps = float(report.get('fps'))
+        except (TypeError, ValueError):
+            fps = 0
+        try:
+            size = int(report.get('total_size'))
+        except (TypeError, ValueError):
+            size = 0
+        speed = out_time / elapsed if elapsed else 0
+        if self.duration and speed:
+            eta = max(self.duration - out_time, 0) / speed
+        else:
+            eta = None
+        self.progress = {'pass': passnum,
+                         'passes': passes,
+                         'frame': report.get('frame'),
+                         'fps': fps,
+                         'speed': speed,
+                         'bytes': size,
+                         'time': out_time,
+                         'duration': self.duration,
+                         'elapsed': elapsed,
+                         'eta': eta,
+                         'done': report.get('progress') == 'end'}
+        if self.progress_callback:
+            self.progress_callback(self.progress)
         
 def main():
     enc = Encoder(get_args=True)
@@ -6,11 +6,29 @@
 #  The full license is in the file LICENSE, distributed with this software.
 #
 
-import subprocess
+from izdvd import runner
+from izdvd import trace
+from izdvd import imgstore
 import os.path
 import shutil
-import tempfile
+import struct
+import zlib
 import math
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# format of the versions written by Img operations.  MIFF is uncompressed
+# and lossless, so only the final images (see BG.resize_imgs) pay for png
+# compression.
+TMP_FMT = 'miff'
+
+# text measurements (see TextImg.measure), shared by all TextImgs
+_SIZE_CACHE = {}
+# candidates measured by one convert command
+MEASURE_BATCH = 100
 
 
 class Error(Exception):
@@ -19,33 +37,28 @@ class Error(Exception):
 
 
 class Img (object):
-    def __init__(self, path=None, ext='png'):
+    def __init__(self, path=None, ext=TMP_FMT):
         self.uid = str(id(self))
+        imgstore.register(self)
         self.ext = ext
         self.versions = []
         self.update_versions(path)
         self.orig_name = self.name
         self.orig_ext = self.ext
+        self.dims = None
         if path is not None:
-            self.tmpdir = os.path.join(tempfile.gettempdir(), __name__, 
-                                       self.orig_name+self.uid)
-            self.width = self.get_width()
-            self.height = self.get_height()
+            self.width, self.height = self.get_dims()
             self.orig_width = self.width
             self.orig_height = self.height
             self.ar = self.width / self.height
             self.orig_ar = self.ar
         else:
-            self.tmpdir = os.path.join(tempfile.gettempdir(), __name__, 
-                                       self.uid)
             self.width = None
             self.height = None
             self.orig_width = None
             self.orig_height = None
             self.ar = None
             self.orig_ar = None
-        if not os.path.exists(self.tmpdir):
-            os.makedirs(self.tmpdir)
         self.x_offset = 0
         self.y_offset = 0
     
@@ -55,6 +68,7 @@ class Img (object):
         self.path = new_version
         self.versions.append(new_version)
         if new_version is not None:
+            imgstore.add(new_version)
             self.basename = os.path.basename(self.path)
             self.name, self.ext = os.path.splitext(self.basename)
         else:
@@ -63,25 +77,47 @@ class Img (object):
     
     def get_tmpfile(self, suffix, out_fmt):
         filename = '{}_{}.{}'.format(self.name, suffix, out_fmt)
-        out_file = os.path.join(self.tmpdir, filename)
+        out_file = imgstore.get_tmpfile(self, filename)
         return out_file
 
+    def get_dims(self):
+        '''Returns (width, height) of the current version.  identify -ping 
+        reads only the header, and the result is kept until the file 
+        changes.
+        '''
+        st = os.stat(self.path)
+        key = (self.path, st.st_mtime_ns, st.st_size)
+        if self.dims is None or self.dims[0] != key:
+            o = runner.check_output(['identify', '-ping', '-format', 
+                                     '%w %h\\n', self.path], 
+                                    universal_newlines=True,
+                                    pool='imagemagick')
+            w, h = o.splitlines()[0].split()
+            self.dims = (key, (int(w), int(h)))
+        return self.dims[1]
+    
     def get_width(self):
-        w = subprocess.check_output(['identify', '-format', '%w', self.path], 
-                                    universal_newlines=True)
-        w = int(w.strip())
-        return w
+        return self.get_dims()[0]
 
     def get_height(self):
-        h = subprocess.check_output(['identify', '-format', '%h', self.path], 
-                                    universal_newlines=True)
-        h = int(h.strip())
-        return h
+        return self.get_dims()[1]
     
     def update_dims(self):
-        self.width = self.get_width()
-        self.height = self.get_height()
+        self.width, self.height = self.get_dims()
         return (self.width, self.height)
+    
+    def get_load_opts(self, width=None, height=None):
+        '''Returns options to put before the current version in a convert
+        command that scales it down to width x height.  For jpeg files this
+        lets libjpeg decode at a fraction of the size (to no less than 
+        twice the target, so the final resize still has enough detail).
+        '''
+        if os.path.splitext(self.path)[1].lower() not in ['.jpg', '.jpeg', 
+                                                          '.jpe']:
+            return []
+        if not width or not height:
+            return []
+        return ['-define', 'jpeg:size={}x{}'.format(width*2, height*2)]
         
     def clear_offsets(self):
         '''Resets any saved offset information.  Any future operations which 
@@ -91,24 +127,23 @@ class Img (object):
         self.x_offset = 0
         self.y_offset = 0
     
+    @trace.traced('img')
     def write(self, overwrite=False, out_file=None, suffix_name=True, 
               backup=True):
         if overwrite:
             if backup:
                 bak = shutil.move(self.versions[0], self.versions[0]+'.bak')
-            written = shutil.copy(self.path, self.versions[0])
+            written = self.copy_to(self.versions[0])
             self.update_versions(written)
             return written
         
         if out_file is None:
-            out_dir = self.tmpdir
             if suffix_name is True:
                 out_basename = self.basename
             else:
                 out_basename = self.orig_name+self.ext
-            out_file = os.path.join(out_dir, out_basename)
-        else:
-            out_dir = os.path.dirname(out_file)
+            out_file = imgstore.get_tmpfile(self, out_basename)
+        out_dir = os.path.dirname(out_file)
         if not os.path.exists(out_dir):
             os.makedirs(out_dir)
         if os.path.exists(out_file):
@@ -116,36 +151,63 @@ class Img (object):
                 return out_file
             else:
                 bak = shutil.move(out_file, out_file+'.bak')
-        written = shutil.copy(self.path, out_file)
+        written = self.copy_to(out_file)
         self.update_versions(written)
         return written
     
+    def copy_to(self, out_file):
+        '''Copy the current version to out_file, converting it if out_file 
+        has a different extension.
+        '''
+        in_ext = os.path.splitext(self.path)[1].lower()
+        out_ext = os.path.splitext(out_file)[1].lower()
+        if in_ext == out_ext:
+            return shutil.copy(self.path, out_file)
+        o = runner.check_output(['convert', self.path, out_file], 
+                                universal_newlines=True,
+                                pool='imagemagick')
+        return out_file
+    
+    def load_version(self, path, suffix):
+        '''Add a copy of path (e.g., an image from thumbcache) as a new 
+        version.
+        '''
+        out_fmt = os.path.splitext(path)[1][1:]
+        out_file = self.get_tmpfile(suffix, out_fmt)
+        shutil.copy(path, out_file)
+        self.update_versions(out_file)
+        return out_file
+    
     def show(self, version_idx=None):
         if version_idx is None:
             path = self.path
         else:
             path = self.versions[version_idx]
         cmd = ['display', path]
-        subprocess.check_call(cmd)
+        runner.check_call(cmd)
     
-    def transcode(self, out_file=None, out_fmt='png'):
+    @trace.traced('img')
+    def transcode(self, out_file=None, out_fmt=TMP_FMT):
         if out_file is None:
             out_file = self.get_tmpfile('tc', out_fmt)
-        o = subprocess.check_output(['convert', self.path, out_file], 
-                                    universal_newlines=True)
+        o = runner.check_output(['convert', self.path, out_file], 
+                                universal_newlines=True,
+                                pool='imagemagick')
         self.update_versions(out_file)
         return out_file
     
+    @trace.traced('img')
     def get_colors(self):
-        out_file = self.get_tmpfile('colors', 'png')
-        o = subprocess.check_output(['convert', self.path, '-unique-colors', 
-                                    out_file])
+        out_file = self.get_tmpfile('colors', TMP_FMT)
+        o = runner.check_output(['convert', self.path, '-unique-colors', 
+                                 out_file], pool='imagemagick')
         self.colors = out_file
         return out_file
     
+    @trace.traced('img')
     def resize(self, width=None, height=None, ignore_aspect=False, 
                no_antialias=False, no_dither=False, colors=None, remap=None, 
-               out_file=None, out_fmt='png'):
+               out_file=None, out_fmt=TMP_FMT):
         if out_file is None:
             out_file = self.get_tmpfile('{}x{}'.format(width, height), out_fmt)
         flags=''
@@ -157,7 +219,8 @@ class Img (object):
             height = self.get_height()
         size = '{}x{}{}'.format(width, height, flags)
         
-        cmd = ['convert', self.path, '-resize', size]
+        cmd = (['convert'] + self.get_load_opts(width, height) + 
+               [self.path, '-resize', size])
         if no_antialias:
             cmd += ['+antialias']
         if no_dither:
@@ -169,12 +232,54 @@ class Img (object):
         if remap:
             cmd += ['-remap', remap]
         
-        o = subprocess.check_output(cmd + [out_file], universal_newlines=True)
+        o = runner.check_output(cmd + [out_file], universal_newlines=True,
+                                pool='imagemagick')
+        self.update_versions(out_file)
+        return out_file
+    
+    @trace.traced('img')
+    def resize_indexed(self, width, height, canvas_height=None, colors=4, 
+                       out_file=None):
+        '''Resize to width x height (ignoring aspect) with nearest-neighbour 
+        sampling and write an indexed png with no more than colors colors, 
+        as spumux requires for subpictures.  If canvas_height is given, the 
+        result is centered on a transparent canvas that high.
+        
+        With numpy, sampling and snapping to the palette are done 
+        in-process (see get_indexed).  Without it, ImageMagick is used 
+        (resize with remap, then pad_to).
+        '''
+        if numpy is None:
+            fmt = TMP_FMT if canvas_height else 'png'
+            self.resize(width=width, height=height, ignore_aspect=True, 
+                        remap=True, no_antialias=True, no_dither=True, 
+                        out_fmt=fmt)
+            if canvas_height:
+                self.pad_to(new_h=canvas_height, out_fmt='png')
+            return self.path
+        if out_file is None:
+            out_file = self.get_tmpfile('{}x{}'.format(width, height), 'png')
+        src_w, src_h = self.get_dims()
+        raw = runner.check_output(['convert', self.path, '-depth', '8', 
+                                   'rgba:-'], pool='imagemagick')
+        px = numpy.frombuffer(raw, dtype=numpy.uint8).reshape(src_h, src_w, 4)
+        # sample the center of each new pixel
+        ys = ((numpy.arange(height) + .5) * src_h / height).astype(int)
+        xs = ((numpy.arange(width) + .5) * src_w / width).astype(int)
+        px = px[ys[:, None], xs]
+        if canvas_height and canvas_height > height:
+            top = (canvas_height - height) // 2
+            canvas = numpy.zeros((canvas_height, width, 4), numpy.uint8)
+            canvas[top:top+height] = px
+            px = canvas
+        indices, palette = get_indexed(px, colors)
+        write_indexed_png(out_file, indices, palette)
         self.update_versions(out_file)
         return out_file
     
+    @trace.traced('img')
     def pad(self, color='none', north=0, south=0, east=0, west=0, 
-            out_file=None, out_fmt='png'):
+            out_file=None, out_fmt=TMP_FMT):
         if out_file is None:
             out_file = self.get_tmpfile('padded', out_fmt)
         splice_opts = []
@@ -188,11 +293,12 @@ class Img (object):
         cmd = ['convert', self.path, '-background', color]
         cmd.extend(splice_opts)
         cmd.append(out_file)
-        o = subprocess.check_output(cmd, universal_newlines=True)
+        o = runner.check_output(cmd, universal_newlines=True,
+                                pool='imagemagick')
         self.update_versions(out_file)
 
     def pad_centered(self, color='none', pad_x=0, pad_y=0, out_file=None, 
-                     out_fmt='png'):
+                     out_fmt=TMP_FMT):
         if out_file is None:
             out_file = self.get_tmpfile('padded', out_fmt)
         new_w = self.get_width() + pad_x
@@ -200,8 +306,9 @@ class Img (object):
         self.pad_to(color=color, new_w=new_w, new_h=new_h, out_file=out_file,
                     out_fmt=out_fmt)
 
+    @trace.traced('img')
     def pad_to(self, color='none', new_w=None, new_h=None, gravity='center',
-                     out_file=None, out_fmt='png'):
+                     out_file=None, out_fmt=TMP_FMT):
         if out_file is None:
             out_file = self.get_tmpfile('padded', out_fmt)
         if new_w is None:
@@ -209,13 +316,15 @@ class Img (object):
         if new_h is None:
             new_h = self.get_height()
         extent_dims = '{}x{}'.format(new_w, new_h)
-        o = subprocess.check_output(['convert', self.path, '-gravity', gravity,
-                                     '-background', color, '-extent', 
-                                     extent_dims, out_file], 
-                                    universal_newlines=True)
+        o = runner.check_output(['convert', self.path, '-gravity', gravity,
+                                 '-background', color, '-extent', 
+                                 extent_dims, out_file], 
+                                universal_newlines=True,
+                                pool='imagemagick')
         self.update_versions(out_file)
     
-    def pad_to_ar(self, ar, color='none', out_file=None, out_fmt='png'):
+    @trace.traced('img')
+    def pad_to_ar(self, ar, color='none', out_file=None, out_fmt=TMP_FMT):
         if out_file is None:
             out_file = self.get_tmpfile('pad_ar', out_fmt)
         if ar > self.ar:
@@ -228,8 +337,9 @@ class Img (object):
             return
         self.pad_to(color, new_w, new_h, out_file, out_fmt)
     
+    @trace.traced('img')
     def border(self, geometry, color='none', shave=False, 
-               out_file=None, out_fmt='png'):
+               out_file=None, out_fmt=TMP_FMT):
         if out_file is None:
             out_file = self.get_tmpfile('border', out_fmt)
         if shave:
@@ -237,10 +347,11 @@ class Img (object):
         else:
             border_cmd = '-border'
         before_w, before_h = self.update_dims()
-        o = subprocess.check_output(['convert', self.path, '-compose', 'Copy', 
-                                     '-bordercolor', color, border_cmd, 
-                                     str(geometry), out_file], 
-                                    universal_newlines=True)
+        o = runner.check_output(['convert', self.path, '-compose', 'Copy', 
+                                 '-bordercolor', color, border_cmd, 
+                                 str(geometry), out_file], 
+                                universal_newlines=True,
+                                pool='imagemagick')
         self.update_versions(out_file)
         new_w, new_h = self.update_dims()
         new_x_offset = (new_w-before_w)/2
@@ -249,17 +360,24 @@ class Img (object):
         self.y_offset += new_y_offset
         return out_file
     
+    @trace.traced('img')
     def drop_shadow(self, color='black', opacity=80, sigma=3, 
-                    x_offset=5, y_offset=5, out_file=None, out_fmt='png'):
+                    x_offset=5, y_offset=5, out_file=None, out_fmt=TMP_FMT):
         if out_file is None:
             out_file = self.get_tmpfile('shadow', out_fmt)
         shadow_opts = '{}x{}{:+}{:+}'.format(opacity, sigma, x_offset, y_offset)
-        o = subprocess.check_output(['convert', self.path, '(', '+clone', 
-                                     '-background', color, '-shadow', 
-                                     shadow_opts, ')', '+swap', '-background', 
-                                     'none', '-layers', 'merge', '+repage', 
-                                     out_file], 
-                                    universal_newlines=True)
+        o = runner.check_output(['convert', self.path, '(', '+clone', 
+                                 '-background', color, '-shadow', 
+                                 shadow_opts, ')', '+swap', '-background', 
+                                 'none', '-layers', 'merge', '+repage', 
+                                 out_file], 
+                                universal_newlines=True,
+                                pool='imagemagick')
+        self.add_shadow_offsets(sigma, x_offset, y_offset)
+        self.update_versions(out_file)
+        return out_file
+    
+    def add_shadow_offsets(self, sigma, x_offset, y_offset):
         # calculate new offset (cannot be less than 0)
         canvas_padding = sigma*2
         new_x_offset = canvas_padding - x_offset
@@ -271,8 +389,6 @@ class Img (object):
         # add new offset to existing offset
         self.x_offset += new_x_offset
         self.y_offset += new_y_offset
-        self.update_versions(out_file)
-        return out_file
     
     def overlay_onto(self, img, x_offset, y_offset, layers_method):
         '''Overlay self onto img. Does not modify self or create a new version.
@@ -280,8 +396,9 @@ class Img (object):
         '''
         pass
     
+    @trace.traced('img')
     def new_layer(self, img, x_offset, y_offset, use_orig_origin=False, 
-                  layers_method='merge', out_file=None, out_fmt='png'):
+                  layers_method='merge', out_file=None, out_fmt=TMP_FMT):
         '''Overlay img onto self.  Modifies self and adds a new version with
         img composed onto self (and flattened).  Does not modify img.
         Returns:  self (with new layer flattened onto canvas)
@@ -295,12 +412,13 @@ class Img (object):
                 y_offset -= img.y_offset
             img = img.path
         offsets = '{:+}{:+}'.format(x_offset, y_offset)
-        o = subprocess.check_output(['convert', self.path, 
-                                     '-background', 'none', 
-                                     '-page', offsets, img, 
-                                     '-layers', layers_method, '+repage', 
-                                     out_file], 
-                                    universal_newlines=True)
+        o = runner.check_output(['convert', self.path, 
+                                 '-background', 'none', 
+                                 '-page', offsets, img, 
+                                 '-layers', layers_method, '+repage', 
+                                 out_file], 
+                                universal_newlines=True,
+                                pool='imagemagick')
         if x_offset < 0:
             self.x_offset += abs(x_offset)
         if y_offset < 0:
@@ -308,17 +426,20 @@ class Img (object):
         self.update_versions(out_file)
         return out_file
     
-    def new_canvas(self, color='none', out_file=None, out_fmt='png'):
+    @trace.traced('img')
+    def new_canvas(self, color='none', out_file=None, out_fmt=TMP_FMT):
         if out_file is None:
             out_file = self.get_tmpfile('canvas', out_fmt)
-        o = subprocess.check_output(['convert', self.path, '-background', 
-                                     color, '-compose', 'Dst', '-flatten', 
-                                     out_file], 
-                                    universal_newlines=True)
+        o = runner.check_output(['convert', self.path, '-background', 
+                                 color, '-compose', 'Dst', '-flatten', 
+                                 out_file], 
+                                universal_newlines=True,
+                                pool='imagemagick')
         return Img(out_file)
     
+    @trace.traced('img')
     def append(self, img_list, vertical=True, gravity='center', 
-               background='none', padding=0, out_file=None, out_fmt='png'):
+               background='none', padding=0, out_file=None, out_fmt=TMP_FMT):
         if out_file is None:
             out_file = self.get_tmpfile('new_layer', out_fmt)
         imgs = [i.path if isinstance(i, type(self)) else i for i in img_list]
@@ -338,12 +459,13 @@ class Img (object):
             append_op = '-'
         else:
             append_op = '+'
-        o = subprocess.check_output(['convert', self.path, 
-                                     '-background', background,
-                                     '-gravity', gravity] 
-                                     + imgs 
-                                     + ['{}append'.format(append_op), out_file], 
-                                    universal_newlines=True)
+        o = runner.check_output(['convert', self.path, 
+                                 '-background', background,
+                                 '-gravity', gravity] 
+                                 + imgs 
+                                 + ['{}append'.format(append_op), out_file], 
+                                universal_newlines=True,
+                                pool='imagemagick')
         self.update_versions(out_file)
         return out_file
 
@@ -469,24 +591,100 @@ class TextImg(Img):
         return cmd
     
     def get_size(self, text=None, pts=None, interword_spacing=None):
-        cmd_h = self.get_annotate_opts(text=self.ref_text, pts=pts, size=None,
-                                      interword_spacing=interword_spacing,
-                                      use_undercolor=True,
-                                      clear_inner_stroke=False)
-        cmd_h += ['-trim', 'info:']
-        cmd_w = self.get_annotate_opts(text=text, pts=pts, size=None,
-                                      interword_spacing=interword_spacing,
-                                      use_undercolor=True,
-                                      clear_inner_stroke=False)
-        cmd_w += ['-trim', 'info:']
-        out_h = subprocess.check_output(cmd_h, universal_newlines=True,
-                                        stderr=subprocess.DEVNULL)
-        out_w = subprocess.check_output(cmd_w, universal_newlines=True,
-                                        stderr=subprocess.DEVNULL)
-        z,h,z,y = out_h.split(';')
-        w,z,x,z = out_w.split(';')
-        return (int(w), int(h), int(x), int(y))
+        '''Returns (w, h, x, y): the width and x offset of text, and the 
+        height and y offset of self.ref_text, when drawn at pts.
+        '''
+        if text is None:
+            text = self.text
+        (z,h,z,y), (w,z,x,z) = self.measure([(self.ref_text, pts, 
+                                              interword_spacing),
+                                             (text, pts, interword_spacing)])
+        return (w, h, x, y)
+    
+    def get_measure_key(self, text, pts=None, interword_spacing=None):
+        if pts is None:
+            pts = self.pts
+        if interword_spacing is None:
+            interword_spacing = self.interword_spacing
+        opts = self.get_common_opts(interword_spacing=interword_spacing)
+        return (tuple(opts), text, pts)
+    
+    @trace.traced('img')
+    def measure(self, candidates):
+        '''Measure the trimmed size of each (text, pts, interword_spacing) 
+        candidate.  Candidates that have not been measured before (by any 
+        TextImg with the same options) are measured together, with one 
+        convert command per MEASURE_BATCH of them.
+        
+        Returns:    list of (w, h, x, y), one for each candidate
+        '''
+        keys = [self.get_measure_key(*i) for i in candidates]
+        missing = {}
+        for k,c in zip(keys, candidates):
+            if k not in _SIZE_CACHE:
+                missing.setdefault(k, c)
+        missing = list(missing.items())
+        for n in range(0, len(missing), MEASURE_BATCH):
+            batch = missing[n:n+MEASURE_BATCH]
+            sizes = self.run_measure([c for k,c in batch])
+            for (k,c), size in zip(batch, sizes):
+                _SIZE_CACHE[k] = size
+        return [_SIZE_CACHE[k] for k in keys]
     
+    def run_measure(self, candidates):
+        # each candidate is drawn and trimmed in its own parentheses, then
+        # info: prints a line for each of them
+        cmd = ['convert', '-respect-parentheses']
+        for text, pts, interword_spacing in candidates:
+            opts = self.get_annotate_opts(text=text, pts=pts, size=None,
+                                          interword_spacing=interword_spacing,
+                                          use_undercolor=True,
+                                          clear_inner_stroke=False)
+            # without 'convert' and the -format setting
+            cmd += ['('] + opts[1:-2] + ['-trim', ')']
+        cmd += ['-format', '%w;%h;%X;%Y\\n', 'info:']
+        out = runner.check_output(cmd, universal_newlines=True,
+                                  stderr=runner.DEVNULL,
+                                  pool='imagemagick')
+        sizes = [tuple([int(v) for v in i.split(';')]) 
+                 for i in out.splitlines() if i]
+        if len(sizes) != len(candidates):
+            raise Error('Expected {} text sizes from convert, got {}'.format(
+                            len(candidates), len(sizes)))
+        return sizes
+    
+    def prefetch_line(self, words, pts=None, interword_spacing=None):
+        '''Measure the prefixes of words that _split_lines may try for a 
+        line starting with words[0], up to the first that cannot fit in 
+        max_width (assuming no character is narrower than a quarter of 
+        pts).
+        '''
+        if pts is None:
+            pts = self.pts
+        candidates = [(self.ref_text, pts, interword_spacing)]
+        for n in range(1, len(words)+1):
+            text = ' '.join(words[:n])
+            candidates.append((text, pts, interword_spacing))
+            if len(text) * pts * .25 > self.max_width:
+                break
+        self.measure(candidates)
+    
+    def prefetch_labels(self, texts):
+        '''Measure the first lines of other labels that will be made with 
+        the same options and line height as this one (see 
+        BG.create_labels).
+        '''
+        candidates = []
+        for text in texts:
+            words = text.split(' ')
+            for n in range(1, len(words)+1):
+                line = ' '.join(words[:n])
+                candidates.append((line, self.pts_orig, 0))
+                if len(line) * self.pts_orig * .25 > self.max_width:
+                    break
+        self.measure(candidates)
+    
+    @trace.traced('img')
     def write(self, cmd=None, out_file=None):
         if len(self.lines['used']) > 1:
             self.append_lines()
@@ -503,14 +701,15 @@ class TextImg(Img):
             if self.out_file:
                 out_file = self.out_file
             else:
-                out_file = os.path.join(self.tmpdir, self.basename)
+                out_file = imgstore.get_tmpfile(self, self.basename)
         out_dir = os.path.dirname(out_file)
         if out_dir:
             if not os.path.exists(out_dir):
                 os.makedirs(out_dir)
         
         cmd = cmd + [out_file]
-        output = subprocess.check_output(cmd, universal_newlines=True)
+        output = runner.check_output(cmd, universal_newlines=True,
+                                     pool='imagemagick')
         self.update_versions(out_file)
         
         if self.line_height:
@@ -541,7 +740,8 @@ class TextImg(Img):
             line_imgs.append(img)
         self.line_imgs = line_imgs
     
-    def append_lines(self, out_file=None, out_fmt='png'):
+    @trace.traced('img')
+    def append_lines(self, out_file=None, out_fmt=TMP_FMT):
         if out_file is None:
             out_file = self.get_tmpfile('wrapped', out_fmt)
         if not self.line_imgs:
@@ -551,7 +751,8 @@ class TextImg(Img):
         bottom = li[1:]
         append_cmd = ['convert', top, '-background', self.background, 
                       '-gravity', self.gravity] + bottom + ['-append', out_file]
-        o = subprocess.check_output(append_cmd, universal_newlines=True)
+        o = runner.check_output(append_cmd, universal_newlines=True,
+                                pool='imagemagick')
         self.update_versions(out_file)
         print(out_file)
         return out_file
@@ -561,14 +762,18 @@ class TextImg(Img):
             cmd = ['display', self.path]
         else:
             cmd = cmd + ['show:']
-        subprocess.check_call(cmd)
+        runner.check_call(cmd)
     
     def get_pts_from_lh(self):
+        # only the height of ref_text is needed, and it is the same for 
+        # every label with the same options
+        self.measure([(self.ref_text, p, None) 
+                      for p in range(1, self.line_height+2)])
         results = []
         pts = 0
         while True:
             pts += 1
-            w,h,x,y = self.get_size(pts=pts)
+            w,h,x,y = self.measure([(self.ref_text, pts, None)])[0]
             results.append((pts, h))
             if h > self.line_height:
                 pt_size = pts - 1
@@ -580,6 +785,7 @@ class TextImg(Img):
         default = zero - one + 1
         return default
     
+    @trace.traced('img')
     def wrap_text(self):
         self._fit_wrapping()
         self._maximize_pts()
@@ -623,6 +829,7 @@ class TextImg(Img):
     def _split_lines(self, text, pts=None, interword_spacing=None):
         words = text.split(' ')
         lines = [{'line':[], 'trim':False}]
+        self.prefetch_line(words, pts, interword_spacing)
         while words:
             w = words.pop(0)
             width, h,x,y = self.get_size(' '.join(lines[-1]['line'] + [w]), pts,
@@ -640,6 +847,7 @@ class TextImg(Img):
                     break
                 else:
                     lines.append({'line':[w], 'trim':False})
+                    self.prefetch_line([w] + words, pts, interword_spacing)
         return {'used': lines, 'unused': words}
     
     def _get_trimmed_len(self, line, force=False, pts=None, 
@@ -651,7 +859,13 @@ class TextImg(Img):
                                     interword_spacing=interword_spacing)
         if width <= self.max_width:
             return False
+        # measure the candidates down to a bit less than the length that 
+        # fits if characters are about the same width
+        fit = len(text) * self.max_width / width
         text = ' '.join(line)
+        self.measure([(text[:len(text)-i]+'...', pts, interword_spacing) 
+                      for i in range(len(text)+1) 
+                      if len(text) - i + 3 >= fit * .75])
         for i in range(len(text)+1):
             width,h,x,y = self.get_size(text[:len(text)-i]+'...', pts=pts, 
                                     interword_spacing=interword_spacing)
@@ -752,14 +966,103 @@ class CanvasImg(Img):
         super(CanvasImg, self).__init__()
         self.write_canvas()
     
-    def write_canvas(self, out_file=None, out_fmt='png'):
+    @trace.traced('img')
+    def write_canvas(self, out_file=None, out_fmt=TMP_FMT):
         if out_file is None:
             out_file = self.get_tmpfile('canvas', out_fmt)
-        o = subprocess.check_output(['convert', 
-                                     '-size', '{}x{}'.format(*self.size),
-                                     'xc:{}'.format(self.color),
-                                     out_file], universal_newlines=True)
+        o = runner.check_output(['convert', 
+                                 '-size', '{}x{}'.format(*self.size),
+                                 'xc:{}'.format(self.color),
+                                 out_file], universal_newlines=True,
+                                pool='imagemagick')
         self.update_versions(out_file)
         return out_file
 
 
+def drop_shadows(imgs, color='black', opacity=80, sigma=3, x_offset=5, 
+                 y_offset=5):
+    '''Like Img.drop_shadow for each of imgs, but the shadow (the blur) is 
+    made only once for each distinct size and alpha channel, and all of it
+    is done by a single convert command.
+    
+    Returns:    number of distinct shadows made
+    '''
+    if not imgs:
+        return 0
+    with trace.span('drop_shadows', 'img'):
+        # the shadow only depends on the alpha channel (and the options)
+        o = runner.check_output(['convert'] + [i.path for i in imgs] + 
+                                ['-alpha', 'extract', 
+                                 '-format', '%w %h %#\\n', 'info:'], 
+                                universal_newlines=True,
+                                pool='imagemagick')
+        keys = o.split()
+        keys = [tuple(keys[n:n+3]) for n in range(0, len(keys), 3)]
+        if len(keys) != len(imgs):
+            raise Error('Expected {} alpha signatures from convert, '
+                        'got {}'.format(len(imgs), len(keys)))
+        shadow_opts = '{}x{}{:+}{:+}'.format(opacity, sigma, x_offset, 
+                                             y_offset)
+        shadows = {}
+        cmd = ['convert', '-respect-parentheses']
+        for img, key in zip(imgs, keys):
+            if key not in shadows:
+                shadows[key] = 'mpr:shadow{}'.format(len(shadows))
+                cmd += ['(', img.path, '-background', color, 
+                        '-shadow', shadow_opts, 
+                        '-write', shadows[key], '+delete', ')']
+        out_files = []
+        for img, key in zip(imgs, keys):
+            out_file = img.get_tmpfile('shadow', TMP_FMT)
+            cmd += ['(', shadows[key], img.path, '-background', 'none', 
+                    '-layers', 'merge', '+repage', 
+                    '-write', out_file, '+delete', ')']
+            out_files.append(out_file)
+        cmd += ['null:']
+        runner.check_call(cmd, pool='imagemagick')
+        for img, out_file in zip(imgs, out_files):
+            img.add_shadow_offsets(sigma, x_offset, y_offset)
+            img.update_versions(out_file)
+    return len(shadows)
+
+def get_indexed(px, colors=4):
+    '''Returns (indices, palette) for an RGBA numpy array: a 2d array of 
+    palette indices and an array of no more than colors RGBA entries.  
+    Pixels less than half opaque become transparent, the rest opaque, and 
+    colors other than the most common ones are snapped to the nearest of 
+    those.
+    '''
+    h, w = px.shape[:2]
+    px = px.copy()
+    clear = px[..., 3] < 128
+    px[clear] = 0
+    px[~clear, 3] = 255
+    packed = numpy.ascontiguousarray(px).view(numpy.uint32).ravel()
+    values, inverse, counts = numpy.unique(packed, return_inverse=True, 
+                                           return_counts=True)
+    palette = values.view(numpy.uint8).reshape(-1, 4)
+    if len(values) > colors:
+        keep = numpy.argsort(counts)[::-1][:colors]
+        diff = palette[:, None, :].astype(int) - palette[keep][None, :, :]
+        nearest = numpy.argmin((diff ** 2).sum(axis=2), axis=1)
+        palette = palette[keep]
+        inverse = nearest[inverse]
+    return inverse.reshape(h, w).astype(numpy.uint8), palette
+
+def write_indexed_png(path, indices, palette):
+    '''Write an 8-bit indexed png (with a tRNS chunk for the palette's 
+    alpha).
+    '''
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data + 
+                struct.pack('>I', zlib.crc32(kind + data)))
+    h, w = indices.shape
+    # filter type 0 (none) at the start of each row
+    rows = numpy.hstack([numpy.zeros((h, 1), numpy.uint8), indices])
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 3, 0, 0, 0)))
+        f.write(chunk(b'PLTE', palette[:, :3].tobytes()))
+        f.write(chunk(b'tRNS', palette[:, 3].tobytes()))
+        f.write(chunk(b'IDAT', zlib.compress(rows.tobytes(), 9)))
+        f.write(chunk(b'IEND', b''))
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2013 William Adams
+#  Distributed under the terms of the Modified BSD License.
+#  The full license is in the file LICENSE, distributed with this software.
+#
+
+'''Temp files for the versions of Img objects.
+
+Every Img operation writes a new version of the image.  New versions are
+written to a memory tier (a workspace on /dev/shm) while the versions
+there fit in the memory budget, and to the images workspace on disk
+otherwise.  collect removes the versions that no Img can reach any more;
+it runs when each image stage of BG (and DVDMenu) finishes.
+'''
+
+from izdvd import workspace
+from izdvd import config
+import threading
+import functools
+import tempfile
+import weakref
+import gc
+import os
+
+
+SHM_DIR = '/dev/shm'
+MEMORY_BUDGET = 256*1024*1024
+
+_LOCK = threading.Lock()
+# Imgs, and the dirs made for them, by the thread that made them
+_IMGS = {}
+_DIRS = {}
+# sizes of the versions in the memory tier
+_SIZES = {}
+_SHM = None
+
+
+def set_memory_budget(budget):
+    '''Change the space the versions in the memory tier may use (0 to keep
+    every version on disk).
+    '''
+    global MEMORY_BUDGET
+    MEMORY_BUDGET = budget
+
+def get_shm():
+    '''Returns the memory tier's workspace, or None if there is none.'''
+    global _SHM
+    with _LOCK:
+        if _SHM is None:
+            _SHM = False
+            if os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK):
+                try:
+                    root = os.path.join(SHM_DIR, config.PROG_NAME)
+                    _SHM = workspace.Workspace(root, 'images')
+                except OSError:
+                    pass
+        return _SHM or None
+
+def get_memory_used():
+    with _LOCK:
+        return sum(_SIZES.values())
+
+def use_memory():
+    if not MEMORY_BUDGET:
+        return False
+    shm = get_shm()
+    if shm is None:
+        return False
+    used = get_memory_used()
+    if used >= MEMORY_BUDGET:
+        return False
+    # leave at least as much free as is used, since tmpfs is ram
+    s = os.statvfs(shm.path)
+    return s.f_frsize * s.f_bavail > used
+
+def register(img):
+    img.tmpdirs = {}
+    with _LOCK:
+        _IMGS.setdefault(threading.get_ident(), weakref.WeakSet()).add(img)
+
+def get_tmpfile(img, filename):
+    '''Returns a path for a new version of img, in the memory tier when
+    there is room for it.
+    '''
+    tier = 'memory' if use_memory() else 'disk'
+    d = img.tmpdirs.get(tier)
+    if d is None:
+        if tier == 'memory':
+            root = get_shm().path
+        else:
+            root = workspace.get_images_dir()
+        d = tempfile.mkdtemp(prefix='{}.'.format(img.orig_name), dir=root)
+        img.tmpdirs[tier] = d
+        with _LOCK:
+            _DIRS[d] = threading.get_ident()
+    return os.path.join(d, filename)
+
+def add(path):
+    '''Count a new version in the memory tier's usage.'''
+    shm = get_shm()
+    if shm is None or not path.startswith(shm.path + os.sep):
+        return
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return
+    with _LOCK:
+        _SIZES[path] = size
+
+def collect():
+    '''Remove the versions made by this thread that are not the current,
+    original or palette version of an Img that still exists.
+    
+    Returns:    number of files removed
+    '''
+    # Imgs in reference cycles (e.g. TextImg) are only freed by gc
+    gc.collect()
+    tid = threading.get_ident()
+    with _LOCK:
+        imgs = list(_IMGS.get(tid, []))
+        dirs = [d for d,t in _DIRS.items() if t == tid]
+    keep = set()
+    live_dirs = set()
+    for i in imgs:
+        keep.update([i.path, getattr(i, 'colors', None)] + i.versions[:1])
+        live_dirs.update(i.tmpdirs.values())
+    removed = 0
+    for d in dirs:
+        try:
+            names = os.listdir(d)
+        except OSError:
+            names = []
+        for n in names:
+            path = os.path.join(d, n)
+            if path in keep:
+                continue
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+            with _LOCK:
+                _SIZES.pop(path, None)
+        if d not in live_dirs:
+            try:
+                os.rmdir(d)
+                with _LOCK:
+                    del _DIRS[d]
+            except OSError:
+                pass
+    for i in imgs:
+        i.versions = [v for v in i.versions if v is None or os.path.exists(v)]
+    return removed
+
+def collects(func):
+    '''Decorator that runs collect when a method returns.'''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            collect()
+    return wrapper
@@ -8,8 +8,11 @@
 from izdvd.bg import BG
 from izdvd.dvdmenu import DVDMenu
 from izdvd.dvd import DVD
+from izdvd.planner import DiscSet
 from izdvd.utils import ArgumentParser, HelpFormatter, format_help
 from izdvd import config
+from izdvd import trace
+from izdvd import metrics
 import re
 import os
 import os.path
@@ -22,6 +25,20 @@ LOGGER.addHandler(logging.StreamHandler())
 LOGGER.setLevel(logging.INFO)
 
 def get_options(mode='dvd', prog=None, export=False, export_width=100):
+    parser = get_parser(mode, prog)
+    options = parser.parse_args()
+    
+    if export:
+        help_doc = format_help(parser, width=export_width)
+        return help_doc
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit()
+
+    return options
+
+def get_parser(mode='dvd', prog=None):
     desc = {}
     desc['dvd'] = '''Make an authored DVD with menu.  Outputs a VIDEO_TS 
                      directory with DVD video files as well as a "files" 
@@ -54,17 +71,7 @@ def get_options(mode='dvd', prog=None, export=False, export_width=100):
         add_menu_opts(parser, mode)
         add_out_paths_opts(parser, mode)
     
-    options = parser.parse_args()
-    
-    if export:
-        help_doc = format_help(parser, width=export_width)
-        return help_doc
-
-    if len(sys.argv) == 1:
-        parser.print_help()
-        sys.exit()
-
-    return options
+    return parser
 
 def add_in_paths_opts(parser, mode='dvd'):
     desc = {}
@@ -109,7 +116,17 @@ def add_in_paths_opts(parser, mode='dvd'):
                                           file or as a color name/value, e.g., 
                                           "white" or "#ffffff".  (default: 
                                           %(default)s)""")
+    if mode in ['menu']:
+        in_files.add_argument('--menu-vids', metavar='PATH', nargs='+', 
+                                  help="""Videos to play inside the menu 
+                                          buttons (one per menu-img, in the 
+                                          same order), for a motion menu.  
+                                          Needs numpy.""")
     if mode in ['dvd', 'menu']:
+        in_files.add_argument('--menu-bg-vid', metavar='PATH', 
+                                  help="""Video to play behind the menu 
+                                          buttons, for a motion menu 
+                                          (optional).  Needs numpy.""")
         in_files.add_argument('-a', '--menu-audio', metavar='PATH', 
                                  help="""Audio file to be used as audio for
                                          the menu (optional).  If this option 
@@ -167,6 +184,19 @@ def add_in_opts(parser, mode='dvd'):
     in_opts.add_argument('--no-encode-v', action='store_true',
                              help="""Skip encoding of video files.  Assume 
                                      video files are DVD compliant mpeg2.""")
+    in_opts.add_argument('--no-encode-a', action='store_true',
+                             help="""Skip encoding of audio.  Assume the 
+                                     audio is DVD compliant ac3, mp2 or 
+                                     lpcm at 48kHz.""")
+    in_opts.add_argument('--no-auto-passthrough', action='store_false',
+                             dest='auto_passthrough', default=True,
+                             help="""Normally, video and audio streams that 
+                                     are already DVD compliant (mpeg2 video 
+                                     at a DVD resolution/frame rate/aspect 
+                                     ratio, ac3/mp2/lpcm audio at 48kHz) are 
+                                     detected automatically and remuxed 
+                                     instead of being re-encoded.  This 
+                                     option re-encodes everything.""")
     in_opts.add_argument('--unstack-vids', action='store_true',
                              help='''Treat multiple input video files as a
                                      single video when their names only 
@@ -202,6 +232,40 @@ def add_dvd_opts(parser, mode='dvd'):
     dvd_opts.add_argument('--no-two-pass', action='store_false', default=True,
                               dest='two_pass',
                               help="""Don't use two-pass encoding.""")
+    dvd_opts.add_argument('--intermediate', default='auto', 
+                              choices=['auto', 'always', 'never'],
+                              help="""With two-pass encoding, decode and 
+                                      scale the source only once, during the 
+                                      first pass, into a lossless 
+                                      intermediate file that the second pass 
+                                      reads from.  This needs a lot of temp 
+                                      space but saves time with sources that 
+                                      are slow to decode (HEVC, 10-bit, 
+                                      4K).  With "auto" it is only used for 
+                                      such sources.  The temp dir is sized 
+                                      for the largest title that uses it, 
+                                      at roughly 10 MB per second of video.  
+                                      It is not used with --low-disk, or for 
+                                      a title whose intermediate would not 
+                                      fit in the temp space (or 
+                                      --tmp-budget).  (default: 
+                                      %(default)s)""")
+    dvd_opts.add_argument('--no-ivtc', action='store_const', const='never',
+                              default='auto', dest='ivtc',
+                              help="""Normally, NTSC film sources (23.976 fps
+                                      progressive, or 29.97 fps with 3:2 
+                                      pulldown) are encoded at 23.976 fps 
+                                      with soft pulldown flags, which is 
+                                      faster and gives better quality for 
+                                      the same bitrate.  This option always 
+                                      encodes at 29.97 fps.""")
+    dvd_opts.add_argument('--no-crop', action='store_const', const='never',
+                              default='auto', dest='crop',
+                              help="""Normally, black bars that are part of 
+                                      the source video (e.g., letterboxed 
+                                      video) are detected and cropped before 
+                                      scaling, then replaced with padding.  
+                                      This option disables the detection.""")
     dvd_opts.add_argument('--no-separate-titlesets', action='store_false', 
                               default=True, dest='separate_titlesets',
                               help="""By default, the DVD will be made with 
@@ -226,6 +290,12 @@ def add_dvd_opts(parser, mode='dvd'):
                                       until a title is selected.  With this
                                       option the menu plays once and then 
                                       starts playing the first title.""")
+    dvd_opts.add_argument('--motion-menu', action='store_true', 
+                              default=False, 
+                              help="""Make a motion menu: each button plays 
+                                      a clip of its title (starting 10%% of 
+                                      the way in) instead of showing a still 
+                                      image.  Needs numpy.""")
     dvd_opts.add_argument('--no-menu', action='store_false', dest='with_menu', 
                               default=True,
                               help="""Don't make a menu for the DVD""")
@@ -234,6 +304,13 @@ def add_dvd_opts(parser, mode='dvd'):
                               help="""Output an xml file that can be used 
                                       with dvdauthor, but don't actually 
                                       create the DVD files""")
+    dvd_opts.add_argument('--low-disk', action='store_true', default=False,
+                              help="""Stream the encoded video directly into 
+                                      dvdauthor through named pipes instead 
+                                      of writing intermediate mpeg2 files to 
+                                      the temp directory.  Roughly halves the 
+                                      amount of data written to disk and 
+                                      needs almost no temp space.""")
     dvd_opts.add_argument('--dvd-size', type=int, default=4700372992, 
                               dest='dvd_size_bytes', metavar='BYTES', 
                               help="""Size of DVD media in bytes. The default 
@@ -245,6 +322,24 @@ def add_dvd_opts(parser, mode='dvd'):
                                       DVD+R DL= 8547991552.  (default: 
                                       %(default)s)""")
 
+    dvd_opts.add_argument('--min-vbitrate', metavar='BPS', type=int,
+                              help="""Minimum acceptable video bitrate in 
+                                      bits per second.  If the videos do not
+                                      fit on one DVD at this bitrate, they 
+                                      are split (in order) across as many 
+                                      DVDs as needed, each made in its own 
+                                      subdirectory of the output 
+                                      directory.""")
+    dvd_opts.add_argument('--size-margin', type=float, default=.02, 
+                              metavar='FRACTION',
+                              help="""Fraction of the DVD size to keep free
+                                      when calculating the video bitrate.  
+                                      The bitrate of the remaining titles is 
+                                      recalculated from the actual size of 
+                                      each encoded title, and titles are 
+                                      re-encoded if the DVD would still 
+                                      overflow. (default: %(default)s)""")
+
 def add_menu_opts(parser, mode='dvd'):
     bg_opts = parser.add_argument_group(title='Menu Options')
 
@@ -336,6 +431,25 @@ def add_menu_opts(parser, mode='dvd'):
                                      is the same as the value given with 
                                      --button-highlight-thickness. 
                                      (default: %(default)s)""")
+    if mode in ['dvd']:
+        bg_opts.add_argument('--menu-page-size', type=int, metavar='N', 
+                                 default=12,
+                                 help="""Maximum number of titles on each 
+                                         page of the menu.  With more 
+                                         titles than this, the menu is 
+                                         split into pages (as evenly as 
+                                         possible) linked by 
+                                         previous/next buttons.  0 puts 
+                                         every title on one page.  
+                                         (default: %(default)s)""")
+    bg_opts.add_argument('--menu-preview', action='store_true', 
+                             default=False,
+                             help="""Only render a low resolution preview 
+                                     of the menu layout (background, 
+                                     buttons, labels and highlight) to 
+                                     <out-name>_preview.png and exit.  
+                                     Much faster than making the menu, for 
+                                     trying out layout options.""")
 
 def add_output_opts(parser, mode='dvd'):
     out_opts = parser.add_argument_group(title='Output Options')
@@ -345,6 +459,12 @@ def add_output_opts(parser, mode='dvd'):
                                        option overrides that behavior and
                                        causes the script to run 
                                        uninterrupted.""")
+    out_opts.add_argument('--estimate', action='store_true', default=False,
+                               help="""Encode a few short samples of each 
+                                       video to estimate how long encoding 
+                                       will take and how large the result 
+                                       will be, then exit without making 
+                                       the DVD.""")
 
 def add_out_paths_opts(parser, mode='dvd'):
     out_files = parser.add_argument_group(title='Output Paths')
@@ -355,15 +475,47 @@ def add_out_paths_opts(parser, mode='dvd'):
                                        files, etc.) By default /tmp, or 
                                        whatever tempfile.gettempdir() returns 
                                        will be used if there is enough space 
-                                       available.""")
+                                       available.  Each run makes its own 
+                                       directory inside it, so runs can 
+                                       share a temp directory.""")
+    if mode == 'dvd':
+        out_files.add_argument('--tmp-budget', metavar='MiB', type=float, 
+                                   help="""Maximum temp space the run may 
+                                           use.  The run stops with an error 
+                                           before encoding a title that 
+                                           would go over it.  (default: the 
+                                           dvd size plus 20%%, or 300 MiB 
+                                           with --low-disk)""")
     out_files.add_argument('-n', '--out-name', metavar='NAME',
                                help="""Base name prefix for generated files 
                                        (menu, log, etc)""")
+    out_files.add_argument('--trace', metavar='PATH', dest='trace_file',
+                               help="""Write a timeline of the run (each 
+                                       stage, image operation and external 
+                                       command) to PATH in the Chrome trace 
+                                       format, for viewing in 
+                                       chrome://tracing or 
+                                       https://ui.perfetto.dev""")
+    out_files.add_argument('--metrics-file', metavar='PATH',
+                               help="""Write metrics (stage durations, titles 
+                                       encoded, encoding speed, commands 
+                                       run, disc utilisation, etc) to PATH in 
+                                       the Prometheus text format after each 
+                                       stage and at exit, e.g. for 
+                                       node_exporter's textfile 
+                                       collector.""")
 
 # ----------------------------------------------------------------------------
 
 def make_dvd(options):
-    dvd = DVD(**vars(options))
+    opts = vars(options)
+    min_vbitrate = opts.pop('min_vbitrate')
+    if opts.get('tmp_budget'):
+        opts['tmp_budget'] = int(opts['tmp_budget'] * 1024 * 1024)
+    if min_vbitrate:
+        return DiscSet(min_vbitrate=min_vbitrate, **opts)
+    else:
+        return DVD(**opts)
 
 def make_menu(options):
     menu = DVDMenu(**vars(options))
@@ -378,12 +530,19 @@ def export_help(mode='dvd', width=100):
 
 def main(mode='dvd'):
     options = get_options(mode=mode)
+    trace_file = vars(options).pop('trace_file')
+    if trace_file:
+        trace.enable(trace_file)
+    metrics_file = vars(options).pop('metrics_file')
+    if metrics_file:
+        metrics.enable(metrics_file)
     if mode == 'dvd':
         make_dvd(options)
     elif mode == 'menu':
         make_menu(options)
     elif mode == 'bg':
         make_bg(options)
+    metrics.set_value('izdvd_run_success', 1)
     return 0
 
 if __name__ == '__main__':
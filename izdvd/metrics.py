@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2013 William Adams
+#  Distributed under the terms of the Modified BSD License.
+#  The full license is in the file LICENSE, distributed with this software.
+#
+
+'''Optional metrics file for monitoring unattended runs.
+
+When enabled (see enable), metrics are written in the Prometheus text
+format at the end of each stage and when the process exits, so that the
+file can be picked up by node_exporter's textfile collector.  The file is
+replaced atomically, so a half written file is never collected.  When it
+is not enabled, recording metrics does nothing.
+'''
+
+import threading
+import atexit
+import copy
+import time
+import os
+
+
+STAGE_BUCKETS = [.1, .5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200, 14400]
+FPS_BUCKETS = [5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500]
+
+METRICS = {
+    'izdvd_run_start_timestamp_seconds':
+        ('gauge', 'Time the run started.', None),
+    'izdvd_run_last_update_timestamp_seconds':
+        ('gauge', 'Time this file was last written.', None),
+    'izdvd_run_success':
+        ('gauge', '1 if the run finished without an error.', None),
+    'izdvd_stage_duration_seconds':
+        ('histogram', 'Duration of each stage.', STAGE_BUCKETS),
+    'izdvd_titles_encoded_total':
+        ('counter', 'Titles encoded (or remuxed) to mpeg2.', None),
+    'izdvd_title_bytes_total':
+        ('counter', 'Bytes of encoded titles written.', None),
+    'izdvd_encode_fps':
+        ('histogram', 'Average encoding speed of each title: frames over '
+                      'the wall time of all its passes.',
+         FPS_BUCKETS),
+    'izdvd_cache_hits_total':
+        ('counter', 'Cache lookups that were answered from the cache.', None),
+    'izdvd_cache_misses_total':
+        ('counter', 'Cache lookups that were not.', None),
+    'izdvd_subprocesses_total':
+        ('counter', 'External commands run.', None),
+    'izdvd_subprocess_failures_total':
+        ('counter', 'External commands that exited with an error.', None),
+    'izdvd_subprocess_bytes_written_total':
+        ('counter', 'Bytes written by external commands.', None),
+    'izdvd_disc_used_bytes':
+        ('gauge', 'Size of the authored DVD.', None),
+    'izdvd_disc_capacity_bytes':
+        ('gauge', 'Capacity of the target disc (dvd_size_bytes).', None),
+    'izdvd_disc_utilisation_ratio':
+        ('gauge', 'Size of the authored DVD as a fraction of capacity.', None),
+}
+
+_PATH = None
+_VALUES = {}
+_LOCK = threading.Lock()
+_WRITE_LOCK = threading.Lock()
+
+
+def enable(path):
+    '''Start recording metrics, written to path at the end of each stage
+    and when the process exits.
+    '''
+    global _PATH
+    if _PATH is None:
+        atexit.register(write)
+    _PATH = os.path.abspath(path)
+    set_value('izdvd_run_start_timestamp_seconds', time.time())
+    set_value('izdvd_run_success', 0)
+
+def enabled():
+    return _PATH is not None
+
+def get_key(labels):
+    return tuple(sorted(labels.items()))
+
+def inc(name, value=1, **labels):
+    if _PATH is None:
+        return
+    with _LOCK:
+        series = _VALUES.setdefault(name, {})
+        key = get_key(labels)
+        series[key] = series.get(key, 0) + value
+
+def set_value(name, value, **labels):
+    if _PATH is None:
+        return
+    with _LOCK:
+        _VALUES.setdefault(name, {})[get_key(labels)] = value
+
+def observe(name, value, **labels):
+    if _PATH is None:
+        return
+    buckets = METRICS[name][2]
+    with _LOCK:
+        series = _VALUES.setdefault(name, {})
+        key = get_key(labels)
+        if key not in series:
+            series[key] = {'buckets': [0] * len(buckets), 'sum': 0,
+                           'count': 0}
+        h = series[key]
+        for n,b in enumerate(buckets):
+            if value <= b:
+                h['buckets'][n] += 1
+        h['sum'] += value
+        h['count'] += 1
+
+def stage_finished(name, duration):
+    '''Record the duration of a stage and write the file.'''
+    if _PATH is None:
+        return
+    observe('izdvd_stage_duration_seconds', duration, stage=name)
+    write()
+
+def format_labels(labels, extra=None):
+    labels = list(labels) + (extra or [])
+    if not labels:
+        return ''
+    escaped = []
+    for k,v in labels:
+        v = str(v).replace('\\', r'\\').replace('"', r'\"')
+        escaped.append('{}="{}"'.format(k, v.replace('\n', r'\n')))
+    return '{{{}}}'.format(','.join(escaped))
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def get_lines():
+    lines = []
+    with _LOCK:
+        values = copy.deepcopy(_VALUES)
+    for name in sorted(values):
+        kind, help_text, buckets = METRICS[name]
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for labels, v in sorted(values[name].items()):
+            if kind != 'histogram':
+                lines.append('{}{} {}'.format(name, format_labels(labels),
+                                              format_value(v)))
+                continue
+            for b,count in zip(buckets + [float('inf')],
+                               v['buckets'] + [v['count']]):
+                le = [('le', format_value(b))]
+                lines.append('{}_bucket{} {}'.format(
+                                 name, format_labels(labels, le), count))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels),
+                                              format_value(v['sum'])))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels),
+                                                v['count']))
+    return lines
+
+def write(path=None):
+    path = path or _PATH
+    if path is None:
+        return
+    set_value('izdvd_run_last_update_timestamp_seconds', time.time())
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with _WRITE_LOCK:
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(get_lines()) + '\n')
+        os.replace(tmp, path)
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2013 William Adams
+#  Distributed under the terms of the Modified BSD License.
+#  The full license is in the file LICENSE, distributed with this software.
+#
+
+'''Motion menus.
+
+The menu video is made one frame at a time: each frame is the still menu
+(BG's background image, or its overlay image on top of a frame of a
+background video) with a frame of each button's video pasted into the
+button.  Videos are decoded by ffmpeg processes writing raw rgb24 frames
+to pipes, and the composited frames are converted to YUV 4:2:0 in-process
+and streamed to mpeg2enc in the YUV4MPEG format.  No frame is written to
+disk, and only one frame of each source is held in memory at a time.
+
+Every decoder runs at once, so a menu holds a slot in the ffmpeg pool for
+each of them and for mpeg2enc (see MotionMenu.encode).  A menu with more
+videos than the pool allows takes the whole pool, and runs with more
+processes than the limit.
+
+Needs numpy.
+'''
+
+from izdvd import runner
+from izdvd import trace
+import os
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Error(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+def get_video_params(dvd_format, menu_ar):
+    '''Returns the framerate, pixel aspect ratio (both as y4m ratios), and
+    the mpeg2enc norm and aspect code for a menu.
+    '''
+    if dvd_format == 'PAL':
+        framerate = '25:1'
+        pixel_aspect = '59:54'
+        fmt = 'p'
+    else:
+        framerate = '30000:1001'
+        pixel_aspect = '10:11'
+        fmt = 'n'
+    if menu_ar == 16/9:
+        aspect = '3'
+    else:
+        aspect = '2'
+    return framerate, pixel_aspect, fmt, aspect
+
+def read_rgb(path, width, height, alpha=False):
+    '''Returns the pixels of an image as a (height, width, 3 or 4) array.'''
+    fmt = 'rgba' if alpha else 'rgb'
+    raw = runner.check_output(['convert', path, '-depth', '8',
+                               '{}:-'.format(fmt)], pool='imagemagick')
+    return numpy.frombuffer(raw, dtype=numpy.uint8).reshape(height, width,
+                                                            len(fmt))
+
+def rgb_to_yuv420(frame):
+    '''Returns the Y, Cb and Cr planes (BT.601, studio range, chroma
+    averaged over each 2x2 block) of an rgb frame with even dimensions, as
+    bytes in the order YUV4MPEG expects.
+    '''
+    h, w = frame.shape[:2]
+    rgb = frame.astype(numpy.float32)
+    y = rgb @ numpy.array([65.481, 128.553, 24.966], numpy.float32) / 255
+    # chroma from the average colour of each 2x2 block
+    rgb = rgb.reshape(h//2, 2, w//2, 2, 3).mean(axis=(1, 3))
+    cb = rgb @ numpy.array([-37.797, -74.203, 112.0], numpy.float32) / 255
+    cr = rgb @ numpy.array([112.0, -93.786, -18.214], numpy.float32) / 255
+    planes = [y + 16, cb + 128, cr + 128]
+    return b''.join([numpy.clip(numpy.rint(i), 0, 255).astype(numpy.uint8)
+                     .tobytes() for i in planes])
+
+
+class FrameSource (object):
+    '''Raw rgb24 frames of a video from an ffmpeg pipe, cropped to fill
+    width x height.
+    
+    Args:
+        path (str):         video file
+        width (int):        frame width, in storage pixels
+        height (int):       frame height, in storage pixels
+        display_size (tuple):   (width, height) the frame is shown at; used
+                                to crop to the right aspect ratio (default:
+                                width, height)
+        framerate (str):    y4m framerate, e.g. '30000:1001'
+        start (float):      seconds into the video to start at
+        log (str):          path of a log file for ffmpeg's output
+    
+    The video is looped if it is shorter than the menu.
+    '''
+    def __init__(self, path, width, height, display_size=None,
+                 framerate='30000:1001', start=0, log=None):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.display_size = display_size or (width, height)
+        self.framerate = framerate.replace(':', '/')
+        self.start = start
+        self.log = log
+        self.frame_size = width * height * 3
+        self.last = None
+        self.open()
+    
+    def open(self):
+        dw, dh = self.display_size
+        vf = ['scale=iw*sar:ih', 'setsar=1',
+              'scale={}:{}:force_original_aspect_ratio=increase'.format(dw,
+                                                                        dh),
+              'crop={}:{}'.format(dw, dh),
+              'scale={}:{}'.format(self.width, self.height),
+              'fps={}'.format(self.framerate)]
+        cmd = ['ffmpeg', '-nostdin', '-loglevel', 'error',
+               '-stream_loop', '-1', '-ss', '{:.3f}'.format(self.start),
+               '-i', self.path, '-an', '-sn', '-vf', ','.join(vf),
+               '-pix_fmt', 'rgb24', '-f', 'rawvideo', '-']
+        self.proc = runner.Popen(cmd, stdout=runner.PIPE, log=self.log)
+    
+    def read(self):
+        '''Returns the next frame.  If the video ends early, its last frame
+        is repeated.
+        '''
+        data = self.proc.stdout.read(self.frame_size)
+        if len(data) == self.frame_size:
+            self.last = numpy.frombuffer(data, numpy.uint8).reshape(
+                self.height, self.width, 3)
+        elif self.last is None:
+            raise Error('No video frames could be decoded from {}'.format(
+                self.path))
+        return self.last
+    
+    def close(self):
+        self.proc.stdout.close()
+        if self.proc.poll() is None:
+            self.proc.terminate()
+        self.proc.wait()
+
+
+class MotionMenu (object):
+    '''Encodes a motion menu to an mpeg2 video file with mpeg2enc.
+    
+    Args:
+        bg (BG):            the menu's background, once it has been made
+        out_file (str):     path of the m2v file to write
+        button_vids (list): a video to play in each button (None for a
+                            button that keeps its image)
+        button_starts (list):   seconds into each button video to start at
+        bg_vid (str):       a video to play behind the buttons.  bg must
+                            have been made with_overlay.
+        frames (int):       length of the menu in frames
+        dvd_format (str):   'NTSC' or 'PAL'
+        menu_ar (float):    16/9 or 4/3
+        out_log (str):      path of a log file for the commands' output
+    '''
+    def __init__(self, bg, out_file, button_vids=None, button_starts=None,
+                 bg_vid=None, frames=360, dvd_format='NTSC', menu_ar=16/9,
+                 out_log=None):
+        if numpy is None:
+            raise Error('Motion menus need numpy')
+        self.bg = bg
+        self.out_file = out_file
+        self.button_vids = button_vids or []
+        self.button_starts = button_starts or [0 for i in self.button_vids]
+        self.bg_vid = bg_vid
+        self.frames = int(frames)
+        self.dvd_format = dvd_format
+        self.menu_ar = menu_ar
+        self.out_log = out_log
+        #------
+        self.get_params()
+        self.get_rects()
+        self.get_base()
+        self.encode()
+    
+    def get_params(self):
+        params = get_video_params(self.dvd_format, self.menu_ar)
+        self.framerate, self.pixel_aspect, self.fmt, self.aspect = params
+        self.width = int(self.bg.storage_width)
+        self.height = int(self.bg.storage_height)
+        self.x_scale = self.width / self.bg.display_width
+        self.y_scale = self.height / self.bg.display_height
+    
+    def get_rects(self):
+        '''Get the area of each button's image in the storage sized frame
+        (BG.button_rects are in display pixels).
+        '''
+        self.rects = []
+        for r in getattr(self.bg, 'button_rects', None) or []:
+            x0 = round(r['x'] * self.x_scale)
+            y0 = round(r['y'] * self.y_scale)
+            x1 = min(round((r['x'] + r['w']) * self.x_scale), self.width)
+            y1 = min(round((r['y'] + r['h']) * self.y_scale), self.height)
+            self.rects.append({'x0': x0, 'y0': y0, 'x1': x1, 'y1': y1,
+                               'display_size': (r['w'], r['h'])})
+    
+    @trace.traced()
+    def get_base(self):
+        '''Load the still parts of the menu: the background image, or with
+        a background video, the overlay with premultiplied alpha.
+        '''
+        if self.bg_vid:
+            if os.path.exists(self.bg.path_overlay_img):
+                overlay = read_rgb(self.bg.path_overlay_img, self.width,
+                                   self.height, alpha=True)
+            else:
+                # no buttons
+                overlay = numpy.zeros((self.height, self.width, 4),
+                                      numpy.uint8)
+            alpha = overlay[..., 3:].astype(numpy.float32) / 255
+            self.overlay = overlay[..., :3] * alpha
+            self.overlay_alpha = 1 - alpha
+            self.base = None
+        else:
+            self.base = read_rgb(self.bg.path_bg_img, self.width, self.height)
+    
+    def get_sources(self):
+        sources = []
+        for n,r in enumerate(self.rects):
+            vid = self.button_vids[n] if n < len(self.button_vids) else None
+            if vid is None:
+                sources.append(None)
+                continue
+            sources.append(FrameSource(vid, r['x1'] - r['x0'],
+                                       r['y1'] - r['y0'],
+                                       display_size=r['display_size'],
+                                       framerate=self.framerate,
+                                       start=self.button_starts[n],
+                                       log=self.out_log))
+        if self.bg_vid:
+            display = (round(self.bg.display_width),
+                       round(self.bg.display_height))
+            self.bg_source = FrameSource(self.bg_vid, self.width, self.height,
+                                         display_size=display,
+                                         framerate=self.framerate,
+                                         log=self.out_log)
+        else:
+            self.bg_source = None
+        return sources
+    
+    def get_frame(self, sources):
+        '''Returns the next composited rgb frame.'''
+        if self.bg_source is not None:
+            frame = self.bg_source.read() * self.overlay_alpha + self.overlay
+            frame = frame.astype(numpy.uint8)
+        else:
+            frame = self.base.copy()
+        for src, r in zip(sources, self.rects):
+            if src is not None:
+                frame[r['y0']:r['y1'], r['x0']:r['x1']] = src.read()
+        return frame
+    
+    def get_header(self):
+        return 'YUV4MPEG2 W{} H{} F{} Ip A{} C420mpeg2\n'.format(
+            self.width, self.height, self.framerate, self.pixel_aspect)
+    
+    def get_slot_count(self):
+        '''Returns the number of processes encode runs at once: a decoder
+        for each video and mpeg2enc.
+        '''
+        vids = [i for i in self.button_vids[:len(self.rects)] if i]
+        return len(vids) + bool(self.bg_vid) + 1
+    
+    @trace.traced()
+    def encode(self):
+        # the decoders and the encoder all run at once, so each takes a slot
+        # (capped at the pool's limit, see runner.slot)
+        with runner.slot('ffmpeg', count=self.get_slot_count()):
+            sources = self.get_sources()
+            opened = [i for i in sources + [self.bg_source] if i is not None]
+            cmd = ['mpeg2enc', '-n', self.fmt, '-f', '8', '-b', '5000',
+                   '-a', self.aspect, '-o', self.out_file]
+            p = runner.Popen(cmd, stdin=runner.PIPE, stdout=runner.LOG,
+                             log=self.out_log)
+            try:
+                p.stdin.write(self.get_header().encode())
+                for n in range(self.frames):
+                    p.stdin.write(b'FRAME\n')
+                    p.stdin.write(rgb_to_yuv420(self.get_frame(sources)))
+                p.stdin.close()
+            except BrokenPipeError:
+                # mpeg2enc exited early; its status is checked below
+                pass
+            except:
+                p.kill()
+                p.wait()
+                raise
+            finally:
+                for i in opened:
+                    i.close()
+            if p.wait():
+                raise runner.CalledProcessError(p.returncode, cmd)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2013 William Adams
+#  Distributed under the terms of the Modified BSD License.
+#  The full license is in the file LICENSE, distributed with this software.
+#
+
+from izdvd.dvd import DVD
+from izdvd import utils
+from izdvd import config
+from datetime import datetime
+import os
+import logging
+
+
+class Error(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class DiscSet (object):
+    '''Splits a set of videos that is too large to fit on one DVD at an
+    acceptable bitrate across as many discs as needed and makes each one.
+
+    Titles are kept in order (so stacked parts and titlesets stay together)
+    and divided into contiguous groups, balanced so that the largest disc
+    is as small as possible.  The input is probed only once; the probe
+    results are cached and reused when each disc is made.
+    '''
+    def __init__(self,
+                 min_vbitrate=2500000,
+                 menu_allowance=50*1024*1024,
+                 **dvd_opts):
+        self.min_vbitrate = min_vbitrate
+        self.menu_allowance = menu_allowance
+        self.dvd_opts = dvd_opts
+        self.logger = logging.getLogger('{}.discs'.format(config.PROG_NAME))
+        #----------
+        self.get_titles()
+        self.plan_discs()
+        self.log_plan()
+        self.make_discs()
+    
+    def get_titles(self):
+        opts = dict(self.dvd_opts)
+        opts['probe_only'] = True
+        self.probe = DVD(**opts)
+        self.titles = self.probe.vids
+        self.dvd_size_bytes = self.probe.dvd_size_bytes
+        self.abitrate = self.probe.abitrate
+    
+    def get_title_bits(self, vid):
+        '''Size of a title at the minimum acceptable bitrate.'''
+        if vid['copy_v']:
+            return sum([os.path.getsize(i) * 8 for i in vid['in']])
+        return vid['duration'] * (self.min_vbitrate + self.abitrate)
+    
+    def get_disc_capacity(self):
+        size = (self.dvd_size_bytes * (1 - self.probe.size_margin)
+                - self.menu_allowance)
+        return size * 8
+    
+    def plan_discs(self):
+        capacity = self.get_disc_capacity()
+        bits = [self.get_title_bits(i) for i in self.titles]
+        for n,b in enumerate(bits):
+            if b > capacity:
+                raise Error('"{}" does not fit on a DVD at {} bps'.format(
+                                self.titles[n]['vid_label'],
+                                self.min_vbitrate))
+        # fewest discs needed when filling them in order
+        discs = len(self.split_titles(bits, capacity))
+        # then find the smallest maximum disc size with that many discs
+        low = max(bits)
+        high = capacity
+        while high - low > 8*1024*1024:
+            mid = (low + high) / 2
+            if len(self.split_titles(bits, mid)) <= discs:
+                high = mid
+            else:
+                low = mid
+        groups = self.split_titles(bits, high)
+        self.discs = [[self.titles[i] for i in g] for g in groups]
+    
+    def split_titles(self, bits, max_bits):
+        '''Split titles (in order) into groups no larger than max_bits.
+
+        Returns:    list of lists of title indexes
+        '''
+        groups = [[]]
+        used = 0
+        for n,b in enumerate(bits):
+            if groups[-1] and used + b > max_bits:
+                groups.append([])
+                used = 0
+            groups[-1].append(n)
+            used += b
+        return groups
+    
+    def log_plan(self):
+        utils.log_items(heading='Disc Plan', items=[], lines_before=1,
+                        logger=self.logger)
+        for n,d in enumerate(self.discs):
+            duration = sum([i['duration'] for i in d])
+            log_data = [('Duration', self.probe.get_duration_string(duration)),
+                        ('Titles', [i['vid_label'] for i in d])]
+            utils.log_items('Disc #{} of {}'.format(n+1, len(self.discs)),
+                            lines_before=0, sep_pre='-', sep_post='-',
+                            logger=self.logger)
+            utils.log_items(log_data, col_width=12, indent=4, lines_before=0,
+                            logger=self.logger)
+    
+    def make_discs(self):
+        out_name = self.dvd_opts.get('out_name')
+        if not out_name:
+            out_time = datetime.now().strftime('%Y.%m.%d-%H%M%S')
+            out_name = '{}_{}'.format(config.PROG_NAME, out_time)
+        out_dir = self.dvd_opts.get('out_dir') or os.path.join(os.getcwd(), 
+                                                               out_name)
+        self.dvds = []
+        for n,d in enumerate(self.discs):
+            opts = dict(self.dvd_opts)
+            if len(self.discs) == 1:
+                opts['out_name'] = out_name
+            else:
+                opts['out_name'] = '{}_disc{}'.format(out_name, n+1)
+                opts['out_dir'] = os.path.join(out_dir, opts['out_name'])
+            opts['in_vids'] = [i['in'][0] for i in d]
+            opts['in_dirs'] = None
+            opts['unstack_vids'] = self.probe.unstack_vids
+            if self.probe.with_menu:
+                opts['menu_imgs'] = [i['img'] for i in d]
+            if self.probe.with_menu_labels:
+                opts['menu_labels'] = [i['menu_label'] for i in d]
+            if self.probe.with_subs:
+                opts['in_srts'] = [i['srt'][0] for i in d]
+            self.dvds.append(DVD(**opts))
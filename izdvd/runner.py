@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2013 William Adams
+#  Distributed under the terms of the Modified BSD License.
+#  The full license is in the file LICENSE, distributed with this software.
+#
+
+'''Runs every external command used by izdvd.
+
+Commands are started in named pools ('ffmpeg', 'imagemagick', 'mux') that
+limit how many of them run at once in this process (a pipeline run under 
+slot() counts as the number of slots it holds).  Each child is reaped
+with wait4 so that its wall time, user/sys cpu time and peak memory use can
+be recorded, both in a log file and in per-pool totals (see log_stats).
+'''
+
+from izdvd import utils
+from izdvd import trace
+from izdvd import metrics
+import subprocess
+from subprocess import PIPE, DEVNULL, STDOUT, CalledProcessError
+import threading
+import contextlib
+import time
+import os
+
+
+CPUS = os.cpu_count() or 1
+
+POOL_LIMITS = {'ffmpeg': max(1, CPUS // 2),
+               'imagemagick': CPUS,
+               'mux': 2}
+
+# use as stdout/stderr to send a child's output to its log file
+LOG = -10
+
+_POOLS = {}
+_LIMITS = {}
+# taken to acquire several slots of a pool at once (see slot)
+_MULTI_LOCKS = {}
+_POOLS_LOCK = threading.Lock()
+_LOCAL = threading.local()
+_STATS = {}
+_STATS_LOCK = threading.Lock()
+
+
+def set_limit(pool, limit):
+    '''Change the number of commands that can run at once in pool.  Only
+    takes effect before the pool is first used.
+    '''
+    POOL_LIMITS[pool] = limit
+
+def get_pool(pool):
+    with _POOLS_LOCK:
+        if pool not in _POOLS:
+            _LIMITS[pool] = POOL_LIMITS.get(pool, CPUS)
+            _POOLS[pool] = threading.BoundedSemaphore(_LIMITS[pool])
+            _MULTI_LOCKS[pool] = threading.Lock()
+        return _POOLS[pool]
+
+def holds_slot(pool):
+    '''Returns True if this thread holds a slot in pool (see slot).'''
+    return pool in getattr(_LOCAL, 'held', ())
+
+@contextlib.contextmanager
+def slot(pool, count=1):
+    '''Hold a slot in pool.  Commands started in the same pool by this 
+    thread while it holds a slot run under it instead of taking their own, 
+    so that a pipeline of several commands counts (and waits) as one.
+    
+    count slots are held for work that runs that many heavy commands at 
+    once.  It is capped at the pool's limit, so work with more commands 
+    than that holds the whole pool and runs alone in it, over the limit.
+    '''
+    if pool is None or holds_slot(pool):
+        yield
+        return
+    sem = get_pool(pool)
+    count = max(1, min(count, _LIMITS[pool]))
+    if count == 1:
+        sem.acquire()
+    else:
+        # one at a time, so that two of them cannot each hold part of the 
+        # pool and wait forever for the rest
+        with _MULTI_LOCKS[pool]:
+            for n in range(count):
+                sem.acquire()
+    _LOCAL.held = getattr(_LOCAL, 'held', frozenset()) | {pool}
+    try:
+        yield
+    finally:
+        _LOCAL.held = _LOCAL.held - {pool}
+        for n in range(count):
+            sem.release()
+
+def record(pool, name, wall, rusage):
+    with _STATS_LOCK:
+        s = _STATS.setdefault(pool or 'other', {'count': 0, 'wall': 0,
+                                                'user': 0, 'sys': 0,
+                                                'max_rss': 0})
+        s['count'] += 1
+        s['wall'] += wall
+        if rusage is not None:
+            s['user'] += rusage.ru_utime
+            s['sys'] += rusage.ru_stime
+            s['max_rss'] = max(s['max_rss'], rusage.ru_maxrss)
+
+def get_io(pid):
+    '''Returns the bytes read and written by a process (and its reaped
+    children) from /proc/<pid>/io, or None if it cannot be read.
+    '''
+    try:
+        with open('/proc/{}/io'.format(pid)) as f:
+            io = dict([i.split(': ') for i in f.read().splitlines()])
+        return (int(io['rchar']), int(io['wchar']))
+    except (OSError, KeyError, ValueError):
+        return None
+
+def get_exit_code(sts):
+    '''Returns the returncode subprocess would give for a wait status.'''
+    if os.WIFSIGNALED(sts):
+        return -os.WTERMSIG(sts)
+    return os.WEXITSTATUS(sts)
+
+def get_stats():
+    with _STATS_LOCK:
+        return {k: dict(v) for k,v in _STATS.items()}
+
+def log_stats(logger):
+    stats = get_stats()
+    if not stats:
+        return
+    utils.log_items(heading='External Commands', items=[], lines_before=1,
+                    logger=logger)
+    for pool in sorted(stats):
+        s = stats[pool]
+        log_data = [('Commands', s['count']),
+                    ('Wall', '{:.1f} s'.format(s['wall'])),
+                    ('CPU', '{:.1f} s user, {:.1f} s sys'.format(s['user'],
+                                                               s['sys'])),
+                    ('Peak RSS', '{:.1f} MiB'.format(s['max_rss']/1024))]
+        utils.log_items(pool, lines_before=0, sep_pre='-', sep_post='-',
+                        logger=logger)
+        utils.log_items(log_data, col_width=12, indent=4, lines_before=0,
+                        logger=logger)
+
+
+class Popen (subprocess.Popen):
+    '''subprocess.Popen that runs in a pool and records resource usage.
+    
+    Args:
+        pool (str):     name of the pool to run in (None for no limit)
+        log (str):      path of a log file.  stderr (unless given) and a
+                        line of resource usage are appended to it.  LOG can
+                        also be passed as stdout.
+    
+    The pool slot is released when the process has been waited for (by
+    wait, poll, communicate or use as a context manager).
+    '''
+    def __init__(self, args, pool=None, log=None, **kwargs):
+        self.pool = pool
+        self.log = log
+        self.rusage = None
+        self.io = None
+        self.status = None
+        self.wall = None
+        self.tid = threading.get_ident()
+        self.sem = None
+        if log is not None:
+            kwargs.setdefault('stderr', LOG)
+        log_fh = None
+        if LOG in [kwargs.get('stdout'), kwargs.get('stderr')]:
+            log_fh = open(log, 'a') if log is not None else DEVNULL
+            for k in ['stdout', 'stderr']:
+                if kwargs.get(k) == LOG:
+                    kwargs[k] = log_fh
+        self.reap_lock = threading.Lock()
+        if pool is not None and not holds_slot(pool):
+            self.sem = get_pool(pool)
+            self.sem.acquire()
+        self.started = time.time()
+        try:
+            super().__init__(args, **kwargs)
+        except:
+            self.release()
+            raise
+        finally:
+            if log_fh not in [None, DEVNULL]:
+                log_fh.close()
+    
+    def release(self):
+        if self.sem is not None:
+            self.sem.release()
+            self.sem = None
+    
+    def reap(self, block):
+        '''Reap the child with wait4, if it has exited (or, if block, once 
+        it has), and record its resource usage.  Returns the returncode, or 
+        None if the child is still running or another thread is waiting 
+        for it.
+        '''
+        if not self.reap_lock.acquire(blocking=block):
+            return None
+        try:
+            if self.returncode is not None:
+                return self.returncode
+            flags = os.WEXITED | os.WNOWAIT
+            if not block:
+                flags |= os.WNOHANG
+            try:
+                # wait for the child to exit without reaping it, so that its
+                # i/o counters can still be read from /proc
+                if os.waitid(os.P_PID, self.pid, flags) is None:
+                    return None
+                self.io = get_io(self.pid)
+                pid, sts, self.rusage = os.wait4(self.pid, 0)
+                self.returncode = get_exit_code(sts)
+            except ChildProcessError:
+                # reaped elsewhere, so the status is lost (as in subprocess)
+                self.returncode = 0
+            self.status = self.returncode
+            self.finished()
+            return self.returncode
+        finally:
+            self.reap_lock.release()
+    
+    def poll(self):
+        return self.reap(False)
+    
+    def wait(self, timeout=None):
+        if timeout is None:
+            return self.reap(True)
+        end = time.monotonic() + timeout
+        delay = .0005
+        while self.reap(False) is None:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            delay = min(delay * 2, remaining, .05)
+            time.sleep(delay)
+        return self.returncode
+    
+    def finished(self):
+        if self.wall is not None:
+            return
+        self.wall = time.time() - self.started
+        self.release()
+        record(self.pool, self.get_name(), self.wall, self.rusage)
+        self.add_span()
+        self.add_metrics()
+        if self.log is not None:
+            with open(self.log, 'a') as f:
+                f.write('{}\n'.format(self.get_usage_string()))
+    
+    def add_span(self):
+        if not trace.enabled():
+            return
+        cmd = self.args
+        if not isinstance(cmd, (str, bytes)):
+            cmd = ' '.join([str(i) for i in cmd])
+        args = {'cmd': str(cmd),
+                'pool': self.pool,
+                'status': self.status}
+        if self.rusage is not None:
+            args.update({'user': self.rusage.ru_utime,
+                         'sys': self.rusage.ru_stime,
+                         'max_rss_kib': self.rusage.ru_maxrss})
+        if self.io is not None:
+            args.update({'bytes_in': self.io[0], 'bytes_out': self.io[1]})
+        trace.add_span(self.get_name(), 'cmd', self.started, 
+                       self.started + self.wall, args, tid=self.tid)
+    
+    def add_metrics(self):
+        labels = {'tool': self.get_name(), 'pool': self.pool or 'other'}
+        metrics.inc('izdvd_subprocesses_total', **labels)
+        if self.status:
+            metrics.inc('izdvd_subprocess_failures_total', **labels)
+        if self.io is not None:
+            metrics.inc('izdvd_subprocess_bytes_written_total', self.io[1], 
+                        **labels)
+    
+    def get_name(self):
+        if isinstance(self.args, (str, bytes)):
+            return os.path.basename(str(self.args).split()[0])
+        return os.path.basename(str(self.args[0]))
+    
+    def get_usage_string(self):
+        s = '[{}] {}: wall {:.1f}s'.format(self.pool or 'other',
+                                           self.get_name(), self.wall)
+        if self.rusage is not None:
+            s += ', user {:.1f}s, sys {:.1f}s, peak rss {:.1f} MiB'.format(
+                    self.rusage.ru_utime, self.rusage.ru_stime,
+                    self.rusage.ru_maxrss/1024)
+        return s
+
+
+def run(args, pool=None, log=None, input=None, check=False, **kwargs):
+    '''Like subprocess.run, but through a Popen from this module.'''
+    if input is not None:
+        kwargs['stdin'] = PIPE
+    with Popen(args, pool=pool, log=log, **kwargs) as p:
+        try:
+            stdout, stderr = p.communicate(input)
+        except:
+            p.kill()
+            raise
+        retcode = p.poll()
+    if check and retcode:
+        raise CalledProcessError(retcode, p.args, output=stdout,
+                                 stderr=stderr)
+    return subprocess.CompletedProcess(p.args, retcode, stdout, stderr)
+
+def check_output(args, pool=None, log=None, **kwargs):
+    return run(args, pool=pool, log=log, stdout=PIPE, check=True,
+               **kwargs).stdout
+
+def check_call(args, pool=None, log=None, **kwargs):
+    run(args, pool=pool, log=log, check=True, **kwargs)
+    return 0
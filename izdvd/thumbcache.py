@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2013 William Adams
+#  Distributed under the terms of the Modified BSD License.
+#  The full license is in the file LICENSE, distributed with this software.
+#
+
+'''Persistent cache of resized menu button images.
+
+Resized buttons are kept in ~/.cache/izdvd/buttons (or under
+$XDG_CACHE_HOME), keyed by the identity of the source image (path,
+modification time and size) and the geometry it was resized to, so that
+making a menu for the same images again (or another disc of the same
+library) skips decoding and resizing them.  The least recently used
+entries are removed when the cache grows over MAX_SIZE.
+'''
+
+from izdvd import config
+from izdvd import metrics
+import threading
+import tempfile
+import hashlib
+import shutil
+import json
+import os
+
+
+# change when the way buttons are resized changes, to ignore old entries
+VERSION = 1
+MAX_SIZE = 256*1024*1024
+
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                         os.path.join(os.path.expanduser('~'), '.cache'),
+                         config.PROG_NAME, 'buttons')
+
+_LOCK = threading.Lock()
+
+
+def set_max_size(size):
+    '''Change the size limit of the cache (0 to disable it).'''
+    global MAX_SIZE
+    MAX_SIZE = size
+
+def get_key(path, width, height, ignore_aspect=False):
+    st = os.stat(path)
+    ident = [VERSION, os.path.abspath(path), st.st_mtime_ns, st.st_size,
+             width, height, ignore_aspect]
+    return hashlib.sha1(json.dumps(ident).encode()).hexdigest()
+
+def get(key, ext):
+    '''Returns the path of the cached image for key, or None.'''
+    if not MAX_SIZE:
+        return None
+    path = os.path.join(CACHE_DIR, '{}.{}'.format(key, ext))
+    try:
+        # the modification time is the last use, for eviction
+        os.utime(path)
+    except OSError:
+        metrics.inc('izdvd_cache_misses_total', cache='buttons')
+        return None
+    metrics.inc('izdvd_cache_hits_total', cache='buttons')
+    return path
+
+def put(key, src):
+    '''Add a copy of src to the cache as the image for key.'''
+    if not MAX_SIZE:
+        return
+    ext = os.path.splitext(src)[1]
+    path = os.path.join(CACHE_DIR, '{}{}'.format(key, ext))
+    tmp = None
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # a unique name, since other threads and processes may be adding 
+        # the same key
+        fd, tmp = tempfile.mkstemp(prefix='{}.'.format(key), suffix='.tmp', 
+                                   dir=CACHE_DIR)
+        os.close(fd)
+        shutil.copy(src, tmp)
+        os.replace(tmp, path)
+    except OSError:
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+        return
+    evict()
+
+def evict():
+    '''Remove the least recently used entries until the cache fits in
+    MAX_SIZE.
+    '''
+    with _LOCK:
+        entries = []
+        try:
+            names = os.listdir(CACHE_DIR)
+        except OSError:
+            return
+        for i in names:
+            path = os.path.join(CACHE_DIR, i)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum([i[1] for i in entries])
+        for mtime, size, path in sorted(entries):
+            if total <= MAX_SIZE:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2013 William Adams
+#  Distributed under the terms of the Modified BSD License.
+#  The full license is in the file LICENSE, distributed with this software.
+#
+
+'''Optional timeline of a run in the Chrome trace event format.
+
+When enabled (see enable), the stages of DVD, DVDMenu and BG, Img
+operations and every external command (see runner) are recorded as spans,
+and written to a json file that can be opened in chrome://tracing or
+https://ui.perfetto.dev.  When it is not enabled, tracing does nothing.
+
+Spans of stages are also passed to metrics (when it is enabled).
+'''
+
+from izdvd import metrics
+import threading
+import contextlib
+import functools
+import atexit
+import json
+import time
+import os
+
+
+_PATH = None
+_EVENTS = []
+_THREADS = {}
+_LOCK = threading.Lock()
+_START = time.time()
+
+
+def enable(path):
+    '''Start recording spans, to be written to path when the process
+    exits (or when write is called).
+    '''
+    global _PATH
+    if _PATH is None:
+        atexit.register(write)
+    _PATH = os.path.abspath(path)
+
+def enabled():
+    return _PATH is not None
+
+def add_span(name, cat, start, end, args=None, tid=None):
+    '''Record a span from start to end (as returned by time.time()).'''
+    if _PATH is None:
+        return
+    if tid is None:
+        tid = threading.get_ident()
+    event = {'name': name,
+             'cat': cat,
+             'ph': 'X',
+             'ts': round((start - _START) * 1000000),
+             'dur': round((end - start) * 1000000),
+             'pid': os.getpid(),
+             'tid': tid}
+    if args:
+        event['args'] = args
+    with _LOCK:
+        _EVENTS.append(event)
+        if tid == threading.get_ident():
+            _THREADS[tid] = threading.current_thread().name
+
+@contextlib.contextmanager
+def span(name, cat='stage', **args):
+    if _PATH is None and not metrics.enabled():
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        end = time.time()
+        add_span(name, cat, start, end, args)
+        if cat == 'stage':
+            metrics.stage_finished(name, end - start)
+
+def traced(cat='stage'):
+    '''Decorator that records each call of a method as a span named
+    "<class>.<method>".
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if _PATH is None and not metrics.enabled():
+                return func(self, *args, **kwargs)
+            name = '{}.{}'.format(type(self).__name__, func.__name__)
+            with span(name, cat):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def write(path=None):
+    path = path or _PATH
+    if path is None:
+        return
+    with _LOCK:
+        events = list(_EVENTS)
+        threads = dict(_THREADS)
+    pid = os.getpid()
+    for tid, name in threads.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                       'tid': tid, 'args': {'name': name}})
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -7,6 +7,9 @@
 #
 
 from izdvd import config
+from izdvd import runner
+from izdvd import metrics
+from izdvd import workspace
 import os
 import os.path
 import argparse
@@ -61,13 +64,12 @@ def get_out_paths(prog_name, out_name, out_dir, tmp_dir, tmp_required_space):
     if not out_dir:
         out_dir = os.path.join(os.getcwd(), out_name)
     
-    # tmp_dir
+    # tmp_dir (the parent of the run's workspace, see workspace.Workspace)
     if not tmp_dir:
-        tmp = tempfile.gettempdir()
-        tmp_free = get_space_available(tmp)
-        if tmp_free > tmp_required_space:
-            tmp_dir = os.path.join(tmp, prog_name, out_name)
-        else:
+        tmp_dir = os.path.join(tempfile.gettempdir(), prog_name)
+        # leave room for what other runs have reserved
+        tmp_free = workspace.get_space_available(tmp_dir)
+        if tmp_free <= tmp_required_space:
             tmp_dir = os.path.join(out_dir, 'tmp')
     
     # make dirs if they don't exist
@@ -77,6 +79,38 @@ def get_out_paths(prog_name, out_name, out_dir, tmp_dir, tmp_required_space):
     
     return out_name, os.path.abspath(out_dir), os.path.abspath(tmp_dir)
 
+_MEDIAINFO_CACHE = {}
+
+def get_mediainfo(path, fmt=None):
+    '''Returns the output of mediainfo for path (optionally with a 
+    --Output template).  Results are cached for the life of the process, 
+    keyed by path, modification time and size, so that files probed more 
+    than once (e.g., when planning several discs) only run mediainfo once.
+    '''
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_mtime, st.st_size, fmt)
+    if key in _MEDIAINFO_CACHE:
+        metrics.inc('izdvd_cache_hits_total', cache='mediainfo')
+    else:
+        metrics.inc('izdvd_cache_misses_total', cache='mediainfo')
+        cmd = ['mediainfo', path] if fmt is None else ['mediainfo', fmt, path]
+        _MEDIAINFO_CACHE[key] = runner.check_output(cmd, 
+                                                    universal_newlines=True)
+    return _MEDIAINFO_CACHE[key]
+
+def get_logger(kind, out_log):
+    '''Returns a logger that writes to out_log.  Each log file gets its own
+    logger (and a single handler) so that several DVDs/menus made in the 
+    same process do not write to each other's logs.
+    '''
+    name = '{}.{}.{}'.format(config.PROG_NAME, kind, 
+                             abs(hash(os.path.abspath(out_log))))
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        logger.addHandler(logging.FileHandler(out_log))
+    logger.setLevel(logging.INFO)
+    return logger
+
 def get_dvd_dims(ar, dvd_format):
     storage_width = 720
     if dvd_format.lower() == 'ntsc':
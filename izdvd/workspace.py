@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2013 William Adams
+#  Distributed under the terms of the Modified BSD License.
+#  The full license is in the file LICENSE, distributed with this software.
+#
+
+'''Private temp directories, so that several runs (and the workers within a
+run) can share a host and a temp dir without colliding.
+
+Each Workspace is a new directory (made with mkdtemp, so its name is never
+reused) holding a small reservation file with the owner's pid and the
+disk space it expects to use.  Runs choosing a temp dir subtract the space
+other live workspaces have reserved but not yet used, and workspaces left
+behind by processes that no longer exist are removed.
+'''
+
+from izdvd import config
+import tempfile
+import threading
+import shutil
+import atexit
+import json
+import os
+
+
+RESERVATION_FILE = '.{}-reservation'.format(config.PROG_NAME)
+
+_IMAGES = None
+_IMAGES_LOCK = threading.Lock()
+
+
+class Error(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class Workspace (object):
+    '''A private directory under root.
+    
+    Args:
+        root (str):     directory to make the workspace in
+        name (str):     prefix for the workspace's directory name
+        budget (int):   bytes the workspace may use (and reserves); 0 for
+                        no limit
+        keep (bool):    leave the directory in place on cleanup
+    
+    The directory is removed by cleanup(), or when the process exits.
+    '''
+    def __init__(self, root, name, budget=0, keep=False):
+        self.root = os.path.abspath(root)
+        self.name = name
+        self.budget = budget
+        self.keep = keep
+        self.cleaned = False
+        if not os.path.exists(self.root):
+            os.makedirs(self.root, exist_ok=True)
+        remove_stale(self.root)
+        self.path = tempfile.mkdtemp(prefix='{}.'.format(name), dir=self.root)
+        self.write_reservation()
+        atexit.register(self.cleanup)
+    
+    def write_reservation(self):
+        path = os.path.join(self.path, RESERVATION_FILE)
+        with open(path, 'w') as f:
+            json.dump({'pid': os.getpid(), 'bytes': self.budget}, f)
+    
+    def get_usage(self):
+        return get_dir_size(self.path)
+    
+    def check_budget(self, required):
+        '''Raise Error if writing required more bytes would go over the
+        budget.
+        '''
+        if not self.budget:
+            return
+        used = self.get_usage()
+        if used + required > self.budget:
+            raise Error('Not enough space left in the temp budget for {}: '
+                        '{:.1f} MiB used, {:.1f} MiB needed, budget is '
+                        '{:.1f} MiB'.format(self.path, used/1024/1024,
+                                            required/1024/1024,
+                                            self.budget/1024/1024))
+    
+    def cleanup(self):
+        if self.cleaned:
+            return
+        if self.keep:
+            # no longer reserved, and not stale either
+            try:
+                os.remove(os.path.join(self.path, RESERVATION_FILE))
+            except OSError:
+                pass
+        else:
+            shutil.rmtree(self.path, ignore_errors=True)
+        self.cleaned = True
+
+
+def get_dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for i in files:
+            try:
+                size += os.path.getsize(os.path.join(root, i))
+            except OSError:
+                pass
+    return size
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def get_reservations(root):
+    '''Returns a list of (path, pid, reserved bytes) for the workspaces in
+    root.
+    '''
+    found = []
+    if not os.path.isdir(root):
+        return found
+    for i in os.listdir(root):
+        path = os.path.join(root, i)
+        try:
+            with open(os.path.join(path, RESERVATION_FILE)) as f:
+                r = json.load(f)
+            found.append((path, int(r['pid']), int(r['bytes'])))
+        except (OSError, ValueError, KeyError, TypeError):
+            continue
+    return found
+
+def remove_stale(root):
+    '''Remove the workspaces in root whose process no longer exists.'''
+    for path, pid, reserved in get_reservations(root):
+        if not is_alive(pid):
+            shutil.rmtree(path, ignore_errors=True)
+
+def get_space_available(root):
+    '''Free space in root, less what other live workspaces in root have
+    reserved and not used yet.
+    '''
+    path = root
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    s = os.statvfs(path)
+    free = s.f_frsize * s.f_bavail
+    for ws_path, pid, reserved in get_reservations(root):
+        if reserved and is_alive(pid):
+            free -= max(0, reserved - get_dir_size(ws_path))
+    return free
+
+def get_images_dir():
+    '''Returns the process-wide workspace for Img temp files.'''
+    global _IMAGES
+    with _IMAGES_LOCK:
+        if _IMAGES is None:
+            root = os.path.join(tempfile.gettempdir(), config.PROG_NAME)
+            _IMAGES = Workspace(root, 'images')
+        return _IMAGES.path
@@ -14,7 +14,8 @@ setup(
     name='izdvd',
     version='0.1.2',
     packages=['izdvd'],
-    scripts=['bin/izdvd', 'bin/izdvdmenu', 'bin/izdvdbg'],
+    scripts=['bin/izdvd', 'bin/izdvdmenu', 'bin/izdvdbg',
+             'bin/izdvdbatch'],
     author='William Adams',
     author_email='willadams+dev@gmail.com',
     url='https://github.com/izzilly/izdvd',